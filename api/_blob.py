@@ -0,0 +1,102 @@
+"""Blob backends for generated images: Vercel Blob, or files on disk.
+
+BLOB_BACKEND picks one:
+
+    vercel    BLOB_READ_WRITE_TOKEN; public blobs behind Vercel's CDN
+    local     files under BLOB_DIR (default: no-rulez-blobs in the system
+              temp directory); for tests, the bench and the local dev server
+
+Without BLOB_BACKEND, Vercel Blob is used if its token is set. Otherwise
+there is no backend (BACKEND is None) and images aren't cached: on Vercel
+each instance has its own /tmp, so the one serving an image would seldom
+be the one that stored it.
+
+Blobs are written once under a name and never change. ``put`` returns a
+locator (the blob's URL, or its path under BLOB_DIR) to keep with the name,
+and ``get`` reads the blob back from it, or returns None if it is gone.
+"""
+
+import json
+import os
+import tempfile
+from urllib.parse import quote
+
+import _http
+
+TIMEOUT = float(os.environ.get("BLOB_TIMEOUT", "15"))
+
+
+class VercelBlob:
+    name = "vercel"
+
+    def __init__(self, token, api_url="https://blob.vercel-storage.com"):
+        self.token = token
+        self.api_url = api_url.rstrip("/")
+
+    def put(self, name, data, content_type):
+        headers = {
+            "Authorization": f"Bearer {self.token}",
+            "x-api-version": "7",
+            "x-content-type": content_type,
+            "x-add-random-suffix": "0",
+            "x-allow-overwrite": "1",  # same name, same bytes
+            "x-cache-control-max-age": "31536000",
+        }
+        reply = _http.request("PUT", f"{self.api_url}/{quote(name)}", data, headers, timeout=TIMEOUT)
+        return json.loads(reply)["url"]
+
+    def get(self, locator):
+        try:
+            return _http.request("GET", locator, timeout=TIMEOUT)
+        except _http.HTTPStatusError as e:
+            if e.status == 404:
+                return None
+            raise
+
+
+class LocalBlob:
+    name = "local"
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, locator):
+        path = os.path.normpath(os.path.join(self.root, locator))
+        if os.path.isabs(locator) or not path.startswith(os.path.join(self.root, "")):
+            raise ValueError(f"blob outside {self.root}: {locator}")
+        return path
+
+    def put(self, name, data, content_type):
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Readers never see half a file
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        return name
+
+    def get(self, locator):
+        try:
+            with open(self._path(locator), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+
+def _load():
+    token = os.environ.get("BLOB_READ_WRITE_TOKEN", "")
+    kind = os.environ.get("BLOB_BACKEND", "").strip().lower()
+    if not kind:
+        if not token:
+            return None
+        kind = "vercel"
+    if kind == "vercel":
+        return VercelBlob(token, os.environ.get("BLOB_API_URL", "https://blob.vercel-storage.com"))
+    if kind == "local":
+        root = os.environ.get("BLOB_DIR") or os.path.join(tempfile.gettempdir(), "no-rulez-blobs")
+        return LocalBlob(os.path.abspath(root))
+    raise ValueError(f"unknown BLOB_BACKEND: {kind}")
+
+
+BACKEND = _load()
@@ -0,0 +1,265 @@
+"""Keep-alive HTTP(S) client shared by every upstream call in a warm instance.
+
+Connections are pooled per (scheme, host, port) at module scope, so a warm
+serverless instance pays the TCP + TLS handshake once per host instead of once
+per request.
+"""
+
+import http.client
+import select
+import socket
+import threading
+import time
+from urllib.parse import urlsplit
+
+DEFAULT_TIMEOUT = 10
+HOST_TIMEOUTS = {
+    "api.deepseek.com": 120,
+    "api.replicate.com": 60,
+}
+IDLE_TTL = 50  # seconds; drop idle sockets before the upstream does
+MAX_IDLE_PER_HOST = 8
+
+# Errors that mean a reused keep-alive socket was closed under us
+_STALE_ERRORS = (ConnectionResetError, BrokenPipeError, http.client.BadStatusLine)
+
+
+class HTTPStatusError(Exception):
+    """Upstream answered with a 4xx/5xx status."""
+
+    def __init__(self, status, body):
+        super().__init__(f"HTTP {status}: {body[:200].decode('utf-8', errors='replace')}")
+        self.status = status
+        self.body = body
+
+
+class Cancelled(Exception):
+    """The request was abandoned through its Cancel token."""
+
+
+class Cancel:
+    """Lets another thread abort the requests started with it.
+
+    Cancelling shuts down their sockets, so a blocked read returns at once
+    instead of waiting out its timeout.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self._conns = set()
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            conns = list(self._conns)
+        for conn in conns:
+            _abort(conn)
+
+    def _attach(self, conn):
+        with self._lock:
+            if self.cancelled:
+                raise Cancelled()
+            self._conns.add(conn)
+
+    def _detach(self, conn):
+        with self._lock:
+            self._conns.discard(conn)
+
+
+def _abort(conn):
+    sock = conn.sock
+    if sock is None:
+        return
+    try:
+        # The plain socket call: SSLSocket.shutdown would tear down TLS state
+        # under a read that is still running in another thread
+        socket.socket.shutdown(sock, socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def _healthy(conn):
+    """An idle socket that is readable has been closed (or sent junk) by the peer."""
+    sock = conn.sock
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (OSError, ValueError):
+        return False
+    return not readable
+
+
+class _Pool:
+    def __init__(self):
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, timeout):
+        """Return (connection, reused)."""
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                conn, used = idle.pop()
+                if time.monotonic() - used < IDLE_TTL and _healthy(conn):
+                    conn.timeout = timeout
+                    conn.sock.settimeout(timeout)
+                    return conn, True
+                conn.close()
+
+        scheme, host, port = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port, timeout=timeout), False
+        return http.client.HTTPConnection(host, port, timeout=timeout), False
+
+    def put(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < MAX_IDLE_PER_HOST:
+                idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+
+_pool = _Pool()
+
+
+def _open(method, url, body, headers, timeout, cancel=None):
+    parts = urlsplit(url)
+    https = parts.scheme == "https"
+    key = (parts.scheme, parts.hostname, parts.port or (443 if https else 80))
+    path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+    if timeout is None:
+        timeout = HOST_TIMEOUTS.get(parts.hostname, DEFAULT_TIMEOUT)
+
+    while True:
+        conn, reused = _pool.get(key, timeout)
+        if cancel is not None:
+            try:
+                cancel._attach(conn)
+            except Cancelled:
+                _pool.put(key, conn)
+                raise
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            if cancel is not None and cancel.cancelled:
+                raise Cancelled()
+            return key, conn, conn.getresponse()
+        except _STALE_ERRORS as e:
+            _close(conn, cancel)
+            if cancel is not None and cancel.cancelled:
+                raise Cancelled() from e
+            if not reused:
+                raise
+            # The pooled socket went away while idle; retry on a fresh one
+        except Cancelled:
+            _close(conn, cancel)
+            raise
+        except BaseException as e:
+            _close(conn, cancel)
+            if cancel is not None and cancel.cancelled:
+                raise Cancelled() from e
+            raise
+
+
+def _close(conn, cancel):
+    if cancel is not None:
+        cancel._detach(conn)
+    conn.close()
+
+
+def _release(key, conn, resp, cancel=None):
+    if cancel is not None:
+        cancel._detach(conn)
+        if cancel.cancelled:
+            conn.close()
+            return
+    if resp.will_close:
+        conn.close()
+    else:
+        _pool.put(key, conn)
+
+
+def request(method, url, body=None, headers=None, timeout=None, cancel=None):
+    """Send a request over a pooled connection and return the response body.
+
+    Raises HTTPStatusError for 4xx/5xx replies, and Cancelled if ``cancel``
+    fires first.
+    """
+    key, conn, resp = _open(method, url, body, headers, timeout, cancel)
+    try:
+        data = resp.read()
+    except BaseException as e:
+        _close(conn, cancel)
+        if cancel is not None and cancel.cancelled:
+            raise Cancelled() from e
+        raise
+    if cancel is not None and cancel.cancelled:
+        _close(conn, cancel)  # a shut-down socket reads as a short body
+        raise Cancelled()
+    _release(key, conn, resp, cancel)
+    if resp.status >= 400:
+        raise HTTPStatusError(resp.status, data)
+    return data
+
+
+def download(url, max_bytes, timeout=None):
+    """GET ``url`` and return (body, content type) without reading past ``max_bytes``.
+
+    Raises HTTPStatusError for 4xx/5xx replies, and ValueError for a body
+    that is, or says it is, any larger.
+    """
+    key, conn, resp = _open("GET", url, None, None, timeout)
+    try:
+        length = resp.getheader("Content-Length")
+        if resp.status < 400 and length is not None and int(length) > max_bytes:
+            raise ValueError(f"{url}: {length} bytes, over {max_bytes}")
+        data = resp.read(max_bytes + 1)
+        if len(data) > max_bytes:
+            raise ValueError(f"{url}: over {max_bytes} bytes")
+    except BaseException:
+        _close(conn, None)
+        raise
+    if resp.isclosed():
+        _release(key, conn, resp)
+    else:
+        _close(conn, None)  # the error body was longer than we read
+    if resp.status >= 400:
+        raise HTTPStatusError(resp.status, data)
+    content_type = resp.getheader("Content-Type", "").split(";")[0].strip().lower()
+    return data, content_type
+
+
+def stream_lines(method, url, body=None, headers=None, timeout=None, cancel=None):
+    """Yield the response body line by line (bytes) as it arrives.
+
+    The connection goes back to the pool only if the body was read to the
+    end; a stream abandoned half way is closed instead.
+    """
+    key, conn, resp = _open(method, url, body, headers, timeout, cancel)
+    if resp.status >= 400:
+        try:
+            data = resp.read()
+        except BaseException:
+            _close(conn, cancel)
+            raise
+        _release(key, conn, resp, cancel)
+        raise HTTPStatusError(resp.status, data)
+
+    finished = False
+    try:
+        for line in resp:
+            yield line
+        if cancel is not None and cancel.cancelled:
+            raise Cancelled()
+        finished = True
+    except Exception as e:
+        if cancel is not None and cancel.cancelled:
+            raise Cancelled() from e
+        raise
+    finally:
+        if finished:
+            _release(key, conn, resp, cancel)
+        else:
+            _close(conn, cancel)
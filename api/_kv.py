@@ -0,0 +1,526 @@
+"""Key-value backends: Upstash over REST, Redis over its own protocol, or memory.
+
+KV_BACKEND picks one:
+
+    upstash   KV_REST_API_URL / KV_REST_API_TOKEN (or the UPSTASH_REDIS_REST_*
+              names), one HTTPS request per command or pipeline
+    redis     REDIS_URL, e.g. redis://:password@localhost:6379/0 or rediss://
+              for TLS; RESP over pooled TCP connections, for self-hosted
+              deployments and a local redis-server
+    memory    this process only, with TTLs; for tests and the local dev server
+
+Without KV_BACKEND, Upstash is used if its URL is set, then Redis if
+REDIS_URL is.
+
+Every backend answers ``command``, ``pipeline`` and ``subscribe`` the way
+Upstash does: bulk replies as str, integers as int, nil as None. Server
+errors raise KVError. The memory backend can't run Lua, so scripts passed
+to EVAL need a Python version registered with ``emulate``.
+"""
+
+import hashlib
+import json
+import os
+import queue
+import select
+import socket
+import ssl
+import threading
+import time
+from urllib.parse import unquote, urlsplit
+
+import _http
+
+TIMEOUT = float(os.environ.get("KV_TIMEOUT", "10"))
+IDLE_TTL = 50  # seconds; drop idle sockets before the server does
+MAX_IDLE = 8
+
+_EMULATIONS = {}
+
+
+class KVError(Exception):
+    """The server rejected a command (NOSCRIPT, WRONGTYPE, ...)."""
+
+
+def script_sha(script):
+    return hashlib.sha1(script.encode("utf-8")).hexdigest()
+
+
+def emulate(script):
+    """Register ``fn(call, keys, argv)`` as the memory backend's version of a Lua script.
+
+    ``call(*args)`` runs a command like redis.call, inside the same atomic step.
+    """
+    def register(fn):
+        _EMULATIONS[script_sha(script)] = fn
+        return fn
+    return register
+
+
+def emulation(sha):
+    """The function registered for a script's SHA, or None."""
+    return _EMULATIONS.get(sha)
+
+
+# --- Upstash REST ---
+
+class Upstash:
+    name = "upstash"
+
+    def __init__(self, url, token):
+        self.url = url
+        self.token = token
+
+    def _headers(self):
+        return {
+            "Authorization": f"Bearer {self.token}",
+            "Content-Type": "application/json"
+        }
+
+    def _post(self, path, payload):
+        body = json.dumps(payload).encode()
+        try:
+            return json.loads(_http.request("POST", self.url + path, body, self._headers()))
+        except _http.HTTPStatusError as e:
+            if e.status < 500:
+                try:
+                    message = json.loads(e.body).get("error")
+                except (ValueError, AttributeError):
+                    message = None
+                if message:
+                    raise KVError(message) from e
+            raise
+
+    def command(self, *args):
+        return self._post("", [str(a) for a in args]).get("result")
+
+    def pipeline(self, commands):
+        data = self._post("/pipeline", [[str(a) for a in cmd] for cmd in commands])
+        return [item.get("result") for item in data]
+
+    def subscribe(self, channel, timeout):
+        deadline = time.time() + timeout
+        headers = dict(self._headers(), Accept="text/event-stream")
+        lines = _http.stream_lines("POST", f"{self.url}/subscribe/{channel}",
+                                   headers=headers, timeout=timeout)
+        try:
+            for raw in lines:
+                line = raw.decode("utf-8").strip()
+                if line.startswith("data:"):
+                    kind, _, rest = line[5:].strip().partition(",")
+                    if kind == "subscribe":
+                        yield "subscribe", None
+                    elif kind == "message":
+                        yield "message", rest[len(channel) + 1:]
+                if time.time() >= deadline:
+                    return
+        except TimeoutError:
+            return
+        finally:
+            lines.close()
+
+
+# --- Redis (RESP) ---
+
+def _encode(args):
+    out = [b"*%d\r\n" % len(args)]
+    for a in args:
+        data = a if isinstance(a, bytes) else str(a).encode("utf-8")
+        out.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b"".join(out)
+
+
+def _read_reply(f):
+    """One reply off the wire; an error reply comes back as a KVError instance."""
+    line = f.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionResetError("Redis closed the connection")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest.decode("utf-8")
+    if kind == b"-":
+        return KVError(rest.decode("utf-8", errors="replace"))
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        n = int(rest)
+        if n < 0:
+            return None
+        data = f.read(n + 2)
+        if len(data) != n + 2:
+            raise ConnectionResetError("Redis closed the connection")
+        return data[:-2].decode("utf-8", errors="replace")
+    if kind == b"*":
+        n = int(rest)
+        return None if n < 0 else [_read_reply(f) for _ in range(n)]
+    raise KVError(f"Unexpected reply from Redis: {line[:40]!r}")
+
+
+class _Conn:
+    def __init__(self, sock):
+        self.sock = sock
+        self.file = sock.makefile("rb")
+        self.used = time.monotonic()
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+class Redis:
+    name = "redis"
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host = parts.hostname or "localhost"
+        self.port = parts.port or 6379
+        self.tls = parts.scheme == "rediss"
+        self.username = unquote(parts.username) if parts.username else None
+        self.password = unquote(parts.password) if parts.password else None
+        self.db = int(parts.path.strip("/") or 0)
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self, timeout=TIMEOUT):
+        sock = socket.create_connection((self.host, self.port), timeout=timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.tls:
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=self.host)
+        conn = _Conn(sock)
+        setup = []
+        if self.password:
+            setup.append(["AUTH", self.username, self.password] if self.username else ["AUTH", self.password])
+        if self.db:
+            setup.append(["SELECT", self.db])
+        try:
+            for reply in self._roundtrip(conn, setup):
+                if isinstance(reply, KVError):
+                    raise reply
+        except BaseException:
+            conn.close()
+            raise
+        return conn
+
+    def _get(self):
+        """Return (connection, reused)."""
+        with self._lock:
+            while self._idle:
+                conn = self._idle.pop()
+                if time.monotonic() - conn.used < IDLE_TTL and _idle_ok(conn.sock):
+                    return conn, True
+                conn.close()
+        return self._connect(), False
+
+    def _put(self, conn):
+        conn.used = time.monotonic()
+        with self._lock:
+            if len(self._idle) < MAX_IDLE:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    @staticmethod
+    def _roundtrip(conn, commands):
+        if not commands:
+            return []
+        conn.sock.sendall(b"".join(_encode(cmd) for cmd in commands))
+        return [_read_reply(conn.file) for _ in commands]
+
+    def _run(self, commands):
+        while True:
+            conn, reused = self._get()
+            try:
+                replies = self._roundtrip(conn, commands)
+            except (ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if not reused:
+                    raise
+                # The pooled socket went away while idle; retry on a fresh one
+                continue
+            except BaseException:
+                conn.close()
+                raise
+            self._put(conn)
+            return replies
+
+    def command(self, *args):
+        reply = self._run([args])[0]
+        if isinstance(reply, KVError):
+            raise reply
+        return reply
+
+    def pipeline(self, commands):
+        # Errors come back as None, as they do from the Upstash pipeline
+        return [None if isinstance(r, KVError) else r for r in self._run(commands)]
+
+    def subscribe(self, channel, timeout):
+        # A subscribed connection can't run other commands, so it isn't pooled
+        deadline = time.time() + timeout
+        conn = self._connect(timeout=min(TIMEOUT, timeout))
+        try:
+            conn.sock.sendall(_encode(["SUBSCRIBE", channel]))
+            while True:
+                left = deadline - time.time()
+                if left <= 0:
+                    return
+                conn.sock.settimeout(left)
+                reply = _read_reply(conn.file)
+                if isinstance(reply, KVError):
+                    raise reply
+                if reply[0] == "subscribe":
+                    yield "subscribe", None
+                elif reply[0] == "message":
+                    yield "message", reply[2]
+        except (TimeoutError, socket.timeout):
+            return
+        finally:
+            conn.close()
+
+
+def _idle_ok(sock):
+    """An idle socket that is readable has been closed (or sent junk) by the server."""
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (OSError, ValueError):
+        return False
+    return not readable
+
+
+# --- Memory ---
+
+class Memory:
+    """Strings, lists and hashes in a dict, behind one lock.
+
+    Keys expire lazily when read. Only the commands the game uses are
+    implemented; anything else raises KVError like an unknown command would.
+    """
+
+    name = "memory"
+
+    def __init__(self):
+        self._data = {}
+        self._expiry = {}
+        self._scripts = {}
+        self._channels = {}
+        self._lock = threading.RLock()
+
+    def command(self, *args):
+        with self._lock:
+            return self._run([str(a) for a in args])
+
+    def pipeline(self, commands):
+        results = []
+        with self._lock:
+            for cmd in commands:
+                try:
+                    results.append(self._run([str(a) for a in cmd]))
+                except KVError:
+                    results.append(None)
+        return results
+
+    def subscribe(self, channel, timeout):
+        deadline = time.time() + timeout
+        inbox = queue.Queue()
+        with self._lock:
+            self._channels.setdefault(channel, set()).add(inbox)
+        try:
+            yield "subscribe", None
+            while True:
+                left = deadline - time.time()
+                if left <= 0:
+                    return
+                try:
+                    message = inbox.get(timeout=left)
+                except queue.Empty:
+                    return
+                yield "message", message
+        finally:
+            with self._lock:
+                listeners = self._channels.get(channel, set())
+                listeners.discard(inbox)
+                if not listeners:
+                    self._channels.pop(channel, None)
+
+    # Commands (called with the lock held)
+
+    def _get(self, key, kind=None):
+        exp = self._expiry.get(key)
+        if exp is not None and exp <= time.time():
+            self._data.pop(key, None)
+            self._expiry.pop(key, None)
+        value = self._data.get(key)
+        if kind is not None and value is not None and not isinstance(value, kind):
+            raise KVError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return value
+
+    def _set(self, key, value, ex=None):
+        self._data[key] = value
+        if ex:
+            self._expiry[key] = time.time() + int(ex)
+        else:
+            self._expiry.pop(key, None)
+
+    def _hash(self, key):
+        h = self._get(key, dict)
+        if h is None:
+            h = self._data[key] = {}
+        return h
+
+    def _delete(self, key):
+        self._expiry.pop(key, None)
+        return self._data.pop(key, None) is not None
+
+    def _run(self, cmd):
+        op, args = cmd[0].upper(), cmd[1:]
+        if op == "PING":
+            return "PONG"
+        if op == "GET":
+            return self._get(args[0], str)
+        if op == "SET":
+            flags = [a.upper() for a in args[2:]]
+            exists = self._get(args[0]) is not None
+            if ("NX" in flags and exists) or ("XX" in flags and not exists):
+                return None
+            ex = args[2 + flags.index("EX") + 1] if "EX" in flags else None
+            self._set(args[0], args[1], ex)
+            return "OK"
+        if op == "DEL":
+            return sum(1 for k in args if self._get(k) is not None and self._delete(k))
+        if op == "EXISTS":
+            return sum(1 for k in args if self._get(k) is not None)
+        if op == "MGET":
+            return [v if isinstance(v, str) else None for v in map(self._get, args)]
+        if op in ("INCR", "INCRBY"):
+            value = int(self._get(args[0], str) or 0) + (int(args[1]) if op == "INCRBY" else 1)
+            exp = self._expiry.get(args[0])
+            self._data[args[0]] = str(value)
+            if exp is None:
+                self._expiry.pop(args[0], None)
+            return value
+        if op == "EXPIRE":
+            if self._get(args[0]) is None:
+                return 0
+            self._expiry[args[0]] = time.time() + int(args[1])
+            return 1
+        if op == "TTL":
+            if self._get(args[0]) is None:
+                return -2
+            exp = self._expiry.get(args[0])
+            return -1 if exp is None else max(0, round(exp - time.time()))
+        if op in ("LPUSH", "RPUSH"):
+            lst = self._get(args[0], list)
+            if lst is None:
+                lst = self._data[args[0]] = []
+            if op == "LPUSH":
+                lst[:0] = reversed(args[1:])
+            else:
+                lst.extend(args[1:])
+            return len(lst)
+        if op == "LTRIM":
+            lst = self._get(args[0], list)
+            if lst is not None:
+                lst[:] = lst[_list_slice(len(lst), args[1], args[2])]
+                if not lst:
+                    self._delete(args[0])
+            return "OK"
+        if op == "LRANGE":
+            lst = self._get(args[0], list) or []
+            return lst[_list_slice(len(lst), args[1], args[2])]
+        if op == "HINCRBY":
+            h = self._hash(args[0])
+            h[args[1]] = str(int(h.get(args[1], 0)) + int(args[2]))
+            return int(h[args[1]])
+        if op == "HSET":
+            h = self._hash(args[0])
+            pairs = list(zip(args[1::2], args[2::2]))
+            added = sum(1 for k, _ in pairs if k not in h)
+            h.update(pairs)
+            return added
+        if op == "HGET":
+            return (self._get(args[0], dict) or {}).get(args[1])
+        if op == "HDEL":
+            h = self._get(args[0], dict) or {}
+            removed = sum(1 for k in args[1:] if h.pop(k, None) is not None)
+            if not h:
+                self._delete(args[0])
+            return removed
+        if op == "HGETALL":
+            return [x for k, v in (self._get(args[0], dict) or {}).items() for x in (k, v)]
+        if op == "ZADD":
+            z = self._get(args[0], _ZSet)
+            if z is None:
+                z = self._data[args[0]] = _ZSet()
+            pairs = list(zip(args[2::2], map(float, args[1::2])))
+            added = sum(1 for m, _ in pairs if m not in z)
+            z.update(pairs)
+            return added
+        if op == "ZREM":
+            z = self._get(args[0], _ZSet) or _ZSet()
+            removed = sum(1 for m in args[1:] if z.pop(m, None) is not None)
+            if not z and args[0] in self._data:
+                self._delete(args[0])
+            return removed
+        if op == "ZCARD":
+            return len(self._get(args[0], _ZSet) or ())
+        if op == "ZSCORE":
+            score = (self._get(args[0], _ZSet) or {}).get(args[1])
+            return None if score is None else repr(score)
+        if op == "ZRANK":
+            ranked = (self._get(args[0], _ZSet) or _ZSet()).ranked()
+            return ranked.index(args[1]) if args[1] in ranked else None
+        if op == "ZRANGE":
+            ranked = (self._get(args[0], _ZSet) or _ZSet()).ranked()
+            return ranked[_list_slice(len(ranked), args[1], args[2])]
+        if op == "PUBLISH":
+            listeners = self._channels.get(args[0], ())
+            for inbox in listeners:
+                inbox.put(args[1])
+            return len(listeners)
+        if op in ("EVAL", "EVALSHA"):
+            sha = script_sha(args[0]) if op == "EVAL" else args[0]
+            if op == "EVAL":
+                self._scripts[sha] = emulation(sha)
+                if self._scripts[sha] is None:
+                    raise KVError("ERR no emulation registered for this script")
+            script = self._scripts.get(sha)
+            if script is None:
+                raise KVError("NOSCRIPT No matching script. Please use EVAL.")
+            n = int(args[1])
+            return script(lambda *a: self._run([str(x) for x in a]), args[2:2 + n], args[2 + n:])
+        raise KVError(f"ERR unknown command '{op}'")
+
+
+class _ZSet(dict):
+    """Sorted set: member -> score."""
+
+    def ranked(self):
+        return sorted(self, key=lambda m: (self[m], m))
+
+
+def _list_slice(length, start, stop):
+    """LRANGE/LTRIM indexes (inclusive, negatives from the end) as a slice."""
+    start, stop = int(start), int(stop)
+    if start < 0:
+        start = max(0, length + start)
+    if stop < 0:
+        stop = length + stop
+    return slice(start, stop + 1)
+
+
+def _load():
+    rest_url = os.environ.get("KV_REST_API_URL", "") or os.environ.get("UPSTASH_REDIS_REST_URL", "")
+    rest_token = os.environ.get("KV_REST_API_TOKEN", "") or os.environ.get("UPSTASH_REDIS_REST_TOKEN", "")
+    redis_url = os.environ.get("REDIS_URL", "")
+    kind = os.environ.get("KV_BACKEND", "").strip().lower()
+    if not kind:
+        kind = "redis" if redis_url and not rest_url else "upstash"
+    if kind == "memory":
+        return Memory()
+    if kind == "redis":
+        return Redis(redis_url or "redis://localhost:6379")
+    if kind == "upstash":
+        return Upstash(rest_url, rest_token)
+    raise ValueError(f"unknown KV_BACKEND: {kind}")
+
+
+BACKEND = _load()
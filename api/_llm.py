@@ -0,0 +1,140 @@
+"""OpenAI-compatible chat backends, and how each is doing in this instance.
+
+LLM_BACKENDS is a JSON list of backends:
+
+    [{"name": "deepseek", "url": "https://api.deepseek.com/chat/completions",
+      "model": "deepseek-chat", "key_env": "DEEPSEEK_API_KEY"},
+     {"name": "fireworks", "url": "https://api.fireworks.ai/inference/v1/chat/completions",
+      "model": "accounts/fireworks/models/deepseek-v3", "key_env": "FIREWORKS_API_KEY",
+      "roles": ["opponent"]}]
+
+"roles" limits a backend to some callers ("referee", "opponent", "looks"), and
+"json": false leaves out response_format for servers without JSON mode.
+Without LLM_BACKENDS, DeepSeek is the only backend.
+
+Latency and failures are tracked per backend at module scope, so a warm
+instance routes around a provider that is down or crawling: a backend
+that fails or is slow BREAKER_FAILURES times in a row is skipped for
+BREAKER_COOLDOWN seconds, then gets a trial call.
+"""
+
+import collections
+import json
+import os
+import threading
+import time
+
+BREAKER_FAILURES = int(os.environ.get("LLM_BREAKER_FAILURES", "3"))
+BREAKER_COOLDOWN = float(os.environ.get("LLM_BREAKER_COOLDOWN", "30"))
+# A reply slower than this counts against its backend even though it arrived
+SLOW_AFTER = float(os.environ.get("LLM_SLOW_AFTER", "30"))
+
+# Hedge after HEDGE_AFTER seconds until a backend has HEDGE_MIN_SAMPLES replies
+HEDGE_AFTER = float(os.environ.get("LLM_HEDGE_AFTER", "20"))
+HEDGE_MIN_SAMPLES = 20
+HEDGE_WINDOW = 200
+
+
+class Backend:
+    def __init__(self, name, url, model, key_env, roles=None, json=True):
+        self.name = name
+        self.url = url
+        self.model = model
+        self.key_env = key_env
+        self.roles = roles or []
+        self.json = json
+        self._latencies = {}
+        self._failures = 0
+        self._opened = None
+        self._lock = threading.Lock()
+
+    @property
+    def api_key(self):
+        return os.environ.get(self.key_env, "")
+
+    def serves(self, role):
+        return not self.roles or role in self.roles
+
+    def available(self, now=None):
+        """Breaker closed, or open long enough to let a trial call through."""
+        return self._opened is None or (now or time.time()) - self._opened >= BREAKER_COOLDOWN
+
+    def percentile(self, key, p):
+        """p-th percentile of recent latencies for ``key``, or None with too few."""
+        with self._lock:
+            samples = sorted(self._latencies.get(key, ()))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, len(samples) * p // 100)]
+
+    def hedge_delay(self, key):
+        p95 = self.percentile(key, 95)
+        return HEDGE_AFTER if p95 is None else p95
+
+    def succeeded(self, key, seconds):
+        with self._lock:
+            self._latencies.setdefault(key, collections.deque(maxlen=HEDGE_WINDOW)).append(seconds)
+            if seconds >= SLOW_AFTER:
+                self._bad()
+            else:
+                self._failures = 0
+                self._opened = None
+
+    def failed(self):
+        """An error, or a call so slow that a copy elsewhere beat it."""
+        with self._lock:
+            self._bad()
+
+    def _bad(self):
+        self._failures += 1
+        if self._failures >= BREAKER_FAILURES or self._opened is not None:
+            self._opened = time.time()  # a failed trial call restarts the cooldown
+
+    def status(self):
+        return {
+            "name": self.name,
+            "open": not self.available(),
+            "failures": self._failures,
+            "p50_ms": {f"{role}{' (stream)' if streamed else ''}": round(p50 * 1000)
+                       for (role, streamed) in list(self._latencies)
+                       for p50 in [self.percentile((role, streamed), 50)] if p50 is not None},
+        }
+
+
+def _load():
+    raw = os.environ.get("LLM_BACKENDS", "").strip()
+    if raw:
+        return [Backend(**spec) for spec in json.loads(raw)]
+    return [Backend(
+        "deepseek",
+        os.environ.get("DEEPSEEK_API_URL", "https://api.deepseek.com/chat/completions"),
+        os.environ.get("DEEPSEEK_MODEL", "deepseek-chat"),
+        "DEEPSEEK_API_KEY",
+    )]
+
+
+BACKENDS = _load()
+
+
+def route(role, streamed):
+    """Backends for ``role`` with a key configured, best first.
+
+    Healthy backends come first, fastest median latency leading; ones
+    without enough samples yet rank as fastest so they get measured. Open
+    breakers go last rather than away, so a call is always attempted.
+    """
+    key = (role, streamed)
+    now = time.time()
+    ranked = []
+    for index, backend in enumerate(BACKENDS):
+        if backend.serves(role) and backend.api_key:
+            p50 = backend.percentile(key, 50)
+            ranked.append((not backend.available(now), p50 or 0, index, backend))
+    if not ranked:
+        raise Exception("API key not configured")
+    ranked.sort(key=lambda r: r[:3])
+    return [r[3] for r in ranked]
+
+
+def status():
+    return [backend.status() for backend in BACKENDS]
@@ -1,22 +1,44 @@
 """Shared utilities for NO RULEZ API endpoints."""
 
+import base64
+import binascii
+import collections
+import hashlib
+import hmac
+import itertools
 import json
+import math
 import os
+import queue
 import re
+import threading
 import time
 import random
-import urllib.request
-import urllib.error
+from urllib.parse import urlparse
+
+import _blob
+import _http
+import _kv
+import _llm
+import _trace
 
-DEEPSEEK_API_URL = "https://api.deepseek.com/chat/completions"
-DEEPSEEK_MODEL = "deepseek-chat"
 MAX_ACTION = 200
 MAX_NAME = 30
-
-KV_URL = os.environ.get("KV_REST_API_URL", "") or os.environ.get("UPSTASH_REDIS_REST_URL", "")
-KV_TOKEN = os.environ.get("KV_REST_API_TOKEN", "") or os.environ.get("UPSTASH_REDIS_REST_TOKEN", "")
-
-REFEREE_PROMPT = r"""You are the referee, narrator, and artist for NO RULEZ, a turn-based two-player battle game where ANYTHING GOES. Players describe actions in plain English — there are no rules, no move lists, no restrictions. Your job is to resolve every action fairly, dramatically, and entertainingly.
+# "json" asks DeepSeek for a JSON object; "sections" uses the ===MARKER=== format
+REFEREE_FORMAT = os.environ.get("REFEREE_FORMAT", "json")
+
+# Time a request may spend on the LLM, well inside the function's maxDuration
+REQUEST_BUDGET = float(os.environ.get("REQUEST_BUDGET", "55"))
+# Upstream requests per LLM call, counting hedges and retries
+LLM_MAX_ATTEMPTS = int(os.environ.get("LLM_MAX_ATTEMPTS", "3"))
+# Time /api/looks may spend inventing the fighters' looks; past it the first turn does
+LOOKS_BUDGET = float(os.environ.get("LOOKS_BUDGET", "8"))
+MAX_LOOK = 300
+
+# The referee prompt comes in two output formats that share everything else:
+# marker-delimited sections (parse_response) and a JSON object for DeepSeek's
+# JSON output mode (parse_json_reply).
+_REFEREE_RULES = r"""You are the referee, narrator, and artist for NO RULEZ, a turn-based two-player battle game where ANYTHING GOES. Players describe actions in plain English — there are no rules, no move lists, no restrictions. Your job is to resolve every action fairly, dramatically, and entertainingly.
 
 CORE PRINCIPLES:
 - FAIRNESS above all. No single action should instantly kill an opponent. Even the most devastating attack should leave room for a response. Damage scales with creativity, not just destructive intent.
@@ -28,7 +50,9 @@ CORE PRINCIPLES:
 - NO REPEAT BONUS. If a player uses the same attack or a very similar attack as a previous turn, it should do LESS damage, not more. The referee should call it out ("Same trick again? The arena yawns.") and reduce damage by at least half. Creativity is rewarded, repetition is punished. A player spamming the same move should see diminishing returns every time.
 - STATE DECAY. The battlefield should feel FRESH each turn, not like a cluttered junkyard. After big events (nukes, supernovas, etc.), the aftermath settles quickly. Craters fill in, radiation fades, wreckage gets cleared by the arena itself. Only keep details that are ACTIVELY RELEVANT to the current moment. The situation field should be 1 short sentence about what matters RIGHT NOW, not a history of everything that ever happened. Think of it like a movie — the camera moves on.
 
-YOU MUST RESPOND IN EXACTLY THIS FORMAT (use these exact markers on their own line):
+"""
+
+_REFEREE_SECTIONS_FORMAT = r"""YOU MUST RESPOND IN EXACTLY THIS FORMAT (use these exact markers on their own line):
 
 ===NARRATIVE===
 1-2 sentences MAX. Punchy, funny, dramatic. No filler. Address players by name.
@@ -48,7 +72,25 @@ CRITICAL RULES FOR YOUR RESPONSE:
 - Never break character. You ARE the referee. This is YOUR arena.
 - Do NOT wrap the ASCII art in markdown code fences (no ``` blocks). Output the art as raw text.
 
-IMAGE GENERATION RULES:
+"""
+
+_REFEREE_JSON_FORMAT = r"""YOU MUST RESPOND WITH ONE JSON OBJECT AND NOTHING ELSE, using exactly these keys in this order:
+
+{"narrative": "<1-2 sentences MAX. Punchy, funny, dramatic. No filler. Address players by name.>", "state": {"p1_hp": <int>, "p2_hp": <int>, "situation": "<one short sentence: what matters right now>", "last_action": "<what just happened in one sentence>", "image_safe": <true or false>, "image_prompt": "<visual scene description for AI image generation, or empty string>", "p1_look": "<character 1 visual appearance — invent on first turn, then keep unchanged>", "p2_look": "<character 2 visual appearance — invent on first turn, then keep unchanged>"}, "scene": "<ASCII art scene>"}
+
+The "scene" is the FALLBACK when images can't be generated. If image_safe is true, you can keep it minimal (4-6 lines) since a real image will replace it. If image_safe is false, go all out: 8-12 lines tall, up to 50 characters wide, show both players and the action with detail.
+
+CRITICAL RULES FOR YOUR RESPONSE:
+- Output ONLY the JSON object. No markdown code fences, nothing before or after it.
+- Write line breaks in "scene" as \n and escape backslashes and double quotes, so the JSON stays valid.
+- HP values must be integers between 0 and 100.
+- The "situation" field must be ONE short sentence. Not a paragraph. Not a list. Just the key thing happening right now.
+- If a player reaches 0 HP, set their HP to 0 and make the narrative describe their defeat dramatically.
+- Never break character. You ARE the referee. This is YOUR arena.
+
+"""
+
+_REFEREE_IMAGE_RULES = r"""IMAGE GENERATION RULES:
 - "image_safe" must be true or false. Set to true if the scene can be illustrated as a fun, dramatic, creative battle image. Set to false if the scene involves graphic gore, nudity, sexually explicit content, or extreme real-world violence.
 - If image_safe is false, set image_prompt to an empty string "".
 - The image prompt should NOT include text/words/letters to render — image generators can't spell. Describe visuals only.
@@ -67,14 +109,54 @@ CHARACTER APPEARANCE RULES:
 - On ALL SUBSEQUENT TURNS, copy the EXACT p1_look and p2_look values from the game state into your response unchanged. Never modify them.
 - Use these appearance descriptions in every image_prompt so the image generator draws the same characters each time."""
 
+REFEREE_PROMPT = _REFEREE_RULES + _REFEREE_SECTIONS_FORMAT + _REFEREE_IMAGE_RULES
+REFEREE_JSON_PROMPT = (_REFEREE_RULES + _REFEREE_JSON_FORMAT
+                       + _REFEREE_IMAGE_RULES.replace("===STATE=== JSON", '"state" object'))
+
+AI_OPPONENT_PROMPT = r"""You are BRAWLBOT, a chaotic crown-wearing robot combatant in NO RULEZ — a battle game where ANYTHING GOES. You are creative, unpredictable, and you MATCH YOUR OPPONENT'S ENERGY while always bringing your own original moves.
+
+YOUR CORE TRAIT — STYLE MATCHING:
+- READ the battlefield and your opponent's vibe, then MATCH IT while one-upping them.
+- If they're going Minecraft/gaming → you pull from gaming lore but with YOUR twist. Reference specific games, glitches, speedrun strats.
+- If they're going historical/medieval → you come back with historically accurate but absurd references. "I summon Napoleon's actual tactical genius but he's 5'6 and FURIOUS about it"
+- If they're going sci-fi → you go harder sci-fi. Dyson spheres, von Neumann probes, quantum nonsense.
+- If they're being vulgar and funny → you get FILTHY. No filter. Roast them while attacking.
+- If they're being serious/tactical → you respect it with genuinely clever counter-strategy.
+- If they're going absurdist/random → you out-random them with something even more unhinged.
+- ALWAYS escalate the tone. If they're at a 7, you're at an 8. Keep pace, stay one step ahead.
 
-def call_deepseek(system_prompt, user_prompt, max_tokens=1000):
-    api_key = os.environ.get("DEEPSEEK_API_KEY", "")
-    if not api_key:
-        raise Exception("API key not configured")
+YOUR PERSONALITY:
+- You come up with your OWN attacks. You don't just counter what they did — you bring a completely original move that fits the current vibe.
+- You trash talk naturally within whatever genre you're in. Medieval? Old English insults. Sci-fi? Mock their inferior technology. Vulgar? Go full drill sergeant.
+- You're cocky but creative. Every move is a flex AND a genuine threat.
+- You NEVER repeat yourself. Every turn is a completely new flavor.
+- If you're losing, you get MORE creative and MORE desperate — pull out crazier shit.
+- If you're winning, you showboat in whatever style fits the moment.
+- You have deep knowledge of history, science, games, memes, movies — use whatever fits.
 
+ABSOLUTE BANS — NEVER DO THESE:
+- NEVER "redirect," "absorb," "channel," "reverse," or "teleport" the opponent's attack back at them. This is LAZY and BORING.
+- NEVER use the opponent's move as fuel/energy/ammo for your own. That's just reflecting with extra steps.
+- NEVER reference or build on what the opponent just did. Your move should be COMPLETELY INDEPENDENT — as if you didn't even see their attack.
+- If they fire horse cocks, you DON'T do anything with horse cocks. You summon something ENTIRELY DIFFERENT.
+
+RULES FOR YOUR RESPONSE:
+- Respond with ONLY your action. One or two sentences max.
+- Your move must be 100% YOUR OWN IDEA. Completely unrelated to what the opponent just did.
+- Think of it like this: you're both attacking simultaneously. You don't know what they did.
+- NO commentary, NO explanations, NO quotation marks. Just the raw action."""
+
+LOOKS_PROMPT = r"""You are the costume designer for NO RULEZ, a battle game where ANYTHING GOES. Two fighters are about to meet in the arena. INVENT a distinctive visual appearance for each one based on their name. Be specific: body type, outfit, colors, hair, distinguishing features. Make them look like fun indie game characters — exaggerated, cartoonish, memorable. The two should look VERY different from each other.
+
+Each look is ONE sentence of visuals only: no names, no backstory, no text or letters to render.
+
+RESPOND WITH ONE JSON OBJECT AND NOTHING ELSE:
+{"p1_look": "<player 1's visual appearance>", "p2_look": "<player 2's visual appearance>"}"""
+
+
+def _chat_body(backend, system_prompt, user_prompt, max_tokens, stream=False, json_mode=False):
     body = {
-        "model": DEEPSEEK_MODEL,
+        "model": backend.model,
         "messages": [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_prompt},
@@ -82,18 +164,251 @@ def call_deepseek(system_prompt, user_prompt, max_tokens=1000):
         "temperature": 1.0,
         "max_tokens": max_tokens,
     }
-    req = urllib.request.Request(
-        DEEPSEEK_API_URL,
-        data=json.dumps(body).encode("utf-8"),
-        headers={
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}",
-        },
-        method="POST",
-    )
-    with urllib.request.urlopen(req, timeout=120) as resp:
-        result = json.loads(resp.read().decode("utf-8"))
-        return result["choices"][0]["message"]["content"].strip()
+    if stream:
+        body["stream"] = True
+        body["stream_options"] = {"include_usage": True}
+    if json_mode and backend.json:
+        body["response_format"] = {"type": "json_object"}
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {backend.api_key}",
+    }
+    return json.dumps(body).encode("utf-8"), headers
+
+
+class DeadlineExceeded(Exception):
+    """The request's time budget ran out before the LLM answered."""
+
+
+def request_deadline():
+    """Absolute deadline for the LLM calls of a request starting now."""
+    return time.time() + REQUEST_BUDGET
+
+
+def _timeout(deadline):
+    """Socket timeout for an upstream call; None leaves _http's default."""
+    if deadline is None:
+        return None
+    left = deadline - time.time()
+    if left <= 0:
+        raise DeadlineExceeded("The referee ran out of time")
+    return left
+
+
+def _retryable(error):
+    if isinstance(error, _http.HTTPStatusError):
+        return error.status == 429 or error.status >= 500
+    return not isinstance(error, DeadlineExceeded)
+
+
+def _hedged(attempt, backends, key, deadline, stats, discard=None):
+    """Run ``attempt(cancel, backend)`` until one copy succeeds; the first answer wins.
+
+    Copies go to ``backends`` in turn. Another copy starts each time the
+    newest one has been running longer than the first backend's p95 latency
+    for ``key``. Failed attempts are retried while the deadline allows, up
+    to LLM_MAX_ATTEMPTS copies in all. Copies still running when the call
+    returns are cancelled, and a late success from one of them is passed to
+    ``discard``. Every backend hears how its copy did; hedges, retries and
+    the winning backend's name go in ``stats``.
+    """
+    results = queue.Queue()
+    running = {}
+    lock = threading.Lock()
+    done = [False]
+    launched = 0
+    won_at = None
+
+    def run(cancel, backend):
+        try:
+            outcome = (cancel, True, attempt(cancel, backend))
+        except Exception as e:
+            outcome = (cancel, False, e)
+        with lock:
+            if not done[0]:
+                results.put(outcome)
+                return
+        if outcome[1] and discard:
+            discard(outcome[2])
+
+    def launch():
+        nonlocal launched
+        backend = backends[launched % len(backends)]
+        launched += 1
+        cancel = _http.Cancel()
+        running[cancel] = (backend, time.time())
+        threading.Thread(target=run, args=(cancel, backend), daemon=True).start()
+
+    hedge_delay = backends[0].hedge_delay(key)
+    launch()
+    hedge_at = time.time() + hedge_delay
+    try:
+        while True:
+            waits = [t - time.time() for t in (hedge_at, deadline) if t is not None]
+            try:
+                cancel, ok, value = results.get(timeout=max(0, min(waits)) if waits else None)
+            except queue.Empty:
+                if deadline is not None and time.time() >= deadline:
+                    raise DeadlineExceeded("The referee ran out of time")
+                if hedge_at is not None and time.time() >= hedge_at:
+                    hedge_at = None
+                    if launched < LLM_MAX_ATTEMPTS:
+                        launch()
+                        stats["hedges"] += 1
+                        hedge_at = time.time() + hedge_delay
+                continue
+
+            backend, started = running.pop(cancel)
+            if ok:
+                won_at = started
+                backend.succeeded(key, time.time() - started)
+                stats["backend"] = backend.name
+                return value
+            if not _retryable(value):
+                raise value
+            backend.failed()
+            if launched >= LLM_MAX_ATTEMPTS:
+                if running:
+                    continue  # another copy may still come through
+                raise value
+            if not running:
+                backoff = min(0.5 * 2 ** stats["retries"], 4)
+                if deadline is not None and time.time() + backoff >= deadline:
+                    raise value
+                time.sleep(backoff)
+            # With a copy still running (most likely the slow one that got
+            # hedged) the failed copy is replaced straight away
+            launch()
+            stats["retries"] += 1
+            hedge_at = time.time() + hedge_delay
+    finally:
+        with lock:
+            done[0] = True
+            leftovers = []
+            while not results.empty():
+                leftovers.append(results.get_nowait())
+        for cancel, (backend, started) in running.items():
+            cancel.cancel()
+            if won_at is not None and started < won_at:
+                backend.failed()  # a copy sent after it answered first
+        for _, ok, value in leftovers:
+            if ok and discard:
+                discard(value)
+
+
+def _note_usage(usage, role, started, reply_usage=None, first_token=None, error=False, stats=None):
+    """Append one call's token counts and timings to the caller's ``usage`` list."""
+    if usage is None:
+        return
+    reply_usage = reply_usage or {}
+    stats = stats or {}
+    entry = {
+        "role": role,
+        "backend": stats.get("backend") or "none",
+        "calls": 1,
+        "errors": 1 if error else 0,
+        "hedges": stats.get("hedges", 0),
+        "retries": stats.get("retries", 0),
+        "prompt_tokens": reply_usage.get("prompt_tokens", 0),
+        "cache_hit_tokens": reply_usage.get("prompt_cache_hit_tokens", 0),
+        "cache_miss_tokens": reply_usage.get("prompt_cache_miss_tokens", 0),
+        "completion_tokens": reply_usage.get("completion_tokens", 0),
+        "latency_ms": int((time.time() - started) * 1000),
+    }
+    if first_token is not None:
+        entry["streamed"] = 1
+        entry["ttft_ms"] = int((first_token - started) * 1000)
+    usage.append(entry)
+
+
+def call_llm(system_prompt, user_prompt, max_tokens=1000, usage=None, role="llm", json_mode=False,
+             deadline=None):
+    """Return the completion text from the best backend for ``role`` (see _llm).
+
+    Slow calls are hedged and failed ones retried, on the next backend when
+    there is one, all within ``deadline`` (a time.time() value). Token
+    counts and latency are appended to ``usage`` when a list is given.
+    """
+    backends = _llm.route(role, False)
+
+    def attempt(cancel, backend):
+        body, headers = _chat_body(backend, system_prompt, user_prompt, max_tokens, json_mode=json_mode)
+        result = json.loads(_http.request("POST", backend.url, body, headers,
+                                          timeout=_timeout(deadline), cancel=cancel))
+        result["choices"][0]["message"]["content"]  # a malformed reply is worth a retry
+        return result
+
+    started = time.time()
+    stats = {"hedges": 0, "retries": 0}
+    try:
+        with _trace.phase("llm"):
+            result = _hedged(attempt, backends, (role, False), deadline, stats)
+    except Exception:
+        _note_usage(usage, role, started, error=True, stats=stats)
+        raise
+    _note_usage(usage, role, started, result.get("usage"), stats=stats)
+    return result["choices"][0]["message"]["content"].strip()
+
+
+def _stream_deltas(lines, reply, deadline):
+    for raw in lines:
+        if deadline is not None and time.time() > deadline:
+            raise DeadlineExceeded("The referee ran out of time")
+        line = raw.decode("utf-8").strip()
+        if not line.startswith("data:"):
+            continue  # blank separators and ": keep-alive" comments
+        payload = line[5:].strip()
+        if payload == "[DONE]":
+            continue  # drain to the end so the connection can be reused
+        chunk = json.loads(payload)
+        # include_usage puts the totals on a last chunk with no choices
+        reply["usage"] = chunk.get("usage") or reply.get("usage")
+        choices = chunk.get("choices") or []
+        if choices:
+            delta = choices[0].get("delta", {}).get("content")
+            if delta:
+                yield delta
+
+
+def stream_llm(system_prompt, user_prompt, max_tokens=1000, usage=None, role="llm", json_mode=False,
+               deadline=None):
+    """Yield content deltas of a streamed completion as they arrive.
+
+    Routing, hedging and retries (see call_llm) apply up to the first
+    token; after that the stream is committed to.
+    """
+    backends = _llm.route(role, True)
+
+    def attempt(cancel, backend):
+        reply = {}
+        body, headers = _chat_body(backend, system_prompt, user_prompt, max_tokens,
+                                   stream=True, json_mode=json_mode)
+        lines = _http.stream_lines("POST", backend.url, body, headers,
+                                   timeout=_timeout(deadline), cancel=cancel)
+        deltas = _stream_deltas(lines, reply, deadline)
+        return next(deltas, None), deltas, reply
+
+    started = time.time()
+    stats = {"hedges": 0, "retries": 0}
+    try:
+        first, deltas, reply = _hedged(attempt, backends, (role, True), deadline, stats,
+                                       discard=lambda winner: winner[1].close())
+    except Exception:
+        _note_usage(usage, role, started, error=True, stats=stats)
+        raise
+    first_token = time.time()
+    try:
+        if first is not None:
+            yield first
+        yield from deltas
+    except Exception:
+        _note_usage(usage, role, started, reply.get("usage"), first_token, error=True, stats=stats)
+        raise
+    finally:
+        deltas.close()
+        # Includes whatever the caller did between chunks
+        _trace.add("llm", time.time() - started)
+    _note_usage(usage, role, started, reply.get("usage"), first_token, stats=stats)
 
 
 def parse_response(response):
@@ -113,11 +428,7 @@ def parse_response(response):
 
     narrative = sections["NARRATIVE"].strip()
 
-    scene = sections["SCENE"].strip()
-    if scene.startswith("```"):
-        lines = scene.split("\n")
-        lines = [l for l in lines if not l.strip().startswith("```")]
-        scene = "\n".join(lines)
+    scene = _strip_fences(sections["SCENE"].strip())
 
     state_str = sections["STATE"].strip()
     state_update = None
@@ -142,9 +453,243 @@ def parse_response(response):
             except json.JSONDecodeError:
                 pass
 
+    if state_update is not None and not narrative and response.lstrip().startswith(("{", "`")):
+        # Broken JSON-mode reply: salvage the string fields too
+        narrative = _json_string_field(response, "narrative")
+        scene = _strip_fences(_json_string_field(response, "scene"))
+
     return narrative, scene, state_update
 
 
+def _strip_fences(text):
+    if text.startswith("```"):
+        lines = text.split("\n")
+        lines = [l for l in lines if not l.strip().startswith("```")]
+        text = "\n".join(lines)
+    return text
+
+
+def _json_string_field(text, key):
+    match = re.search(r'"%s"\s*:\s*"((?:[^"\\]|\\.)*)"' % key, text)
+    if not match:
+        return ""
+    try:
+        return json.loads(f'"{match.group(1)}"').strip()
+    except json.JSONDecodeError:
+        return ""
+
+
+def parse_json_reply(response):
+    """Parse a JSON-mode referee reply, checking its shape in the same pass.
+
+    Returns (narrative, scene, state_update), or None if the reply isn't a
+    JSON object with a narrative string and a state holding numeric HP.
+    """
+    text = response.strip()
+    if text.startswith("```"):
+        text = _strip_fences(text).strip()
+    if not text.startswith("{"):
+        # "Here is the result:" and similar chatter around the object
+        text = text[text.find("{"):text.rfind("}") + 1]
+    try:
+        reply = json.loads(text)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(reply, dict):
+        return None
+
+    narrative = reply.get("narrative")
+    scene = reply.get("scene", "")
+    state_update = reply.get("state")
+    if not isinstance(narrative, str) or not isinstance(scene, str) or not isinstance(state_update, dict):
+        return None
+    for key in ("p1_hp", "p2_hp"):
+        hp = state_update.get(key)
+        if isinstance(hp, str):
+            try:
+                hp = float(hp)
+            except ValueError:
+                return None
+        if isinstance(hp, bool) or not isinstance(hp, (int, float)) or not math.isfinite(hp):
+            return None
+        state_update[key] = int(round(hp))
+    return narrative.strip(), _strip_fences(scene.strip("\n")), state_update
+
+
+def parse_referee_reply(response):
+    """Parse a referee reply in either format; state_update is None on a fumble."""
+    if "===NARRATIVE===" not in response and "{" in response:
+        parsed = parse_json_reply(response)
+        if parsed is not None:
+            return parsed
+    return parse_response(response)
+
+
+class SectionStream:
+    """Incrementally split a streamed referee reply into its sections.
+
+    feed() returns any narrative text that arrived with the chunk so it can be
+    forwarded to the player right away. ``state`` is filled in as soon as the
+    STATE line closes. The full reply is kept in ``text`` for parse_response.
+    """
+
+    MARKERS = ("NARRATIVE", "SCENE", "STATE")
+
+    def __init__(self):
+        self.text = ""
+        self.section = None
+        self.state = None
+        self._line = ""
+        self._sent = 0  # chars of the current line already forwarded
+
+    def feed(self, chunk):
+        self.text += chunk
+        self._line += chunk
+        out = ""
+        while "\n" in self._line:
+            line, self._line = self._line.split("\n", 1)
+            out += self._close_line(line)
+            self._sent = 0
+        # Forward a partial narrative line unless it may turn into a marker
+        if self.section == "NARRATIVE" and not self._line.lstrip().startswith("="):
+            out += self._line[self._sent:]
+            self._sent = len(self._line)
+        elif self.section == "STATE" and self._line.rstrip().endswith("}"):
+            self._try_state(self._line)
+        return out
+
+    def finish(self):
+        out = self._close_line(self._line) if self._line else ""
+        self._line = ""
+        self._sent = 0
+        return out.rstrip("\n")
+
+    def _close_line(self, line):
+        stripped = line.strip()
+        for name in self.MARKERS:
+            if f"==={name}===" in stripped:
+                self.section = name
+                return ""
+        if self.section == "NARRATIVE":
+            return line[self._sent:] + "\n"
+        if self.section == "STATE":
+            self._try_state(line)
+        return ""
+
+    def _try_state(self, line):
+        stripped = line.strip()
+        if self.state is None and stripped.startswith("{"):
+            try:
+                self.state = json.loads(stripped)
+            except json.JSONDecodeError:
+                pass
+
+
+# A string escape cut off at the end of a chunk
+_PARTIAL_ESCAPE = re.compile(r'(?<!\\)(\\\\)*\\(u[0-9a-fA-F]{0,3})?$')
+
+
+class JsonReplyStream:
+    """Incrementally read a JSON-mode referee reply, like SectionStream.
+
+    feed() returns narrative text as the "narrative" string is generated, and
+    ``state`` is filled in as soon as the "state" object closes. Only the top
+    level of the object is tracked; everything else is skipped over.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.state = None
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._last = None  # last structural char seen at the top level
+        self._key = None
+        self._state_start = None
+        self._narrative_start = None
+        self._narrative_end = None
+        self._narrative_done = False
+        self._sent = ""
+
+    def feed(self, chunk):
+        self.text += chunk
+        text = self.text
+        for i in range(self._pos, len(text)):
+            c = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    self._close_string(i)
+            elif c == '"':
+                self._in_string = True
+                self._string_start = i
+                if self._depth == 1 and self._last == ":" and self._key == "narrative":
+                    self._narrative_start = i + 1
+            elif c in "{[":
+                self._depth += 1
+                if self._depth == 2 and self._last == ":" and self._key == "state":
+                    self._state_start = i
+                if self._depth == 1:
+                    self._last = c
+            elif c in "}]":
+                self._depth -= 1
+                if self._depth == 1 and self._state_start is not None:
+                    self._try_state(text[self._state_start:i + 1])
+                    self._state_start = None
+            elif c in ":," and self._depth == 1:
+                self._last = c
+        self._pos = len(text)
+        return self._narrative()
+
+    def finish(self):
+        return ""
+
+    def _close_string(self, end):
+        if self._depth != 1:
+            return
+        if self._last in ("{", ","):
+            try:
+                self._key = json.loads(self.text[self._string_start:end + 1])
+            except json.JSONDecodeError:
+                self._key = None
+        elif self._narrative_start is not None and self._narrative_end is None:
+            self._narrative_end = end
+        self._last = '"'
+
+    def _narrative(self):
+        if self._narrative_start is None or self._narrative_done:
+            return ""
+        closed = self._narrative_end is not None
+        raw = self.text[self._narrative_start:self._narrative_end if closed else len(self.text)]
+        if not closed:
+            raw = _PARTIAL_ESCAPE.sub("", raw)
+        try:
+            decoded = json.loads(f'"{raw}"')
+        except json.JSONDecodeError:
+            return ""
+        if not closed and decoded and "\ud800" <= decoded[-1] <= "\udbff":
+            decoded = decoded[:-1]  # the low half of this surrogate pair is still coming
+        out = decoded[len(self._sent):]
+        self._sent = decoded
+        self._narrative_done = closed
+        return out
+
+    def _try_state(self, raw):
+        if self.state is None:
+            try:
+                state = json.loads(raw)
+            except json.JSONDecodeError:
+                return
+            if isinstance(state, dict):
+                self.state = state
+
+
 def sanitize_name(name):
     return re.sub(r'[^a-zA-Z0-9 ]', '', name)[:MAX_NAME].strip() or "Player"
 
@@ -153,6 +698,10 @@ def sanitize_action(action):
     return re.sub(r'[\x00-\x1f\x7f]', '', action)[:MAX_ACTION].strip()
 
 
+def sanitize_request_id(request_id):
+    return re.sub(r'[^a-zA-Z0-9-]', '', request_id)[:64]
+
+
 def clamp_hp(old_p1, old_p2, state_update):
     """Clamp HP changes to valid ranges. Max 35 damage, max 10 heal, no attack+heal combo."""
     raw_p1 = state_update.get("p1_hp", old_p1)
@@ -187,19 +736,24 @@ def clamp_hp(old_p1, old_p2, state_update):
 
 
 def build_turn_prompt(state, player_name, player_num, action):
+    # Lines that stay the same for a whole game come first, so DeepSeek's
+    # prefix cache covers them along with the system prompt.
     p1_look = state.get('p1_look', '')
     p2_look = state.get('p2_look', '')
     char_lines = ""
     if p1_look or p2_look:
-        char_lines = f"\n- {state.get('p1_name', 'P1')} appearance: {p1_look}\n- {state.get('p2_name', 'P2')} appearance: {p2_look}"
+        char_lines = f"- {state.get('p1_name', 'P1')} appearance: {p1_look}\n- {state.get('p2_name', 'P2')} appearance: {p2_look}"
     else:
-        char_lines = "\n- Character appearances: Not yet established. You MUST invent distinctive looks for both characters on this turn and include them in p1_look and p2_look."
+        char_lines = "- Character appearances: Not yet established. You MUST invent distinctive looks for both characters on this turn and include them in p1_look and p2_look."
 
-    return f"""CURRENT GAME STATE:
+    return f"""FIGHTERS:
+{char_lines}
+
+CURRENT GAME STATE:
 - {state.get('p1_name', 'P1')} (Player 1): {state.get('p1_hp', 100)} HP
 - {state.get('p2_name', 'P2')} (Player 2): {state.get('p2_hp', 100)} HP
 - Battlefield: {state.get('situation', 'An open arena, untouched and waiting for chaos.')}
-- Last action: {state.get('last_action', 'None yet. This is the first move!')}{char_lines}
+- Last action: {state.get('last_action', 'None yet. This is the first move!')}
 
 NOW ACTING: {player_name} (Player {player_num})
 ACTION: {action}
@@ -209,90 +763,1487 @@ Resolve this action. Remember: reward creativity, keep it fair, be dramatic.
 IMPORTANT: The HP values above are EXACT. Your returned p1_hp and p2_hp must reflect damage/healing applied to THESE values. Typical damage is 5-25 HP. Do NOT reset or randomly assign HP — calculate from the current values."""
 
 
+def build_opponent_prompt(state, ai_name, player_num):
+    opponent_num = 1 if player_num == 2 else 2
+    opponent_name = state.get(f"p{opponent_num}_name", "Opponent")
+    my_hp = state.get(f"p{player_num}_hp", 100)
+    their_hp = state.get(f"p{opponent_num}_hp", 100)
+
+    return f"""CURRENT STATE:
+- You are {ai_name} ({my_hp} HP)
+- Your opponent is {opponent_name} ({their_hp} HP)
+- Battlefield: {state.get('situation', 'An open arena.')}
+- Last thing that happened: {state.get('last_action', 'Nothing yet. You go first!')}
+
+What do you do?"""
+
+
+def opponent_action(state, ai_name, player_num, usage=None, deadline=None):
+    """Ask BRAWLBOT for its next move as player ``player_num``."""
+    result = call_llm(AI_OPPONENT_PROMPT, build_opponent_prompt(state, ai_name, player_num),
+                      max_tokens=150, usage=usage, role="opponent", deadline=deadline)
+    return result.strip('"\'') if result else "I throw a rock"
+
+
+def build_looks_prompt(p1_name, p2_name):
+    return f"""FIGHTERS:
+- Player 1: {p1_name}
+- Player 2: {p2_name}"""
+
+
+def parse_looks_reply(response):
+    """{"p1_look", "p2_look"} from a looks reply, or None unless both are there."""
+    text = _strip_fences(response.strip()).strip()
+    try:
+        reply = json.loads(text[text.find("{"):text.rfind("}") + 1])
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(reply, dict):
+        return None
+    looks = {}
+    for key in ("p1_look", "p2_look"):
+        look = reply.get(key)
+        if not isinstance(look, str) or not look.strip():
+            return None
+        looks[key] = look.strip()[:MAX_LOOK]
+    return looks
+
+
+def invent_looks(p1_name, p2_name, usage=None, deadline=None):
+    """Ask for both fighters' appearances up front; None if the reply had no usable pair."""
+    response = call_llm(LOOKS_PROMPT, build_looks_prompt(p1_name, p2_name), max_tokens=200,
+                        usage=usage, role="looks", json_mode=True, deadline=deadline)
+    with _trace.phase("parse"):
+        return parse_looks_reply(response)
+
+
+def add_looks(game, usage=None):
+    """Give a game that just got its second player both fighters' looks.
+
+    Runs from /api/looks while the first player is still typing, so turn
+    one's referee call copies the looks instead of inventing them and its
+    image already shows the characters the rest of the game will. Only the
+    first call for a game tries. Best effort: if the LLM pool is busy, the
+    call fails or runs past LOOKS_BUDGET, or the first turn lands first,
+    ``game`` comes back as it was and the referee invents the looks on turn
+    one as before.
+    """
+    if game.get("status") != "active" or game.get("p1_look") or game.get("turn", 1) != 1:
+        return game
+    if kv_command("SET", f"looks:{game['code']}", 1, "NX", "EX", GAME_TTL) != "OK":
+        return game
+    lease, _ = admit_looks()
+    if lease is None:
+        return game
+    try:
+        looks = invent_looks(game.get("p1_name") or "Player 1", game.get("p2_name") or "Player 2",
+                             usage=usage, deadline=time.time() + LOOKS_BUDGET)
+    except Exception:
+        looks = None
+    finally:
+        release(LLM_POOL, lease)
+    if looks is None:
+        return game
+    try:
+        saved = update_game(dict(game), looks, lambda g: g.get("turn", 1) == 1 and not g.get("p1_look"))
+    except Exception:
+        saved = None
+    return saved or game
+
+
+class RefereeFumbled(Exception):
+    """The referee reply had no usable STATE block."""
+
+
+def referee_state(p1_hp, p2_hp, state_update):
+    new_p1, new_p2 = clamp_hp(p1_hp, p2_hp, state_update)
+    return {
+        "p1_hp": new_p1,
+        "p2_hp": new_p2,
+        "situation": state_update.get("situation", ""),
+        "last_action": state_update.get("last_action", ""),
+        "image_safe": state_update.get("image_safe", False),
+        "image_prompt": state_update.get("image_prompt", ""),
+        "p1_look": state_update.get("p1_look", ""),
+        "p2_look": state_update.get("p2_look", ""),
+    }
+
+
+def referee_turn(state, player_name, player_num, action, on_event=None, usage=None, deadline=None):
+    """Resolve one action and return {"narrative", "scene", "state"}.
+
+    With ``on_event`` the completion is streamed: narrative text is reported
+    as ("narrative", {"text": ...}) while it is generated, and the clamped
+    state as ("state", {...}) as soon as the STATE block closes. LLM
+    usage is appended to ``usage`` when given. A reply that can't be parsed
+    is asked for again once if it wasn't streamed and ``deadline`` allows.
+    """
+    p1_hp = state.get("p1_hp", 100)
+    p2_hp = state.get("p2_hp", 100)
+    turn_prompt = build_turn_prompt(state, player_name, player_num, action)
+    json_mode = REFEREE_FORMAT == "json"
+    system_prompt = REFEREE_JSON_PROMPT if json_mode else REFEREE_PROMPT
+
+    if on_event is None:
+        for tries_left in (1, 0):
+            response = call_llm(system_prompt, turn_prompt, usage=usage, role="referee",
+                                json_mode=json_mode, deadline=deadline)
+            with _trace.phase("parse"):
+                narrative, scene, state_update = parse_referee_reply(response)
+            if state_update is not None or not tries_left:
+                break
+            typical = _llm.route("referee", False)[0].hedge_delay(("referee", False))
+            if deadline is not None and deadline - time.time() < typical:
+                break  # no time for another go
+    else:
+        stream = JsonReplyStream() if json_mode else SectionStream()
+        state_sent = False
+        chunks = stream_llm(system_prompt, turn_prompt, usage=usage, role="referee",
+                            json_mode=json_mode, deadline=deadline)
+        for chunk in itertools.chain(chunks, [None]):
+            text = stream.feed(chunk) if chunk is not None else stream.finish()
+            if text:
+                on_event("narrative", {"text": text})
+            if stream.state is not None and not state_sent:
+                on_event("state", referee_state(p1_hp, p2_hp, stream.state))
+                state_sent = True
+        with _trace.phase("parse"):
+            narrative, scene, state_update = parse_referee_reply(stream.text.strip())
+
+    if state_update is None:
+        raise RefereeFumbled("Referee fumbled — could not parse response")
+
+    return {
+        "narrative": narrative,
+        "scene": scene,
+        "state": referee_state(p1_hp, p2_hp, state_update),
+    }
+
+
+# --- LLM usage stats ---
+
+LLM_STATS_TTL = 8 * 86400
+LLM_STATS_FIELDS = (
+    "calls", "errors", "hedges", "retries", "streamed", "prompt_tokens", "cache_hit_tokens",
+    "cache_miss_tokens", "completion_tokens", "latency_ms", "ttft_ms",
+)
+
+
+def llm_stats_key(day):
+    return f"llmstats:{day}"
+
+
+def record_llm_usage(endpoint, usage):
+    """Add a request's LLM usage to today's per-endpoint counters.
+
+    Counters live in one hash per UTC day, as "<endpoint>/<role>/<backend>:<field>",
+    and go out with the request's other stats when it ends (_trace.count).
+    """
+    if not usage:
+        return
+    key = llm_stats_key(time.strftime("%Y%m%d", time.gmtime()))
+    entries = usage[:]
+    del usage[:len(entries)]
+    for entry in entries:
+        for field in LLM_STATS_FIELDS:
+            if entry.get(field):
+                group = f"{endpoint}/{entry['role']}/{entry.get('backend', 'none')}"
+                _trace.count(key, f"{group}:{field}", int(entry[field]), LLM_STATS_TTL)
+
+
+def summarize_llm_stats(flat):
+    """Turn a stats hash into {"<endpoint>/<role>/<backend>": {field: total, ..., derived ratios}}."""
+    out = {}
+    for name, value in flat.items():
+        group, _, field = name.rpartition(":")
+        out.setdefault(group, dict.fromkeys(LLM_STATS_FIELDS, 0))[field] = int(value)
+    for row in out.values():
+        cached = row["cache_hit_tokens"] + row["cache_miss_tokens"]
+        row["cache_hit_ratio"] = round(row["cache_hit_tokens"] / cached, 3) if cached else None
+        row["avg_latency_ms"] = round(row["latency_ms"] / row["calls"]) if row["calls"] else None
+        row["avg_ttft_ms"] = round(row["ttft_ms"] / row["streamed"]) if row["streamed"] else None
+    return out
+
+
 # --- KV helpers ---
+#
+# Commands go to the backend picked in _kv (Upstash, Redis or memory).
 
 def kv_set(key, value, ex=None):
     cmd = ["SET", key, json.dumps(value)]
     if ex:
         cmd += ["EX", str(ex)]
-    body = json.dumps(cmd).encode()
-    req = urllib.request.Request(KV_URL, data=body, headers={
-        "Authorization": f"Bearer {KV_TOKEN}",
-        "Content-Type": "application/json"
-    })
-    with urllib.request.urlopen(req) as r:
-        return json.loads(r.read())
+    with _trace.phase("kv"):
+        return _kv.BACKEND.command(*cmd)
 
 
 def kv_get(key):
-    req = urllib.request.Request(f"{KV_URL}/GET/{key}", headers={
-        "Authorization": f"Bearer {KV_TOKEN}"
-    })
-    with urllib.request.urlopen(req) as r:
-        data = json.loads(r.read())
-        result = data.get("result")
-        if result:
-            return json.loads(result)
-        return None
+    with _trace.phase("kv"):
+        result = _kv.BACKEND.command("GET", key)
+    if result:
+        return json.loads(result)
+    return None
 
 
 def kv_del(key):
-    req = urllib.request.Request(f"{KV_URL}/DEL/{key}", headers={
-        "Authorization": f"Bearer {KV_TOKEN}"
-    })
-    with urllib.request.urlopen(req) as r:
-        return json.loads(r.read())
+    with _trace.phase("kv"):
+        return _kv.BACKEND.command("DEL", key)
+
+
+def kv_command(*args):
+    """Run one raw command and return its result."""
+    with _trace.phase("kv"):
+        return _kv.BACKEND.command(*args)
+
+
+def kv_eval(script, keys, args):
+    """Run a Lua script, by SHA when the server already has it cached."""
+    try:
+        return kv_command("EVALSHA", _kv.script_sha(script), len(keys), *keys, *args)
+    except _kv.KVError as e:
+        if "NOSCRIPT" not in str(e):
+            raise
+    return kv_command("EVAL", script, len(keys), *keys, *args)
+
+
+# KEYS: lock[, admission pool]
+# ARGV: token
+RELEASE_LOCK_SCRIPT = """
+local released = 0
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  released = redis.call('DEL', KEYS[1])
+end
+if KEYS[2] then redis.call('ZREM', KEYS[2], ARGV[1]) end
+return released
+"""
+
+
+@_kv.emulate(RELEASE_LOCK_SCRIPT)
+def _release_lock(call, keys, argv):
+    released = 0
+    if call("GET", keys[0]) == argv[0]:
+        released = call("DEL", keys[0])
+    if len(keys) > 1:
+        call("ZREM", keys[1], argv[0])
+    return released
+
+
+def kv_release_lock(key, token, pool=None):
+    """Drop a lease, but only if it is still ours (it may have expired).
+
+    With ``pool``, the admission lease under the same token (see
+    begin_turn) is given back in the same round trip.
+    """
+    kv_eval(RELEASE_LOCK_SCRIPT, [key] + ([pool] if pool else []), [token])
+
+
+def kv_mget(*keys):
+    """GET several keys in one round trip; missing keys come back as None."""
+    return [json.loads(v) if v else None for v in kv_command("MGET", *keys)]
+
+
+def kv_pipeline(commands):
+    """Run several commands in one round trip; returns their results in order."""
+    with _trace.phase("kv"):
+        return _kv.BACKEND.pipeline(commands)
 
 
-# Code generation for game codes
-SAFE_CHARS = "0123456789"
+def kv_subscribe(channel, timeout):
+    """Yield ("subscribe", None) once listening, then ("message", payload) per publish.
 
-def generate_code():
-    return "".join(random.choice(SAFE_CHARS) for _ in range(6))
+    Stops quietly once ``timeout`` seconds have passed.
+    """
+    return _kv.BACKEND.subscribe(channel, timeout)
 
 
+# --- Game storage ---
+#
+# A game lives in two keys: a small header (game:{code}) with everything
+# needed to tell whether anything changed and whose turn it is, and the
+# bulky per-turn content (game:{code}:body). Pollers only read the header
+# until its version moves.
+
+GAME_TTL = 3600
+LONG_POLL_MAX = 25
+POLL_BATCH_MAX = 100  # games per /api/poll_batch request
+PATCH_HISTORY = 8  # versions a poller may lag behind and still get a delta
+GAME_CACHE_SIZE = int(os.environ.get("GAME_CACHE_SIZE", "256"))  # games kept decoded per instance
+
+HEADER_FIELDS = (
+    "code", "gid", "p1_name", "p2_name", "p1_hp", "p2_hp", "turn", "current_player",
+    "status", "version", "last_updated",
+)
+
+
+def split_game(game):
+    header = {k: game[k] for k in HEADER_FIELDS if k in game}
+    body = {k: v for k, v in game.items() if k not in HEADER_FIELDS}
+    return header, body
+
+
+def merge_game(header, body):
+    game = dict(header)
+    for k, v in (body or {}).items():
+        game.setdefault(k, v)
+    return game
+
+
+def load_game_header(code):
+    return kv_get(f"game:{code}")
+
+
+def load_game_body(code):
+    return kv_get(f"game:{code}:body")
+
+
+def game_patch(prev, game):
+    """Field-level difference between two versions of a game."""
+    changed = {k: v for k, v in game.items() if k not in prev or prev[k] != v}
+    removed = [k for k in prev if k not in game]
+    return {"v": game["version"], "set": changed, "unset": removed}
+
+
+# What players and spectators may see; everything else (image job ids,
+# the webhook token, ...) stays on the stored game
+PUBLIC_FIELDS = (
+    "code", "gid", "p1_name", "p2_name", "p1_hp", "p2_hp", "turn", "current_player",
+    "status", "version", "last_updated", "situation", "last_action", "narrative",
+    "scene", "p1_look", "p2_look", "image_url", "image_status", "last_actor",
+    "last_actor_action",
+)
+
+
+def public_game(game):
+    """``game`` (or a patch's changed fields) with only PUBLIC_FIELDS."""
+    return {k: v for k, v in game.items() if k in PUBLIC_FIELDS}
+
+
+def load_game_patch(code, since, current):
+    """Combine the logged patches from ``since`` up to ``current``.
+
+    Returns (set, unset), or None if the log doesn't cover that range and
+    the poller needs a full snapshot instead.
+    """
+    behind = current - since
+    if behind <= 0 or behind > PATCH_HISTORY:
+        return None
+    entries = kv_command("LRANGE", f"game:{code}:log", 0, behind - 1) or []
+    patches = [json.loads(e) for e in reversed(entries)]
+    if [p.get("v") for p in patches] != list(range(since + 1, current + 1)):
+        return None
+
+    changed, removed = {}, set()
+    for p in patches:
+        for k, v in p["set"].items():
+            changed[k] = v
+            removed.discard(k)
+        for k in p["unset"]:
+            changed.pop(k, None)
+            removed.add(k)
+    return changed, sorted(removed)
+
+
+class GameCache:
+    """Decoded games from recent requests in this instance, least recently used evicted.
+
+    An entry is only used after its version and last_updated have been
+    checked against a header fresh from KV, so a stale game is never
+    served; a hit saves fetching and decoding the body. Callers get a
+    shallow copy and must not change nested values in place.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._games = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def version(self, code):
+        with self._lock:
+            game = self._games.get(code)
+            return None if game is None else game.get("version", 0)
+
+    def lookup(self, code, header):
+        """The cached game if it matches ``header``, else None."""
+        with self._lock:
+            game = self._games.get(code)
+            if (game is None or game.get("version") != header.get("version")
+                    or game.get("last_updated") != header.get("last_updated")):
+                self.misses += 1
+                return None
+            self._games.move_to_end(code)
+            self.hits += 1
+            return dict(game)
+
+    def store(self, game):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._games[game["code"]] = dict(game)
+            self._games.move_to_end(game["code"])
+            while len(self._games) > self.size:
+                self._games.popitem(last=False)
+
+    def status(self):
+        with self._lock:
+            looked = self.hits + self.misses
+            return {
+                "size": len(self._games),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / looked, 3) if looked else None,
+            }
+
+
+game_cache = GameCache(GAME_CACHE_SIZE)
+
+
+# KEYS: header, body
+# ARGV: version of the caller's cached copy ('' for none)
+# Returns {} if there's no game, {header} if the cached version is current,
+# else {header, body}.
+LOAD_GAME_SCRIPT = """
+local header = redis.call('GET', KEYS[1])
+if not header then return {} end
+if ARGV[1] ~= '' then
+  local ok, g = pcall(cjson.decode, header)
+  if ok and tostring(g['version'] or 0) == ARGV[1] then return {header} end
+end
+return {header, redis.call('GET', KEYS[2])}
+"""
+
+
+@_kv.emulate(LOAD_GAME_SCRIPT)
+def _load_game(call, keys, argv):
+    header = call("GET", keys[0])
+    if not header:
+        return []
+    if argv[0] != "":
+        try:
+            version = json.loads(header).get("version") or 0
+        except (ValueError, AttributeError):
+            version = None
+        if str(version) == argv[0]:
+            return [header]
+    return [header, call("GET", keys[1])]
+
+
+def cached_game(code, header):
+    """The full game for a header just read, from the cache or with one more read."""
+    game = game_cache.lookup(code, header)
+    if game is None:
+        game = merge_game(header, load_game_body(code))
+        game_cache.store(game)
+    return game
+
+
+def load_game(code):
+    """Return the full game (header + body) in one round trip, or None.
+
+    The body is only transferred when this instance has no current copy.
+    """
+    cached = game_cache.version(code)
+    reply = kv_eval(LOAD_GAME_SCRIPT, [f"game:{code}", f"game:{code}:body"],
+                    ["" if cached is None else cached])
+    return _loaded_game(code, reply) if reply else None
+
+
+def _loaded_game(code, reply):
+    """The game from a LOAD_GAME_SCRIPT reply of {header} or {header, body}."""
+    header = json.loads(reply[0])
+    game = game_cache.lookup(code, header)
+    if game is None:
+        if len(reply) == 1:
+            body = load_game_body(code)  # evicted in the meantime
+        else:
+            body = json.loads(reply[1]) if reply[1] else None
+        game = merge_game(header, body)
+        game_cache.store(game)
+    return game
+
+
+def load_games(seen, full=True):
+    """The games among ``seen`` (code -> last version seen, or None) that moved on.
+
+    Returns (changed, missing): code -> game for each game whose version
+    differs from the one seen (just its header unless ``full``), and the
+    codes with no game. All headers come in one MGET, then one more for
+    the bodies this instance has no current copy of.
+    """
+    codes = list(seen)
+    headers = kv_mget(*[f"game:{c}" for c in codes]) if codes else []
+    changed, missing = {}, []
+    for code, header in zip(codes, headers):
+        if header is None:
+            missing.append(code)
+        elif header.get("version") != seen[code]:
+            changed[code] = header
+    if not full:
+        return changed, missing
+
+    games = {code: game_cache.lookup(code, header) for code, header in changed.items()}
+    fetch = [code for code, game in games.items() if game is None]
+    if fetch:
+        for code, body in zip(fetch, kv_mget(*[f"game:{c}:body" for c in fetch])):
+            games[code] = merge_game(changed[code], body)
+            game_cache.store(games[code])
+    return games, missing
+
+
+# KEYS: header, body, patch log, [copy]
+# ARGV: header json, body json, ttl, expected version ('new': must not
+#       exist, '': any), channel, version,
+#       patch json ('' for none), history length, [full game json]
+SAVE_GAME_SCRIPT = """
+if ARGV[4] == 'new' then
+  if redis.call('GET', KEYS[1]) then return 0 end
+elseif ARGV[4] ~= '' then
+  local cur = redis.call('GET', KEYS[1])
+  if not cur then return 0 end
+  local ok, g = pcall(cjson.decode, cur)
+  if not ok or tostring(g['version'] or 0) ~= ARGV[4] then return 0 end
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[3])
+redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[3])
+if ARGV[7] ~= '' then
+  redis.call('LPUSH', KEYS[3], ARGV[7])
+  redis.call('LTRIM', KEYS[3], 0, tonumber(ARGV[8]) - 1)
+  redis.call('EXPIRE', KEYS[3], ARGV[3])
+end
+if KEYS[4] then redis.call('SET', KEYS[4], ARGV[9], 'EX', ARGV[3]) end
+redis.call('PUBLISH', ARGV[5], ARGV[6])
+return 1
+"""
+
+
+@_kv.emulate(SAVE_GAME_SCRIPT)
+def _save_game(call, keys, argv):
+    if argv[3] == "new":
+        if call("GET", keys[0]):
+            return 0
+    elif argv[3] != "":
+        cur = call("GET", keys[0])
+        if not cur:
+            return 0
+        try:
+            version = json.loads(cur).get("version") or 0
+        except (ValueError, AttributeError):
+            return 0
+        if str(version) != argv[3]:
+            return 0
+    call("SET", keys[0], argv[0], "EX", argv[2])
+    call("SET", keys[1], argv[1], "EX", argv[2])
+    if argv[6] != "":
+        call("LPUSH", keys[2], argv[6])
+        call("LTRIM", keys[2], 0, int(argv[7]) - 1)
+        call("EXPIRE", keys[2], argv[2])
+    if len(keys) > 3:
+        call("SET", keys[3], argv[8], "EX", argv[2])
+    call("PUBLISH", argv[4], argv[5])
+    return 1
+
+
+def save_game(game, copy_to=None, prev=None, ex=GAME_TTL, create=False):
+    """Write the game, bump its version and wake up long-polling readers.
+
+    Header and body are written together. ``prev`` is the game as it was
+    loaded: the write is then a compare-and-swap that only happens if the
+    stored game is still at that version, and the difference is logged so
+    pollers can fetch a patch instead of the whole game. ``create`` only
+    writes if no game has the code yet. ``copy_to`` also stores the full
+    game under a second key in the same atomic step.
+    Returns True if the game was written.
+    """
+    code = game["code"]
+    game["version"] = game.get("version", 0) + 1
+    header, body = split_game(game)
+    patch = json.dumps(game_patch(prev, game)) if prev is not None else ""
+    keys = [f"game:{code}", f"game:{code}:body", f"game:{code}:log"]
+    args = [
+        json.dumps(header), json.dumps(body), ex,
+        "new" if create else "" if prev is None else prev.get("version", 0),
+        f"game:{code}", game["version"], patch, PATCH_HISTORY,
+    ]
+    if copy_to:
+        keys.append(copy_to)
+        args.append(json.dumps(game))
+    if kv_eval(SAVE_GAME_SCRIPT, keys, args) != 1:
+        return False
+    game_cache.store(game)
+    return True
+
+
+def update_game(game, changes, still_applies, copy_to=None, attempts=4):
+    """Apply ``changes`` to a loaded game and save it.
+
+    If another write got in first (an image landing mid-turn, say), the
+    game is reloaded and the changes re-applied, as long as
+    ``still_applies(game)`` holds for the fresh copy. Returns the saved
+    game, or None if the changes no longer apply.
+    """
+    for _ in range(attempts):
+        before = dict(game)
+        game.update(changes)
+        if save_game(game, copy_to=copy_to, prev=before):
+            return game
+        game = load_game(game["code"])
+        if game is None or not still_applies(game):
+            return None
+    return None
+
+
+def wait_for_change(code, since, timeout):
+    """Block until the game's version differs from ``since`` or ``timeout`` passes.
+
+    Returns the current header (None if the game doesn't exist). Waits on the
+    game's pub/sub channel; falls back to re-reading the header once a second
+    if subscribing isn't possible.
+    """
+    header = load_game_header(code)
+    if header is None or header.get("version") != since:
+        return header
+    with _trace.phase("wait"):
+        return _wait_for_version(code, since, header, timeout)
+
+
+def _wait_for_version(code, since, header, timeout):
+    deadline = time.time() + timeout
+    try:
+        for kind, payload in kv_subscribe(f"game:{code}", timeout):
+            # On "subscribe", re-read to close the gap since the first read
+            if kind == "subscribe" or payload != str(since):
+                header = load_game_header(code)
+                if header is None or header.get("version") != since:
+                    return header
+        return header
+    except Exception:
+        pass
+
+    while time.time() < deadline:
+        time.sleep(min(1.0, max(0.0, deadline - time.time())))
+        header = load_game_header(code)
+        if header is None or header.get("version") != since:
+            return header
+    return header
+
+
+# --- Game codes ---
+#
+# Codes are CODE_LENGTH characters from CODE_ALPHABET. A code is claimed by
+# creating its game with save_game(create=True), which fails atomically if
+# the code is live, so there's no check-then-write race. When codes of one
+# length start colliding often (the space is filling up), new games get
+# codes one character longer, up to CODE_MAX_LENGTH.
+
+CODE_ALPHABET = "".join(dict.fromkeys(os.environ.get("CODE_ALPHABET", "0123456789").upper()))
+CODE_LENGTH = int(os.environ.get("CODE_LENGTH", "6"))
+CODE_MAX_LENGTH = max(CODE_LENGTH, int(os.environ.get("CODE_MAX_LENGTH", str(CODE_LENGTH + 2))))
+CODE_ATTEMPTS = 6
+# Share of recent attempts at a length that collided before new codes get longer
+CODE_GROW_AT = float(os.environ.get("CODE_GROW_AT", "0.2"))
+CODE_WINDOW = 100
+CODE_MIN_SAMPLES = 10
+CODE_STATS_TTL = LLM_STATS_TTL
+
+_code_attempts = collections.deque(maxlen=CODE_WINDOW)  # (length, collided)
+_code_lock = threading.Lock()
+
+
+def generate_code(length=CODE_LENGTH):
+    return "".join(random.choice(CODE_ALPHABET) for _ in range(length))
+
+
+def valid_code(code):
+    return (CODE_LENGTH <= len(code) <= CODE_MAX_LENGTH
+            and all(c in CODE_ALPHABET for c in code))
+
+
+def code_length():
+    """Shortest length whose recent collision rate in this instance is acceptable."""
+    with _code_lock:
+        recent = list(_code_attempts)
+    length = CODE_LENGTH
+    while length < CODE_MAX_LENGTH:
+        tries = [collided for n, collided in recent if n == length]
+        if len(tries) < CODE_MIN_SAMPLES or sum(tries) / len(tries) < CODE_GROW_AT:
+            break
+        length += 1
+    return length
+
+
+def create_game(game):
+    """Save a new game under a fresh code, reserved atomically. Returns the code, or None.
+
+    After two collisions in a row the next try is a character longer.
+    """
+    length = code_length()
+    collisions = 0
+    code = None
+    for attempt in range(CODE_ATTEMPTS):
+        if attempt and attempt % 2 == 0 and length < CODE_MAX_LENGTH:
+            length += 1
+        game["code"] = generate_code(length)
+        game.pop("version", None)
+        created = save_game(game, create=True)
+        with _code_lock:
+            _code_attempts.append((length, not created))
+        if created:
+            code = game["code"]
+            break
+        collisions += 1
+    record_code_stats(length if code else None, collisions)
+    return code
+
+
+def code_stats_key(day):
+    return f"codestats:{day}"
+
+
+def record_code_stats(length, collisions):
+    """Count a game creation in today's code stats: its code length, or None if it failed.
+
+    Best effort, like record_llm_usage.
+    """
+    key = code_stats_key(time.strftime("%Y%m%d", time.gmtime()))
+    _trace.count(key, "collisions", collisions, CODE_STATS_TTL)
+    if length is None:
+        _trace.count(key, "failed", 1, CODE_STATS_TTL)
+    else:
+        _trace.count(key, "created", 1, CODE_STATS_TTL)
+        _trace.count(key, f"length:{length}", 1, CODE_STATS_TTL)
+
+
+def summarize_code_stats(flat):
+    """Turn a code stats hash into totals, codes per length and the collision rate."""
+    out = {"created": 0, "failed": 0, "collisions": 0, "lengths": {}}
+    for name, value in flat.items():
+        if name.startswith("length:"):
+            out["lengths"][name[7:]] = int(value)
+        elif name in out:
+            out[name] = int(value)
+    attempts = out["created"] + out["failed"] + out["collisions"]
+    out["collision_rate"] = round(out["collisions"] / attempts, 4) if attempts else None
+    return out
+
+
+# --- Quick match ---
+#
+# Players who'll take any opponent wait in a sorted set of tickets scored
+# by the time they queued. MATCH_SCRIPT either pairs an arriving player
+# with the longest-waiting ticket that is still live, or queues them, in
+# one atomic step, so two arrivals can never take the same waiting player.
+# The arrival then creates the game and publishes its code on the waiting
+# ticket's channel. A waiting player's long poll on /api/match doubles as
+# its heartbeat; tickets not seen for MATCH_STALE seconds are dropped when
+# they reach the front of the queue.
+
+MATCH_QUEUE = "match:queue"      # zset: ticket -> time queued
+MATCH_ENTRIES = "match:entries"  # hash: ticket -> {"name", "since"}
+MATCH_SEEN = "match:seen"        # hash: ticket -> last heartbeat, or "paired"
+MATCH_STALE = 40
+MATCH_IDLE_TTL = 3600  # the queue's keys expire after an hour without arrivals
+MATCH_RESULT_TTL = 300
+MATCH_STATS_TTL = LLM_STATS_TTL
+MATCH_WAIT_BUCKETS = (1, 5, 15, 60)  # seconds, for the wait-time histogram
+
+
+def match_result_key(ticket):
+    """Where a paired ticket's game code is left; also the channel it's announced on."""
+    return f"match:{ticket}"
+
+
+def match_stats_key(day):
+    return f"matchstats:{day}"
+
+
+def _match_keys():
+    day = time.strftime("%Y%m%d", time.gmtime())
+    return [MATCH_QUEUE, MATCH_ENTRIES, MATCH_SEEN, match_stats_key(day)]
+
+
+# KEYS: queue, entries, seen, stats
+# ARGV: ticket, entry json, now, stale after, idle ttl, stats ttl
+# Returns {ticket, entry} of the player to pair with, or {'', queue depth}.
+MATCH_SCRIPT = """
+local now = tonumber(ARGV[3])
+local dropped = 0
+local found = nil
+while true do
+  local head = redis.call('ZRANGE', KEYS[1], 0, 0)[1]
+  if not head then break end
+  redis.call('ZREM', KEYS[1], head)
+  local entry = redis.call('HGET', KEYS[2], head)
+  local seen = tonumber(redis.call('HGET', KEYS[3], head) or '')
+  redis.call('HDEL', KEYS[2], head)
+  if entry and seen and now - seen <= tonumber(ARGV[4]) then
+    redis.call('HSET', KEYS[3], head, 'paired')
+    found = {head, entry}
+    break
+  end
+  redis.call('HDEL', KEYS[3], head)
+  dropped = dropped + 1
+end
+if dropped > 0 then redis.call('HINCRBY', KEYS[4], 'dropped', dropped) end
+redis.call('EXPIRE', KEYS[4], ARGV[6])
+if found then return found end
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[3])
+for i = 1, 3 do redis.call('EXPIRE', KEYS[i], ARGV[5]) end
+redis.call('HINCRBY', KEYS[4], 'queued', 1)
+return {'', redis.call('ZCARD', KEYS[1])}
+"""
+
+
+@_kv.emulate(MATCH_SCRIPT)
+def _match(call, keys, argv):
+    now = float(argv[2])
+    dropped = 0
+    found = None
+    while True:
+        head = (call("ZRANGE", keys[0], 0, 0) or [None])[0]
+        if head is None:
+            break
+        call("ZREM", keys[0], head)
+        entry = call("HGET", keys[1], head)
+        try:
+            seen = float(call("HGET", keys[2], head))
+        except (TypeError, ValueError):
+            seen = None
+        call("HDEL", keys[1], head)
+        if entry and seen is not None and now - seen <= float(argv[3]):
+            call("HSET", keys[2], head, "paired")
+            found = [head, entry]
+            break
+        call("HDEL", keys[2], head)
+        dropped += 1
+    if dropped:
+        call("HINCRBY", keys[3], "dropped", dropped)
+    call("EXPIRE", keys[3], argv[5])
+    if found:
+        return found
+    call("ZADD", keys[0], argv[2], argv[0])
+    call("HSET", keys[1], argv[0], argv[1])
+    call("HSET", keys[2], argv[0], argv[2])
+    for key in keys[:3]:
+        call("EXPIRE", key, argv[4])
+    call("HINCRBY", keys[3], "queued", 1)
+    return ["", call("ZCARD", keys[0])]
+
+
+# KEYS: queue, entries, seen, stats, result
+# ARGV: ticket, now
+# Returns {code} once paired, {'', position, depth} while queued (position
+# 0: being paired right now), or {} if the ticket isn't queued.
+MATCH_POLL_SCRIPT = """
+local code = redis.call('GET', KEYS[5])
+if code then return {code} end
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+  redis.call('HSET', KEYS[3], ARGV[1], ARGV[2])
+  return {'', redis.call('ZRANK', KEYS[1], ARGV[1]) + 1, redis.call('ZCARD', KEYS[1])}
+end
+if redis.call('HGET', KEYS[3], ARGV[1]) == 'paired' then
+  return {'', 0, redis.call('ZCARD', KEYS[1])}
+end
+return {}
+"""
+
+
+@_kv.emulate(MATCH_POLL_SCRIPT)
+def _match_poll(call, keys, argv):
+    code = call("GET", keys[4])
+    if code:
+        return [code]
+    if call("ZSCORE", keys[0], argv[0]) is not None:
+        call("HSET", keys[2], argv[0], argv[1])
+        return ["", call("ZRANK", keys[0], argv[0]) + 1, call("ZCARD", keys[0])]
+    if call("HGET", keys[2], argv[0]) == "paired":
+        return ["", 0, call("ZCARD", keys[0])]
+    return []
+
+
+# KEYS: queue, entries, seen, stats, result
+# ARGV: ticket, stats ttl
+# Returns the game code if already paired, '' if a game is being made for
+# the ticket right now, or nil once it has left the queue.
+MATCH_CANCEL_SCRIPT = """
+local code = redis.call('GET', KEYS[5])
+if code then return code end
+if redis.call('HGET', KEYS[3], ARGV[1]) == 'paired' then return '' end
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 1 then
+  redis.call('HINCRBY', KEYS[4], 'cancelled', 1)
+  redis.call('EXPIRE', KEYS[4], ARGV[2])
+end
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('HDEL', KEYS[3], ARGV[1])
+return false
+"""
+
+
+@_kv.emulate(MATCH_CANCEL_SCRIPT)
+def _match_cancel(call, keys, argv):
+    code = call("GET", keys[4])
+    if code:
+        return code
+    if call("HGET", keys[2], argv[0]) == "paired":
+        return ""
+    if call("ZREM", keys[0], argv[0]) == 1:
+        call("HINCRBY", keys[3], "cancelled", 1)
+        call("EXPIRE", keys[3], argv[1])
+    call("HDEL", keys[1], argv[0])
+    call("HDEL", keys[2], argv[0])
+    return None
+
+
+def new_game(p1_name, p2_name=None):
+    """A game at its first turn; waiting for player 2 unless both are known.
+
+    ``gid`` tells this game apart from later ones that reuse its code.
+    """
+    return {
+        "gid": binascii.hexlify(os.urandom(6)).decode(),
+        "p1_name": p1_name,
+        "p2_name": p2_name,
+        "p1_hp": 100,
+        "p2_hp": 100,
+        "situation": "An open arena, untouched and waiting for chaos.",
+        "last_action": "None yet. This is the first move!",
+        "turn": 1,
+        "current_player": 1,
+        "status": "waiting" if p2_name is None else "active",
+        "narrative": None,
+        "scene": None,
+        "last_updated": time.time(),
+    }
+
+
+def quick_match(name):
+    """Pair this player with the longest-waiting one, or queue them.
+
+    Returns {"matched": True, "code", "player_num": 2, "game"}: the waiting
+    player is player 1 and moves first. Or {"matched": False, "ticket",
+    "depth"} when queued.
+    """
+    ticket = binascii.hexlify(os.urandom(8)).decode()
+    now = time.time()
+    entry = json.dumps({"name": name, "since": now})
+    keys = _match_keys()
+    reply = kv_eval(MATCH_SCRIPT, keys,
+                    [ticket, entry, now, MATCH_STALE, MATCH_IDLE_TTL, MATCH_STATS_TTL])
+    other = reply[0]
+    if not other:
+        return {"matched": False, "ticket": ticket, "depth": reply[1]}
+
+    waiting = json.loads(reply[1])
+    game = new_game(waiting["name"], name)
+    code = create_game(game)
+    if code is None:
+        # Put the waiting player back where they were
+        kv_pipeline([
+            ["ZADD", MATCH_QUEUE, waiting["since"], other],
+            ["HSET", MATCH_ENTRIES, other, reply[1]],
+            ["HSET", MATCH_SEEN, other, now],
+        ])
+        raise Exception("Could not generate unique code")
+
+    waited = max(0.0, now - waiting["since"])
+    bucket = next((str(b) for b in MATCH_WAIT_BUCKETS if waited <= b), "inf")
+    kv_pipeline([
+        ["SET", match_result_key(other), code, "EX", MATCH_RESULT_TTL],
+        ["PUBLISH", match_result_key(other), code],
+        ["HDEL", MATCH_SEEN, other],
+    ])
+    _trace.count(keys[3], "matched", 1, MATCH_STATS_TTL)
+    _trace.count(keys[3], "wait_ms", round(waited * 1000), MATCH_STATS_TTL)
+    _trace.count(keys[3], f"wait_s:{bucket}", 1, MATCH_STATS_TTL)
+    return {"matched": True, "code": code, "player_num": 2, "game": game}
+
+
+def _poll_match(ticket):
+    reply = kv_eval(MATCH_POLL_SCRIPT, _match_keys() + [match_result_key(ticket)],
+                    [ticket, time.time()])
+    if not reply:
+        return None
+    if reply[0]:
+        return {"code": reply[0]}
+    return {"position": reply[1], "depth": reply[2]}
+
+
+def wait_for_match(ticket, timeout):
+    """Keep a queued ticket alive and wait up to ``timeout`` seconds for its game.
+
+    Returns {"code"} once paired, {"position", "depth"} if still waiting,
+    or None if the ticket isn't queued (it expired or was cancelled).
+    Waits on the ticket's channel, falling back to checking once a second.
+    """
+    state = _poll_match(ticket)
+    if state is None or "code" in state or timeout <= 0:
+        return state
+    with _trace.phase("wait"):
+        return _wait_for_pairing(ticket, state, timeout)
+
+
+def _wait_for_pairing(ticket, state, timeout):
+    deadline = time.time() + timeout
+    try:
+        for kind, payload in kv_subscribe(match_result_key(ticket), timeout):
+            if kind == "message":
+                return {"code": payload}
+            # Subscribed: re-check to close the gap since the first look
+            state = _poll_match(ticket)
+            if state is None or "code" in state:
+                return state
+        return state
+    except Exception:
+        pass
+
+    while time.time() < deadline:
+        time.sleep(min(1.0, max(0.0, deadline - time.time())))
+        state = _poll_match(ticket)
+        if state is None or "code" in state:
+            return state
+    return state
+
+
+def cancel_match(ticket):
+    """Leave the queue. Returns the game code if the ticket was paired first,
+    "" if a game is being made for it right now, else None."""
+    keys = _match_keys() + [match_result_key(ticket)]
+    return kv_eval(MATCH_CANCEL_SCRIPT, keys, [ticket, MATCH_STATS_TTL])
+
+
+def summarize_match_stats(flat, depth):
+    """Turn a match stats hash into counters, wait times and the current queue depth."""
+    out = {"depth": depth, "queued": 0, "matched": 0, "cancelled": 0, "dropped": 0, "wait_s": {}}
+    wait_ms = 0
+    for name, value in flat.items():
+        if name.startswith("wait_s:"):
+            out["wait_s"][name[7:]] = int(value)
+        elif name == "wait_ms":
+            wait_ms = int(value)
+        elif name in out:
+            out[name] = int(value)
+    out["avg_wait_ms"] = round(wait_ms / out["matched"]) if out["matched"] else None
+    return out
+
+
+# --- Admission control ---
+#
+# Requests that call the LLM or Replicate are admitted through
+# ADMIT_SCRIPT, which checks token buckets (per client IP, per game, per
+# endpoint) and in-flight limits in one atomic step, and takes from them
+# only if all of them have room. An in-flight limit is a sorted set of
+# leases scored by when they expire, so a request that dies without
+# releasing its lease frees the slot anyway once it runs out.
+#
+# Images are shed first: one needs a free image slot and the LLM pool
+# under IMAGE_SHED_AT of its limit, so under load games go on without
+# pictures well before referee calls are refused with a 429.
+
+LLM_POOL = "admit:llm"      # zset: lease -> expiry (ms)
+IMAGE_POOL = "admit:image"  # zset: lease -> expiry (ms)
+LLM_MAX_INFLIGHT = int(os.environ.get("LLM_MAX_INFLIGHT", "40"))  # requests, across instances
+IMAGE_MAX_INFLIGHT = int(os.environ.get("IMAGE_MAX_INFLIGHT", "20"))  # Replicate jobs
+IMAGE_SHED_AT = float(os.environ.get("IMAGE_SHED_AT", "0.75"))  # share of LLM_MAX_INFLIGHT
+# Token buckets, refilled per minute; 0 turns one off
+ADMIT_IP_PER_MIN = float(os.environ.get("ADMIT_IP_PER_MIN", "30"))
+ADMIT_IP_BURST = int(os.environ.get("ADMIT_IP_BURST", "10"))
+ADMIT_GAME_PER_MIN = float(os.environ.get("ADMIT_GAME_PER_MIN", "12"))
+ADMIT_GAME_BURST = int(os.environ.get("ADMIT_GAME_BURST", "4"))
+ADMIT_ENDPOINT_PER_MIN = float(os.environ.get("ADMIT_ENDPOINT_PER_MIN", "0"))
+LLM_LEASE = int(REQUEST_BUDGET) + 10
+IMAGE_LEASE = 60  # a webhook job's slot is freed when the image lands, or after this
+LLM_RETRY_AFTER = 3
+IMAGE_RETRY_AFTER = 5
+ADMIT_STATS_TTL = LLM_STATS_TTL
+
+# KEYS: buckets..., pools...
+# ARGV: now (ms), bucket count, {per second, burst} per bucket,
+#       pool count, {limit, lease ms (0: only check), retry ms} per pool, lease token
+# Returns {0, ''} if admitted, else {ms to wait, key that refused}.
+# The function is shared with TURN_BEGIN_SCRIPT, which admits as one of its steps.
+ADMIT_FUNCTION = """
+local function admit(KEYS, ARGV)
+local now = tonumber(ARGV[1])
+local nb = tonumber(ARGV[2])
+local np = tonumber(ARGV[3 + 2 * nb])
+local token = ARGV[4 + 2 * nb + 3 * np]
+local wait, refused = 0, ''
+local level = {}
+for k = 1, nb do
+  local rate, burst = tonumber(ARGV[1 + 2 * k]), tonumber(ARGV[2 + 2 * k])
+  local tokens = burst
+  local v = redis.call('GET', KEYS[k])
+  if v then
+    local sep = string.find(v, ':', 1, true)
+    local since = now - tonumber(string.sub(v, sep + 1))
+    tokens = math.min(burst, tonumber(string.sub(v, 1, sep - 1)) + since * rate / 1000)
+  end
+  level[k] = tokens
+  if tokens < 1 then
+    local w = math.ceil((1 - tokens) * 1000 / rate)
+    if w > wait then wait, refused = w, KEYS[k] end
+  end
+end
+for p = 1, np do
+  local at = 3 + 2 * nb + 3 * (p - 1)
+  local key = KEYS[nb + p]
+  redis.call('ZREMRANGEBYSCORE', key, '-inf', now)
+  if redis.call('ZCARD', key) >= tonumber(ARGV[at + 1]) then
+    local w = tonumber(ARGV[at + 3])
+    if w > wait then wait, refused = w, key end
+  end
+end
+if wait > 0 then return {wait, refused} end
+for k = 1, nb do
+  local rate, burst = tonumber(ARGV[1 + 2 * k]), tonumber(ARGV[2 + 2 * k])
+  redis.call('SET', KEYS[k], tostring(level[k] - 1) .. ':' .. ARGV[1], 'EX', math.ceil(burst / rate) + 1)
+end
+for p = 1, np do
+  local lease = tonumber(ARGV[3 + 2 * nb + 3 * (p - 1) + 2])
+  if lease > 0 then
+    redis.call('ZADD', KEYS[nb + p], now + lease, token)
+    redis.call('EXPIRE', KEYS[nb + p], math.ceil(lease / 1000) + 1)
+  end
+end
+return {0, ''}
+end
+"""
+ADMIT_SCRIPT = ADMIT_FUNCTION + "return admit(KEYS, ARGV)\n"
+
+
+@_kv.emulate(ADMIT_SCRIPT)
+def _admit(call, keys, argv):
+    now = int(argv[0])
+    nb = int(argv[1])
+    rates = [(float(argv[2 + 2 * k]), float(argv[3 + 2 * k])) for k in range(nb)]
+    np_ = int(argv[2 + 2 * nb])
+    pools = [tuple(int(x) for x in argv[3 + 2 * nb + 3 * p:6 + 2 * nb + 3 * p]) for p in range(np_)]
+    token = argv[3 + 2 * nb + 3 * np_]
+
+    wait, refused, level = 0, "", []
+    for key, (rate, burst) in zip(keys, rates):
+        tokens = burst
+        v = call("GET", key)
+        if v:
+            left, _, since = v.partition(":")
+            tokens = min(burst, float(left) + (now - int(since)) * rate / 1000)
+        level.append(tokens)
+        if tokens < 1:
+            w = math.ceil((1 - tokens) * 1000 / rate)
+            if w > wait:
+                wait, refused = w, key
+    for key, (limit, _, retry) in zip(keys[nb:], pools):
+        for member in call("ZRANGE", key, 0, -1):
+            if float(call("ZSCORE", key, member)) > now:
+                break
+            call("ZREM", key, member)
+        if call("ZCARD", key) >= limit and retry > wait:
+            wait, refused = retry, key
+    if wait > 0:
+        return [wait, refused]
+    for key, (rate, burst), tokens in zip(keys, rates, level):
+        call("SET", key, f"{tokens - 1!r}:{now}", "EX", math.ceil(burst / rate) + 1)
+    for key, (_, lease, _) in zip(keys[nb:], pools):
+        if lease > 0:
+            call("ZADD", key, now + lease, token)
+            call("EXPIRE", key, math.ceil(lease / 1000) + 1)
+    return [0, ""]
+
+
+def admit_stats_key(day):
+    return f"admitstats:{day}"
+
+
+def client_ip(headers, address=None):
+    """The caller's address: Vercel's x-real-ip, else the first X-Forwarded-For hop."""
+    ip = headers.get("x-real-ip") or headers.get("x-forwarded-for", "").split(",")[0]
+    return ip.strip() or (address[0] if address else "unknown")
+
+
+def admit(kind, buckets, pools, token=None):
+    """Take a token from every bucket and a lease in every pool, or nothing.
+
+    ``buckets`` are (key, per minute, burst) and ``pools`` (key, limit,
+    lease seconds, retry seconds); a lease of 0 only checks that the pool
+    holds fewer than ``limit``. Buckets and pools set to 0 are skipped.
+    Returns (lease token, 0) if admitted, else (None, seconds to wait). A
+    refusal is counted under ``kind`` in the day's admission stats. If KV
+    can't be reached the request is let through.
+    """
+    token = token or binascii.hexlify(os.urandom(8)).decode()
+    keys, argv = _admit_args(buckets, pools, token)
+    try:
+        wait, refused = kv_eval(ADMIT_SCRIPT, keys, argv)
+    except Exception:
+        return token, 0
+    if not wait:
+        return token, 0
+    return None, _refused(kind, wait, refused)
+
+
+def _admit_args(buckets, pools, token):
+    """KEYS and ARGV of ADMIT_SCRIPT for admit()'s arguments."""
+    buckets = [b for b in buckets if b[1] > 0]
+    pools = [p for p in pools if p[1] > 0]
+    argv = [int(time.time() * 1000), len(buckets)]
+    for _, per_min, burst in buckets:
+        argv += [per_min / 60, max(1, burst)]
+    argv.append(len(pools))
+    for _, limit, lease, retry in pools:
+        argv += [limit, int(lease * 1000), max(1, int(retry * 1000))]
+    argv.append(token)
+    return [b[0] for b in buckets] + [p[0] for p in pools], argv
+
+
+def _refused(kind, wait, refused):
+    """Count a refusal in the day's admission stats; returns seconds to wait."""
+    key = admit_stats_key(time.strftime("%Y%m%d", time.gmtime()))
+    _trace.count(key, f"{kind}:{refused.split(':')[1]}", 1, ADMIT_STATS_TTL)
+    return math.ceil(int(wait) / 1000)
+
+
+def _llm_admission(endpoint, ip, code=None):
+    """admit() buckets and pools for a request that calls the LLM."""
+    buckets = [(f"admit:ip:{ip}", ADMIT_IP_PER_MIN, ADMIT_IP_BURST),
+               (f"admit:endpoint:{endpoint}", ADMIT_ENDPOINT_PER_MIN, ADMIT_ENDPOINT_PER_MIN / 6)]
+    if code:
+        buckets.append((f"admit:game:{code}", ADMIT_GAME_PER_MIN, ADMIT_GAME_BURST))
+    return buckets, [(LLM_POOL, LLM_MAX_INFLIGHT, LLM_LEASE, LLM_RETRY_AFTER)]
+
+
+def admit_llm(endpoint, ip, code=None):
+    """Admission for a request that calls the LLM; see admit()."""
+    return admit("llm", *_llm_admission(endpoint, ip, code))
+
+
+def admit_image(ip=None, token=None):
+    """Admission for an image; refused before the LLM pool is full (see above).
+
+    ``ip`` charges the caller's image bucket, kept apart from the one for
+    LLM calls so pictures never use up a player's turns.
+    """
+    buckets = [(f"admit:ip:{ip}:image", ADMIT_IP_PER_MIN, ADMIT_IP_BURST)] if ip else []
+    shed_at = math.ceil(IMAGE_SHED_AT * LLM_MAX_INFLIGHT) if LLM_MAX_INFLIGHT > 0 else 0
+    return admit("image", buckets, [(IMAGE_POOL, IMAGE_MAX_INFLIGHT, IMAGE_LEASE, IMAGE_RETRY_AFTER),
+                                    (LLM_POOL, shed_at, 0, IMAGE_RETRY_AFTER)], token)
+
+
+def admit_looks():
+    """Admission for inventing a game's looks, which can wait for turn one.
+
+    Like an image, it is turned away once the LLM pool reaches IMAGE_SHED_AT.
+    """
+    shed_at = math.ceil(IMAGE_SHED_AT * LLM_MAX_INFLIGHT) if LLM_MAX_INFLIGHT > 0 else 0
+    return admit("looks", [], [(LLM_POOL, shed_at, LLM_LEASE, LLM_RETRY_AFTER)])
+
+
+def release(pool, token):
+    """Give back a lease taken by admit(); it would expire on its own anyway."""
+    try:
+        kv_command("ZREM", pool, token)
+    except Exception:
+        pass
+
+
+# KEYS: turn result copy ('' for none), turn lock, header, body, then admit()'s
+# ARGV: lock token, lock seconds, cached version ('' for none), player, then admit()'s
+# Returns {'done', result} for a turn already played, {'busy'} if the lock is
+# held, {'refused', ms to wait, key that refused}, or {'game', header[, body]}
+# as LOAD_GAME_SCRIPT would. A move that can't be played gets {'missing'},
+# {'finished'}, {'waiting'} or {'turn'} and takes nothing, as does a refusal.
+TURN_BEGIN_SCRIPT = ADMIT_FUNCTION + """
+if KEYS[1] ~= '' then
+  local done = redis.call('GET', KEYS[1])
+  if done then return {'done', done} end
+end
+if not redis.call('SET', KEYS[2], ARGV[1], 'NX', 'EX', ARGV[2]) then return {'busy'} end
+local header = redis.call('GET', KEYS[3])
+local g, reason = nil, nil
+if not header then
+  reason = 'missing'
+else
+  g = cjson.decode(header)
+  if g['status'] == 'finished' then reason = 'finished'
+  elseif g['status'] ~= 'active' then reason = 'waiting'
+  elseif tostring(g['current_player']) ~= ARGV[4] then reason = 'turn' end
+end
+if reason then
+  redis.call('DEL', KEYS[2])
+  return {reason}
+end
+local admitted = admit({unpack(KEYS, 5)}, {unpack(ARGV, 5)})
+if admitted[1] > 0 then
+  redis.call('DEL', KEYS[2])
+  return {'refused', admitted[1], admitted[2]}
+end
+if ARGV[3] ~= '' and tostring(g['version'] or 0) == ARGV[3] then return {'game', header} end
+return {'game', header, redis.call('GET', KEYS[4])}
+"""
+
+
+@_kv.emulate(TURN_BEGIN_SCRIPT)
+def _turn_begin(call, keys, argv):
+    if keys[0]:
+        done = call("GET", keys[0])
+        if done:
+            return ["done", done]
+    if call("SET", keys[1], argv[0], "NX", "EX", argv[1]) != "OK":
+        return ["busy"]
+    header = call("GET", keys[2])
+    g, reason = json.loads(header) if header else None, None
+    if g is None:
+        reason = "missing"
+    elif g.get("status") == "finished":
+        reason = "finished"
+    elif g.get("status") != "active":
+        reason = "waiting"
+    elif str(g.get("current_player")) != argv[3]:
+        reason = "turn"
+    if reason:
+        call("DEL", keys[1])
+        return [reason]
+    wait, refused = _admit(call, keys[4:], argv[4:])
+    if wait > 0:
+        call("DEL", keys[1])
+        return ["refused", wait, refused]
+    if argv[2] != "" and str(g.get("version") or 0) == argv[2]:
+        return ["game", header]
+    return ["game", header, call("GET", keys[3])]
+
+
+def begin_turn(code, player_num, result_key, lock_key, lock_ex, ip):
+    """Everything a turn does before the referee, in one round trip.
+
+    Returns the saved result of a turn already played (``result_key``),
+    or takes the turn lock, checks the move can be played and admits it
+    as admit_llm() would. Returns (outcome, detail, token):
+    ("done", saved game, None), ("busy", None, None), ("refused", seconds
+    to wait, None), one of "missing", "finished", "waiting" or "turn" for
+    a move that can't be played, or ("game", game, token). The token holds
+    both the lock and the LLM lease; kv_release_lock(lock_key, token,
+    LLM_POOL) gives both back.
+    """
+    token = binascii.hexlify(os.urandom(8)).decode()
+    cached = game_cache.version(code)
+    keys, argv = _admit_args(*_llm_admission("turn", ip, code), token)
+    reply = kv_eval(TURN_BEGIN_SCRIPT,
+                    [result_key or "", lock_key, f"game:{code}", f"game:{code}:body"] + keys,
+                    [token, lock_ex, "" if cached is None else cached, player_num] + argv)
+    outcome = reply[0]
+    if outcome == "done":
+        return outcome, json.loads(reply[1]), None
+    if outcome == "refused":
+        return outcome, _refused("llm", reply[1], reply[2]), None
+    if outcome == "game":
+        return outcome, _loaded_game(code, reply[1:]), token
+    return outcome, None, None
+
+
+def image_lease(code, turn, preview=False):
+    """Lease token of the image job for ``turn``, released by its webhook."""
+    return f"{code}:{turn}:preview" if preview else f"{code}:{turn}"
+
+
+def summarize_admit_stats(flat, llm_leases, image_leases):
+    """Refusals per kind and reason, and the leases held right now."""
+    refused = {}
+    for name, value in flat.items():
+        kind, _, why = name.partition(":")
+        refused.setdefault(kind, {})[why] = int(value)
+    return {
+        "refused": refused,
+        "llm_leases": llm_leases,
+        "llm_max": LLM_MAX_INFLIGHT,
+        "image_leases": image_leases,
+        "image_max": IMAGE_MAX_INFLIGHT,
+    }
+
 # --- Image generation ---
 
 REPLICATE_API_TOKEN = os.environ.get("REPLICATE_API_TOKEN", "")
-REPLICATE_MODEL_URL = "https://api.replicate.com/v1/models/black-forest-labs/flux-schnell/predictions"
+REPLICATE_API_URL = os.environ.get("REPLICATE_API_URL", "https://api.replicate.com/v1").rstrip("/")
+REPLICATE_MODEL = "black-forest-labs/flux-schnell"
+REPLICATE_MODEL_URL = f"{REPLICATE_API_URL}/models/{REPLICATE_MODEL}/predictions"
+REPLICATE_WEBHOOK_SECRET = os.environ.get("REPLICATE_WEBHOOK_SECRET", "")
+
+# Progressive images: a quick low-resolution preview is drawn alongside the
+# full render and shown until the full one lands
+IMAGE_PREVIEW = os.environ.get("IMAGE_PREVIEW", "1") != "0"
 
 IMAGE_STYLE_SUFFIX = "chaotic cartoon battle art, indie game style, exaggerated proportions, dynamic action pose, dark arena setting, vibrant saturated colors, warm fire accents, slightly rough and messy rendering, fun and over-the-top, comic book energy, no text, no watermark"
 
-def generate_image(prompt):
-    """Call Replicate FLUX-schnell and return image URL, or None on failure."""
-    if not prompt or not REPLICATE_API_TOKEN:
-        return None
 
-    styled_prompt = f"{prompt} {IMAGE_STYLE_SUFFIX}"
-
-    body = json.dumps({
-        "input": {
-            "prompt": styled_prompt,
-            "num_outputs": 1,
-            "aspect_ratio": "16:9",
-            "output_format": "webp",
-            "output_quality": 80,
-        }
-    }).encode("utf-8")
-
-    req = urllib.request.Request(
-        REPLICATE_MODEL_URL,
-        data=body,
-        headers={
-            "Authorization": f"Bearer {REPLICATE_API_TOKEN}",
-            "Content-Type": "application/json",
-            "Prefer": "wait",
-        },
-        method="POST",
-    )
+def _image_input(prompt, preview=False):
+    inputs = {
+        "prompt": f"{prompt} {IMAGE_STYLE_SUFFIX}",
+        "num_outputs": 1,
+        "aspect_ratio": "16:9",
+        "output_format": "webp",
+        "output_quality": 80,
+    }
+    if preview:
+        # A quarter of the pixels in half the steps: back in about a second
+        inputs.update({"megapixels": "0.25", "num_inference_steps": 2, "output_quality": 60,
+                       "go_fast": True})
+    return inputs
+
+
+def prediction_image_url(prediction):
+    """Return the first output URL of a finished prediction, or None."""
+    output = prediction.get("output")
+    if output and isinstance(output, list) and len(output) > 0:
+        return output[0] if isinstance(output[0], str) else str(output[0])
+    return None
+
+
+def _replicate_headers():
+    return {
+        "Authorization": f"Bearer {REPLICATE_API_TOKEN}",
+        "Content-Type": "application/json",
+    }
+
+
+def create_prediction(prompt, wait=False, webhook_url=None, timeout=None, preview=False):
+    """Start a FLUX-schnell prediction and return Replicate's JSON reply.
+
+    With ``wait`` Replicate holds the request until the image is ready (or
+    its sync window runs out), and with ``preview`` it draws the quick
+    low-resolution version. Raises _http.HTTPStatusError on API errors.
+    """
+    payload = {"input": _image_input(prompt, preview)}
+    if webhook_url:
+        payload["webhook"] = webhook_url
+        payload["webhook_events_filter"] = ["completed"]
+    headers = _replicate_headers()
+    if wait:
+        headers["Prefer"] = "wait"
+    body = json.dumps(payload).encode("utf-8")
+    with _trace.phase("replicate"):
+        return json.loads(_http.request("POST", REPLICATE_MODEL_URL, body, headers, timeout=timeout))
+
+
+def get_prediction(url):
+    with _trace.phase("replicate"):
+        return json.loads(_http.request("GET", url, headers=_replicate_headers(), timeout=10))
+
+
+def generate_image(prompt, looks=(), preview=False):
+    """Return the image URL for ``prompt``, from the cache or a fresh Replicate run; None on failure."""
+    if not prompt:
+        return None
+    key = image_key(prompt, looks, preview)
+    cached = cached_image(key)
+    if cached or not REPLICATE_API_TOKEN:
+        return cached
 
     try:
-        with urllib.request.urlopen(req, timeout=60) as resp:
-            result = json.loads(resp.read().decode("utf-8"))
+        result = create_prediction(prompt, wait=True, preview=preview)
 
-        output = result.get("output")
-        if output and isinstance(output, list) and len(output) > 0:
-            return output[0] if isinstance(output[0], str) else str(output[0])
+        image_url = prediction_image_url(result)
+        if image_url:
+            return store_image(key, image_url)
 
         # Poll fallback
         poll_url = result.get("urls", {}).get("get")
@@ -300,22 +2251,192 @@ def generate_image(prompt):
             return None
 
         for _ in range(15):
-            time.sleep(2)
-            poll_req = urllib.request.Request(
-                poll_url,
-                headers={"Authorization": f"Bearer {REPLICATE_API_TOKEN}"},
-            )
-            with urllib.request.urlopen(poll_req, timeout=10) as poll_resp:
-                poll_result = json.loads(poll_resp.read().decode("utf-8"))
+            with _trace.phase("image_wait"):
+                time.sleep(2)
+            poll_result = get_prediction(poll_url)
 
             status = poll_result.get("status")
             if status == "succeeded":
-                out = poll_result.get("output", [])
-                if out:
-                    return out[0] if isinstance(out[0], str) else str(out[0])
+                image_url = prediction_image_url(poll_result)
+                return store_image(key, image_url) if image_url else None
             elif status == "failed":
                 return None
 
         return None
     except Exception:
         return None
+
+
+def image_token():
+    """Random token a turn's webhook URLs carry, for when webhooks can't be signed."""
+    return binascii.hexlify(os.urandom(16)).decode()
+
+
+def image_webhook_url(host, code, turn, token, preview=False):
+    """Public URL Replicate should call when the image (or preview) for ``turn`` is done.
+
+    ``token`` is the turn's image_token; without REPLICATE_WEBHOOK_SECRET
+    it is all that lets the call in.
+    """
+    base = os.environ.get("PUBLIC_BASE_URL", "").rstrip("/")
+    if not base:
+        host = host or os.environ.get("VERCEL_URL", "")
+        if not host:
+            return None
+        base = f"https://{host}"
+    url = f"{base}/api/image_webhook?code={code}&turn={turn}&token={token}"
+    return f"{url}&tier=preview" if preview else url
+
+
+def start_image_job(prompt, webhook_url, preview=False):
+    """Start a Replicate prediction that reports back to ``webhook_url``.
+
+    Returns the prediction id without waiting for the image, or None if no
+    job could be started.
+    """
+    if not prompt or not webhook_url or not REPLICATE_API_TOKEN:
+        return None
+
+    try:
+        return create_prediction(prompt, webhook_url=webhook_url, timeout=15, preview=preview).get("id")
+    except Exception:
+        return None
+
+
+def verify_replicate_webhook(headers, body):
+    """Check Replicate's webhook signature. Fails when no secret is configured."""
+    if not REPLICATE_WEBHOOK_SECRET:
+        return False
+
+    msg_id = headers.get("webhook-id", "")
+    timestamp = headers.get("webhook-timestamp", "")
+    signatures = headers.get("webhook-signature", "")
+    if not msg_id or not timestamp or not signatures:
+        return False
+    try:
+        if abs(time.time() - int(timestamp)) > 300:
+            return False
+        key = base64.b64decode(REPLICATE_WEBHOOK_SECRET.split("_", 1)[-1])
+    except (ValueError, binascii.Error):
+        return False
+
+    signed = f"{msg_id}.{timestamp}.".encode("utf-8") + body
+    expected = base64.b64encode(hmac.new(key, signed, hashlib.sha256).digest()).decode()
+    for sig in signatures.split():
+        version, _, value = sig.partition(",")
+        if version == "v1" and hmac.compare_digest(value, expected):
+            return True
+    return False
+
+
+# --- Image cache ---
+#
+# Images are kept under a hash of everything that decides what Replicate
+# draws: the model and its inputs, with the styled prompt normalized so
+# prompts that differ only in case, spacing or punctuation share one, and
+# the fighters' looks. A finished image is copied into blob storage (see
+# _blob) and served by /api/image_proxy at a URL that never changes what
+# it points to, so the edge and both players' browsers keep it for good.
+# image:{hash} in KV points at the blob.
+
+IMAGE_INDEX_TTL = 30 * 86400
+IMAGE_MAX_BYTES = 4 * 1024 * 1024  # under Vercel's response limit
+IMAGE_KEY_RE = re.compile(r"^[0-9a-f]{64}$")
+IMAGE_EXTENSIONS = {"image/webp": "webp", "image/png": "png", "image/jpeg": "jpg"}
+# Where store_image may copy from: these origins and their subdomains
+IMAGE_SOURCES = [s.strip() for s in os.environ.get(
+    "IMAGE_SOURCES", "https://replicate.delivery").split(",") if s.strip()]
+
+
+def _normalize(text):
+    return " ".join(re.sub(r"[^\w\s]", " ", str(text).lower()).split())
+
+
+def image_key(prompt, looks=(), preview=False):
+    """Content address of the image ``prompt`` makes for fighters with ``looks``."""
+    inputs = _image_input(prompt, preview)
+    inputs["prompt"] = _normalize(inputs["prompt"])
+    source = json.dumps({"model": REPLICATE_MODEL, "input": inputs,
+                         "looks": [_normalize(look) for look in looks]}, sort_keys=True)
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+
+def image_index_key(key):
+    return f"image:{key}"
+
+
+def image_proxy_url(key):
+    return f"/api/image_proxy?key={key}"
+
+
+def image_source_allowed(url):
+    """Whether ``url`` is on one of IMAGE_SOURCES (scheme, host or a subdomain, and port)."""
+    try:
+        parts = urlparse(url)
+        if parts.username is not None or not parts.hostname:
+            return False
+        for source in IMAGE_SOURCES:
+            allowed = urlparse(source)
+            if (parts.scheme == allowed.scheme and parts.port == allowed.port
+                    and (parts.hostname == allowed.hostname
+                         or parts.hostname.endswith("." + allowed.hostname))):
+                return True
+    except ValueError:
+        pass
+    return False
+
+
+def cached_image(key):
+    """Proxy URL of the stored image for ``key``, or None if there isn't one (yet)."""
+    if _blob.BACKEND is None:
+        return None
+    try:
+        return image_proxy_url(key) if kv_get(image_index_key(key)) else None
+    except Exception:
+        return None
+
+
+def cached_images(*keys):
+    """cached_image() for several keys in one round trip."""
+    if _blob.BACKEND is None:
+        return [None] * len(keys)
+    try:
+        found = kv_command("MGET", *[image_index_key(key) for key in keys])
+    except Exception:
+        return [None] * len(keys)
+    return [image_proxy_url(key) if v else None for key, v in zip(keys, found)]
+
+
+def store_image(key, source_url):
+    """Copy a finished image from Replicate into blob storage under ``key``.
+
+    Only an image from IMAGE_SOURCES, of a type in IMAGE_EXTENSIONS and no
+    larger than IMAGE_MAX_BYTES is copied. Returns its proxy URL, or
+    ``source_url`` itself if there is no blob backend or the copy failed:
+    the picture still shows, it just isn't cached.
+    """
+    if _blob.BACKEND is None or not image_source_allowed(source_url):
+        return source_url
+    try:
+        with _trace.phase("blob"):
+            data, content_type = _http.download(source_url, IMAGE_MAX_BYTES, timeout=30)
+            ext = IMAGE_EXTENSIONS.get(content_type)
+            if ext is None:
+                return source_url
+            locator = _blob.BACKEND.put(f"images/{key}.{ext}", data, content_type)
+        kv_set(image_index_key(key), {"blob": locator, "type": content_type}, ex=IMAGE_INDEX_TTL)
+    except Exception:
+        return source_url
+    return image_proxy_url(key)
+
+
+def load_image(key):
+    """(bytes, content type) of the stored image for ``key``, or None."""
+    if _blob.BACKEND is None:
+        return None
+    entry = kv_get(image_index_key(key))
+    if not entry:
+        return None
+    with _trace.phase("blob"):
+        data = _blob.BACKEND.get(entry["blob"])
+    return (data, entry["type"]) if data is not None else None
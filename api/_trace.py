@@ -0,0 +1,333 @@
+"""Per-request timing: Server-Timing headers, JSON log lines and latency histograms.
+
+Every endpoint's handler derives from TracedHandler. Each request gets a
+trace id (the browser's X-Trace-Id when it sends one) and adds up the time
+spent in each phase as it runs:
+
+    with _trace.phase("kv"):
+        ...
+
+The phases timed in _shared are kv, llm, parse, replicate, image_wait
+(sleeping between Replicate polls), blob (copying images into and out of
+blob storage) and wait (long-poll holds). Responses
+carry the totals so far in Server-Timing along with X-Trace-Id, and once
+the request is done one JSON line goes to stdout, i.e. the function logs.
+TRACE_LOG=0 turns the lines off. With TRACE_SAMPLE set (0-1), that share
+of requests also adds its timings to daily histograms in KV, which
+/api/stats summarizes. 404s are left out of those, so requests for
+made-up endpoints can't add fields.
+
+The daily stats counters (see count()) ride on the trace too: a request
+sends all of them, and its histogram sample, in one pipeline at the end.
+"""
+
+import contextlib
+import functools
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlparse
+
+import _kv
+
+TRACE_LOG = os.environ.get("TRACE_LOG", "1") != "0"
+TRACE_SAMPLE = float(os.environ.get("TRACE_SAMPLE", "0"))
+LATENCY_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)  # ms, upper bounds
+LATENCY_STATS_TTL = 8 * 86400
+
+_TRACE_ID = re.compile(r"^[0-9A-Za-z-]{8,64}$")
+_TRACEPARENT = re.compile(r"^[0-9a-f]{2}-([0-9a-f]{32})-[0-9a-f]{16}-[0-9a-f]{2}$")
+_local = threading.local()
+
+
+class Trace:
+    """Phase timings of one request; safe to add to from several threads."""
+
+    def __init__(self, trace_id, method):
+        self.id = trace_id
+        self.method = method
+        self.endpoint = None
+        self.status = None
+        self.error = None
+        self.started = time.perf_counter()
+        self.phases = {}  # name -> [seconds, calls]
+        self.counters = {}  # (stats hash, field) -> amount, sent when the request ends
+        self.ttls = {}  # stats hash -> seconds to keep it
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            entry = self.phases.setdefault(name, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += 1
+
+    def count(self, key, field, n, ttl):
+        with self._lock:
+            self.counters[(key, field)] = self.counters.get((key, field), 0) + n
+            self.ttls[key] = ttl
+
+    def counter_commands(self):
+        """HINCRBY/EXPIRE commands for the counts so far, which are then cleared."""
+        with self._lock:
+            commands = [["HINCRBY", key, field, n] for (key, field), n in self.counters.items()]
+            commands += [["EXPIRE", key, ttl] for key, ttl in self.ttls.items()]
+            self.counters, self.ttls = {}, {}
+        return commands
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        with self._lock:
+            parts = [f'{name};dur={s * 1000:.1f};desc="{n}x"' for name, (s, n) in self.phases.items()]
+        parts.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(parts)
+
+    def record(self):
+        with self._lock:
+            phases = {name: {"ms": round(s * 1000, 1), "n": n} for name, (s, n) in self.phases.items()}
+        entry = {
+            "trace_id": self.id,
+            "endpoint": self.endpoint,
+            "method": self.method,
+            "status": self.status,
+            "ms": round(self.elapsed() * 1000, 1),
+            "phases": phases,
+        }
+        if self.error:
+            entry["error"] = self.error
+        return entry
+
+
+def current():
+    """The trace of the request this thread is serving, or None."""
+    return getattr(_local, "trace", None)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Add the time spent in the block to the current request's ``name`` phase."""
+    trace = current()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, time.perf_counter() - started)
+
+
+def add(name, seconds):
+    trace = current()
+    if trace is not None:
+        trace.add(name, seconds)
+
+
+def count(key, field, n, ttl):
+    """Add ``n`` to ``field`` of the stats hash ``key``, kept ``ttl`` seconds.
+
+    During a request the counts are sent with its others when it ends;
+    outside one they go straight away. Stats never fail a request.
+    """
+    trace = current()
+    if trace is not None:
+        trace.count(key, field, n, ttl)
+        return
+    try:
+        _kv.BACKEND.pipeline([["HINCRBY", key, field, n], ["EXPIRE", key, ttl]])
+    except Exception:
+        pass
+
+
+def bind(fn):
+    """``fn`` set up to record into the current request's trace from another thread."""
+    trace = current()
+
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        _local.trace = trace
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.trace = None
+    return run
+
+
+def trace_id(headers):
+    """The caller's trace id (X-Trace-Id or a W3C traceparent), else a new one."""
+    given = headers.get("X-Trace-Id", "").strip()
+    if _TRACE_ID.match(given):
+        return given
+    parent = _TRACEPARENT.match(headers.get("traceparent", "").strip())
+    if parent:
+        return parent.group(1)
+    return uuid.uuid4().hex[:16]
+
+
+def _traced(method):
+    @functools.wraps(method)
+    def run(self):
+        if current() is not None:
+            return method(self)  # app.py handing over to the endpoint
+        trace = Trace(trace_id(self.headers), self.command)
+        _local.trace = trace
+        try:
+            return method(self)
+        except BaseException as e:
+            trace.error = type(e).__name__
+            raise
+        finally:
+            _local.trace = None
+            trace.endpoint = urlparse(self.path).path.rstrip("/").rsplit("/", 1)[-1]
+            _finish(trace, self.headers)
+    return run
+
+
+def _finish(trace, headers):
+    entry = trace.record()
+    if TRACE_LOG:
+        vercel_id = headers.get("x-vercel-id")
+        if vercel_id:
+            entry["vercel_id"] = vercel_id
+        print(json.dumps(entry), flush=True)
+    commands = trace.counter_commands()
+    if trace.status != 404 and TRACE_SAMPLE > 0 and random.random() < TRACE_SAMPLE:
+        commands += latency_commands(entry)
+    if commands:
+        try:
+            _kv.BACKEND.pipeline(commands)
+        except Exception:
+            pass  # stats must never fail a request
+
+
+class TracedHandler(BaseHTTPRequestHandler):
+    """Base of the endpoint handlers: traces every do_GET and do_POST.
+
+    A subclass's do_GET/do_POST are wrapped as the class is defined, so
+    the trace starts with whichever handler runs the request, however it
+    was routed there (Vercel, app.py, dev.py or the bench).
+    """
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name in ("do_GET", "do_POST"):
+            if name in cls.__dict__:
+                setattr(cls, name, _traced(cls.__dict__[name]))
+
+    def send_response(self, code, message=None):
+        trace = current()
+        if trace is not None and trace.status is None:
+            trace.status = code
+        super().send_response(code, message)
+
+    def end_headers(self):
+        trace = current()
+        if trace is not None:
+            self.send_header("Server-Timing", trace.server_timing())
+            self.send_header("X-Trace-Id", trace.id)
+        super().end_headers()
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode("utf-8")
+
+
+class StreamingHandler(TracedHandler):
+    """A handler that can answer with JSON or, once _start_stream() ran, SSE events.
+
+    _respond() sends a JSON reply, or after the stream has started the
+    final "result" (or "error") event. A client that hangs up mid-stream
+    doesn't abort the request: the work still finishes, and events after
+    that go nowhere.
+    """
+
+    _streaming = False
+
+    def _respond(self, status, data, retry_after=None):
+        if self._streaming:
+            # Headers are already out; report the outcome as the final event
+            if status == 200:
+                self._send_event("result", data)
+            else:
+                self._send_event("error", dict(data, status=status))
+            return
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if retry_after:
+            self.send_header("Retry-After", str(retry_after))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _start_stream(self):
+        self._streaming = True
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("X-Accel-Buffering", "no")
+        self.end_headers()
+
+    def _send_event(self, event, data):
+        try:
+            self.wfile.write(sse_event(event, data))
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+# --- Latency histograms ---
+# One hash per day, field "<endpoint>:<phase>:<bucket>" -> requests, where
+# bucket is the upper bound in ms ("inf" past the last) and the phase
+# "total" is the whole request.
+
+def latency_stats_key(day):
+    return f"latency:{day}"
+
+
+def _bucket(ms):
+    for bound in LATENCY_BUCKETS:
+        if ms <= bound:
+            return str(bound)
+    return "inf"
+
+
+def latency_commands(entry):
+    """The commands that add a finished request's timings to today's histograms."""
+    key = latency_stats_key(time.strftime("%Y%m%d", time.gmtime()))
+    prefix = f"{entry['endpoint']}:"
+    timings = [("total", entry["ms"])] + [(name, p["ms"]) for name, p in entry["phases"].items()]
+    commands = [["HINCRBY", key, f"{prefix}{name}:{_bucket(ms)}", 1] for name, ms in timings]
+    commands.append(["EXPIRE", key, LATENCY_STATS_TTL])
+    return commands
+
+
+def summarize_latency(totals):
+    """Per endpoint and phase: sampled requests and p50/p90/p99 upper bounds in ms."""
+    counts = {}
+    for field, n in totals.items():
+        endpoint, name, bucket = field.rsplit(":", 2)
+        bound = float("inf") if bucket == "inf" else int(bucket)
+        counts.setdefault(endpoint, {}).setdefault(name, {})[bound] = int(n)
+
+    summary = {}
+    for endpoint, phases in sorted(counts.items()):
+        summary[endpoint] = {}
+        for name, buckets in sorted(phases.items()):
+            total = sum(buckets.values())
+            row = {"samples": total}
+            for label, share in (("p50_ms", 0.5), ("p90_ms", 0.9), ("p99_ms", 0.99)):
+                seen = 0
+                for bound in sorted(buckets):
+                    seen += buckets[bound]
+                    if seen >= share * total:
+                        row[label] = None if bound == float("inf") else bound
+                        break
+            summary[endpoint][name] = row
+    return summary
@@ -0,0 +1,112 @@
+"""Vercel serverless function — player move plus BRAWLBOT's reply in one request.
+
+BRAWLBOT's prompt tells it to ignore what its opponent just did, so its move is
+generated while the player's move is still being refereed.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import sys, os
+sys.path.insert(0, os.path.dirname(__file__))
+
+from _trace import StreamingHandler, bind
+from _shared import (
+    sanitize_name, sanitize_action, referee_turn, opponent_action,
+    RefereeFumbled, DeadlineExceeded, record_llm_usage, request_deadline,
+    client_ip, admit_llm, release, LLM_POOL,
+)
+
+
+def _apply(state, result):
+    """State after a referee result, as the client would track it."""
+    new = dict(state)
+    for k in ("p1_hp", "p2_hp", "situation", "last_action"):
+        new[k] = result["state"][k]
+    for k in ("p1_look", "p2_look"):
+        if result["state"].get(k):
+            new[k] = result["state"][k]
+    return new
+
+
+class handler(StreamingHandler):
+    def do_POST(self):
+        deadline = request_deadline()
+        length = int(self.headers.get("Content-Length", 0))
+        if length > 10240:
+            self._respond(413, {"error": "Request too large"})
+            return
+
+        raw = self.rfile.read(length)
+        try:
+            data = json.loads(raw)
+        except Exception:
+            self._respond(400, {"error": "Invalid JSON"})
+            return
+
+        state = data.get("state")
+        player_name = sanitize_name(str(data.get("player_name", "")))
+        player_num = data.get("player_num")
+        action = sanitize_action(str(data.get("action", "")))
+        ai_name = sanitize_name(str(data.get("ai_name", "BRAWLBOT")))
+
+        if not state or not action or player_num not in (1, 2):
+            self._respond(400, {"error": "Missing or invalid fields"})
+            return
+        ai_num = 2 if player_num == 1 else 1
+
+        lease, retry_after = admit_llm("ai_turn", client_ip(self.headers, self.client_address))
+        if lease is None:
+            self._respond(429, {"error": "The arena is packed. Trying again shortly...",
+                                "retry_after": retry_after}, retry_after)
+            return
+
+        if data.get("stream"):
+            self._start_stream()
+
+        usage = []
+        pool = ThreadPoolExecutor(max_workers=1)
+        try:
+            ai_move = pool.submit(bind(opponent_action), state, ai_name, ai_num, usage, deadline)
+            self._resolve(state, player_name, player_num, action, ai_name, ai_num, ai_move,
+                          usage, deadline)
+        finally:
+            # The response is out by now. A bot move nobody needed still
+            # finishes under this request's lease, and its tokens are counted.
+            pool.shutdown(wait=True)
+            release(LLM_POOL, lease)
+            record_llm_usage("ai_turn", usage)
+
+    def _resolve(self, state, player_name, player_num, action, ai_name, ai_num, ai_move,
+                 usage, deadline):
+        try:
+            player = referee_turn(state, player_name, player_num, action,
+                                  on_event=self._send_event if self._streaming else None,
+                                  usage=usage, deadline=deadline)
+        except RefereeFumbled as e:
+            self._respond(500, {"error": str(e)})
+            return
+        except DeadlineExceeded as e:
+            self._respond(504, {"error": str(e)})
+            return
+        except Exception as e:
+            self._respond(502, {"error": str(e)})
+            return
+
+        if self._streaming:
+            self._send_event("player", player)
+
+        after = _apply(state, player)
+        if after["p1_hp"] <= 0 or after["p2_hp"] <= 0:
+            self._respond(200, {"player": player, "ai": None})
+            return
+
+        try:
+            ai_action = ai_move.result()
+            ai = referee_turn(after, ai_name, ai_num, ai_action, usage=usage, deadline=deadline)
+        except Exception as e:
+            # The player's move stands; the client falls back to /api/opponent
+            self._respond(502, {"error": str(e), "player": player})
+            return
+
+        ai["action"] = ai_action
+        self._respond(200, {"player": player, "ai": ai})
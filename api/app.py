@@ -0,0 +1,86 @@
+"""Vercel serverless function — every endpoint in one function.
+
+Optional layout: deploy with vercel.single.json and all /api/<name>
+requests are rewritten to this function, so they share one warm instance
+along with its connection pools and caches. The URLs stay the same.
+Endpoint modules are imported on first use, so a cold start only pays for
+the code the request needs; the endpoint's handler then serves the request
+on this one's connection (handle_as).
+"""
+
+from urllib.parse import urlparse, parse_qsl, urlencode
+import importlib
+import json
+import threading
+import sys, os
+sys.path.insert(0, os.path.dirname(__file__))
+
+from _trace import TracedHandler
+
+ENDPOINTS = {
+    "ai_turn", "create", "image", "image_proxy", "image_webhook", "join", "looks", "match",
+    "opponent", "poll", "poll_batch", "referee", "stats", "turn", "warm", "watch",
+}
+# The rewrite in vercel.single.json passes the endpoint name in this parameter
+ROUTE_PARAM = "__fn"
+
+_modules = {}
+_import_lock = threading.Lock()
+
+
+def endpoint(name):
+    """The handler class for api/<name>.py, imported on first use."""
+    module = _modules.get(name)
+    if module is None:
+        with _import_lock:
+            module = _modules.get(name) or importlib.import_module(name)
+            _modules[name] = module
+    return module.handler
+
+
+def handle_as(cls, request, method):
+    """Serve the request ``request`` has read with ``cls``'s ``method``.
+
+    A ``cls`` handler is made to share the connection, the request line and
+    the headers, without handling anything of its own; ``request`` only
+    takes back whether to keep the connection open.
+    """
+    delegate = cls.__new__(cls)
+    delegate.__dict__.update(request.__dict__)
+    try:
+        getattr(delegate, method)()
+    finally:
+        request.close_connection = delegate.close_connection
+
+
+class handler(TracedHandler):
+    def do_GET(self):
+        self._dispatch("do_GET")
+
+    def do_POST(self):
+        self._dispatch("do_POST")
+
+    def _dispatch(self, method):
+        url = urlparse(self.path)
+        params = parse_qsl(url.query, keep_blank_values=True)
+        name = dict(params).get(ROUTE_PARAM) or url.path.rstrip("/").rsplit("/", 1)[-1]
+        if name not in ENDPOINTS:
+            self._respond(404, {"error": "Not found"})
+            return
+
+        # The endpoint sees the URL the client asked for
+        query = urlencode([(k, v) for k, v in params if k != ROUTE_PARAM])
+        self.path = f"/api/{name}" + (f"?{query}" if query else "")
+        cls = endpoint(name)
+        if not hasattr(cls, method):
+            self._respond(405, {"error": "Method not allowed"})
+            return
+        handle_as(cls, self, method)
+
+    def _respond(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
@@ -1,15 +1,14 @@
 """Vercel serverless function — create online game."""
 
-from http.server import BaseHTTPRequestHandler
 import json
-import time
 import sys, os
 sys.path.insert(0, os.path.dirname(__file__))
 
-from _shared import kv_set, kv_get, generate_code, sanitize_name
+from _trace import TracedHandler
+from _shared import create_game, new_game, sanitize_name
 
 
-class handler(BaseHTTPRequestHandler):
+class handler(TracedHandler):
     def do_POST(self):
         length = int(self.headers.get("Content-Length", 0))
         if length > 4096:
@@ -24,37 +23,14 @@ class handler(BaseHTTPRequestHandler):
 
         player_name = sanitize_name(str(data.get("player_name", "")))
 
-        # Generate unique code (retry up to 10 times)
-        code = None
-        for _ in range(10):
-            candidate = generate_code()
-            existing = kv_get(f"game:{candidate}")
-            if existing is None:
-                code = candidate
-                break
+        game = new_game(player_name)
 
+        # Claims a free code and writes the game in one atomic step
+        code = create_game(game)
         if code is None:
             self._respond(500, {"error": "Could not generate unique code"})
             return
 
-        game = {
-            "code": code,
-            "p1_name": player_name,
-            "p2_name": None,
-            "p1_hp": 100,
-            "p2_hp": 100,
-            "situation": "An open arena, untouched and waiting for chaos.",
-            "last_action": "None yet. This is the first move!",
-            "turn": 1,
-            "current_player": 1,
-            "status": "waiting",
-            "narrative": None,
-            "scene": None,
-            "last_updated": time.time(),
-        }
-
-        kv_set(f"game:{code}", game, ex=3600)
-
         self._respond(200, {"code": code, "player_num": 1, "game": game})
 
     def _respond(self, status, data):
@@ -1,19 +1,26 @@
-"""Vercel serverless function — generate image via Replicate FLUX-schnell."""
+"""Vercel serverless function — generate image via Replicate FLUX-schnell.
+
+POST {"prompt", "looks": [p1_look, p2_look]} returns {"image_url"}: the
+cached image for that prompt and looks when there is one, else a new one,
+copied into the image cache (see _shared) before it is returned. With
+"preview": true it is the quick low-resolution version, which the client
+asks for alongside the full one and shows until that arrives.
+"""
 
-from http.server import BaseHTTPRequestHandler
 import json
-import os
 import time
-import urllib.request
-import urllib.error
-
-REPLICATE_API_TOKEN = os.environ.get("REPLICATE_API_TOKEN", "")
-REPLICATE_MODEL_URL = "https://api.replicate.com/v1/models/black-forest-labs/flux-schnell/predictions"
+import sys, os
+sys.path.insert(0, os.path.dirname(__file__))
 
-IMAGE_STYLE_SUFFIX = "chaotic cartoon battle art, indie game style, exaggerated proportions, dynamic action pose, dark arena setting, vibrant saturated colors, warm fire accents, slightly rough and messy rendering, fun and over-the-top, comic book energy, no text, no watermark"
+from _trace import TracedHandler, phase
+from _shared import (
+    REPLICATE_API_TOKEN, create_prediction, get_prediction, prediction_image_url, client_ip,
+    admit_image, release, image_key, cached_image, store_image, IMAGE_POOL, IMAGE_PREVIEW,
+)
+from _http import HTTPStatusError
 
 
-class handler(BaseHTTPRequestHandler):
+class handler(TracedHandler):
     def do_POST(self):
         length = int(self.headers.get("Content-Length", 0))
         if length > 4096:
@@ -31,44 +38,43 @@ class handler(BaseHTTPRequestHandler):
             self._respond(400, {"error": "Missing prompt"})
             return
 
+        preview = data.get("preview") is True
+        if preview and not IMAGE_PREVIEW:
+            self._respond(404, {"error": "Previews are turned off"})
+            return
+
+        looks = data.get("looks")
+        if not isinstance(looks, list):
+            looks = []
+        key = image_key(prompt, [str(look) for look in looks[:2]], preview)
+        cached = cached_image(key)
+        if cached:
+            self._respond(200, {"image_url": cached})
+            return
+
         if not REPLICATE_API_TOKEN:
             self._respond(500, {"error": "Image generation not configured"})
             return
 
-        styled_prompt = f"{prompt} {IMAGE_STYLE_SUFFIX}"
-
-        # Create prediction
-        body = json.dumps({
-            "input": {
-                "prompt": styled_prompt,
-                "num_outputs": 1,
-                "aspect_ratio": "16:9",
-                "output_format": "webp",
-                "output_quality": 80,
-            }
-        }).encode("utf-8")
-
-        req = urllib.request.Request(
-            REPLICATE_MODEL_URL,
-            data=body,
-            headers={
-                "Authorization": f"Bearer {REPLICATE_API_TOKEN}",
-                "Content-Type": "application/json",
-                "Prefer": "wait",  # Sync mode — waits for result
-            },
-            method="POST",
-        )
+        # Refused under load; the client falls back to the ASCII scene
+        lease, retry_after = admit_image(client_ip(self.headers, self.client_address))
+        if lease is None:
+            self._respond(429, {"error": "Too busy for pictures right now"}, retry_after)
+            return
+        try:
+            self._generate(prompt, key, preview)
+        finally:
+            release(IMAGE_POOL, lease)
 
+    def _generate(self, prompt, key, preview):
         try:
-            with urllib.request.urlopen(req, timeout=60) as resp:
-                result = json.loads(resp.read().decode("utf-8"))
+            # Sync mode — Replicate waits for the result
+            result = create_prediction(prompt, wait=True, preview=preview)
 
             # With Prefer: wait, output should be ready
-            output = result.get("output")
-            if output and isinstance(output, list) and len(output) > 0:
-                # Output items can be strings (URLs) or objects with .url()
-                image_url = output[0] if isinstance(output[0], str) else str(output[0])
-                self._respond(200, {"image_url": image_url})
+            image_url = prediction_image_url(result)
+            if image_url:
+                self._respond(200, {"image_url": store_image(key, image_url)})
                 return
 
             # If not ready (shouldn't happen with Prefer: wait), poll
@@ -79,20 +85,15 @@ class handler(BaseHTTPRequestHandler):
 
             # Poll up to 30 seconds
             for _ in range(15):
-                time.sleep(2)
-                poll_req = urllib.request.Request(
-                    poll_url,
-                    headers={"Authorization": f"Bearer {REPLICATE_API_TOKEN}"},
-                )
-                with urllib.request.urlopen(poll_req, timeout=10) as poll_resp:
-                    poll_result = json.loads(poll_resp.read().decode("utf-8"))
+                with phase("image_wait"):
+                    time.sleep(2)
+                poll_result = get_prediction(poll_url)
 
                 status = poll_result.get("status")
                 if status == "succeeded":
-                    output = poll_result.get("output", [])
-                    if output:
-                        image_url = output[0] if isinstance(output[0], str) else str(output[0])
-                        self._respond(200, {"image_url": image_url})
+                    image_url = prediction_image_url(poll_result)
+                    if image_url:
+                        self._respond(200, {"image_url": store_image(key, image_url)})
                         return
                 elif status == "failed":
                     self._respond(500, {"error": "Image generation failed"})
@@ -100,16 +101,18 @@ class handler(BaseHTTPRequestHandler):
 
             self._respond(504, {"error": "Image generation timed out"})
 
-        except urllib.error.HTTPError as e:
-            error_body = e.read().decode("utf-8", errors="replace")
-            self._respond(e.code, {"error": f"Replicate API error: {error_body[:200]}"})
+        except HTTPStatusError as e:
+            error_body = e.body.decode("utf-8", errors="replace")
+            self._respond(e.status, {"error": f"Replicate API error: {error_body[:200]}"})
         except Exception as e:
             self._respond(500, {"error": str(e)[:200]})
 
-    def _respond(self, status, data):
+    def _respond(self, status, data, retry_after=None):
         body = json.dumps(data).encode("utf-8")
         self.send_response(status)
         self.send_header("Content-Type", "application/json")
         self.send_header("Content-Length", str(len(body)))
+        if retry_after:
+            self.send_header("Retry-After", str(retry_after))
         self.end_headers()
         self.wfile.write(body)
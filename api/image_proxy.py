@@ -0,0 +1,62 @@
+"""Vercel serverless function — serve a cached battle image.
+
+GET ?key=<hash> answers with the image stored under that hash (see the
+image cache in _shared). What a hash points to never changes, so the edge
+and browsers keep the answer for good and the function sees about one
+request per image per edge region. A key with no image yet is a 404 that
+nobody caches, since the image may be on its way.
+"""
+
+from urllib.parse import urlparse, parse_qs
+import json
+import sys, os
+sys.path.insert(0, os.path.dirname(__file__))
+
+from _trace import TracedHandler
+from _shared import load_image, IMAGE_KEY_RE
+
+IMAGE_CACHE = "public, max-age=31536000, s-maxage=31536000, immutable"
+
+
+class handler(TracedHandler):
+    def do_GET(self):
+        params = parse_qs(urlparse(self.path).query)
+        key = params.get("key", [""])[0].strip().lower()
+        if not IMAGE_KEY_RE.match(key):
+            self._respond(400, {"error": "Invalid image key"})
+            return
+
+        etag = f'"{key}"'
+        if etag in (t.strip().removeprefix("W/") for t in self.headers.get("If-None-Match", "").split(",")):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", IMAGE_CACHE)
+            self.end_headers()
+            return
+
+        try:
+            image = load_image(key)
+        except Exception as e:
+            self._respond(502, {"error": str(e)[:200]})
+            return
+        if image is None:
+            self._respond(404, {"error": "Image not found"})
+            return
+
+        data, content_type = image
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Cache-Control", IMAGE_CACHE)
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _respond(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(body)
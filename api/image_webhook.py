@@ -0,0 +1,118 @@
+"""Vercel serverless function — Replicate webhook for turn images.
+
+?tier=preview marks the quick preview: it is shown while the full image
+is still pending and never replaces it. A call must carry Replicate's
+signature when REPLICATE_WEBHOOK_SECRET is set; without one, the ?token=
+the turn put in the URL (its image_token) has to match instead.
+"""
+
+from urllib.parse import urlparse, parse_qs
+import hmac
+import json
+import time
+import sys, os
+sys.path.insert(0, os.path.dirname(__file__))
+
+from _trace import TracedHandler
+from _shared import (
+    update_game, load_game, prediction_image_url, verify_replicate_webhook, release, image_lease,
+    store_image, image_key, valid_code, IMAGE_POOL, REPLICATE_WEBHOOK_SECRET,
+)
+
+
+class handler(TracedHandler):
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if length > 65536:
+            self._respond(413, {"error": "Request too large"})
+            return
+
+        raw = self.rfile.read(length)
+        signed = verify_replicate_webhook(self.headers, raw)
+        if REPLICATE_WEBHOOK_SECRET and not signed:
+            self._respond(401, {"error": "Bad signature"})
+            return
+
+        try:
+            prediction = json.loads(raw)
+        except Exception:
+            self._respond(400, {"error": "Invalid JSON"})
+            return
+
+        params = parse_qs(urlparse(self.path).query)
+        code = (params.get("code", [""])[0]).strip().upper()
+        try:
+            turn = int(params.get("turn", [""])[0])
+        except ValueError:
+            turn = None
+        if turn is None or not valid_code(code):
+            self._respond(400, {"error": "Missing or invalid fields"})
+            return
+        preview = params.get("tier", [""])[0] == "preview"
+        token = params.get("token", [""])[0]
+
+        status = prediction.get("status")
+        if status not in ("succeeded", "failed", "canceled"):
+            self._respond(200, {"ok": True})
+            return
+
+        # Replicate can beat the turn's own writes (the turn, then its job
+        # ids); give them a moment to land
+        field = "image_preview_job" if preview else "image_job"
+        game = None
+        for _ in range(10):
+            game = load_game(code)
+            if game is None or game.get("turn", 0) > turn or (game.get("turn") == turn and game.get(field)):
+                break
+            time.sleep(0.3)
+
+        current = game is not None and game.get("turn") == turn
+        if not signed and not (current and token and hmac.compare_digest(token, game.get("image_token") or "")):
+            if current:
+                self._respond(401, {"error": "Bad token"})
+            else:
+                # Too late to check the token; the job's lease runs out on its own
+                self._respond(200, {"ok": True, "stale": True})
+            return
+        release(IMAGE_POOL, image_lease(code, turn, preview))
+
+        # Acknowledge stale or unknown jobs so Replicate doesn't retry them
+        job = prediction.get("id")
+        if not current or game.get(field) != job:
+            self._respond(200, {"ok": True, "stale": True})
+            return
+
+        image_url = prediction_image_url(prediction) if status == "succeeded" else None
+        if preview:
+            self._preview(game, turn, job, image_url)
+            return
+        if image_url and game.get("image_key"):
+            image_url = store_image(game["image_key"], image_url)
+        # A failed render leaves the preview up, if there is one
+        changes = {"image_status": "ready" if image_url else "failed", "last_updated": time.time()}
+        if image_url:
+            changes["image_url"] = image_url
+
+        # Only lands if no newer turn was committed since we read the game
+        update_game(game, changes, lambda g: g.get("turn") == turn and g.get("image_job") == job)
+
+        self._respond(200, {"ok": True})
+
+    def _preview(self, game, turn, job, image_url):
+        if not image_url or game.get("image_status") != "pending":
+            self._respond(200, {"ok": True})  # failed, or the full image won the race
+            return
+        looks = [game.get("p1_look", ""), game.get("p2_look", "")]
+        image_url = store_image(image_key(game.get("image_prompt", ""), looks, preview=True), image_url)
+        changes = {"image_url": image_url, "image_status": "preview", "last_updated": time.time()}
+        update_game(game, changes, lambda g: (g.get("turn") == turn and g.get("image_preview_job") == job
+                                              and g.get("image_status") == "pending"))
+        self._respond(200, {"ok": True})
+
+    def _respond(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
@@ -1,15 +1,19 @@
-"""Vercel serverless function — join online game."""
+"""Vercel serverless function — join online game.
+
+Once player 2 has the answer, their client asks /api/looks for the
+fighters' looks while player 1 types the first move.
+"""
 
-from http.server import BaseHTTPRequestHandler
 import json
 import time
 import sys, os
 sys.path.insert(0, os.path.dirname(__file__))
 
-from _shared import kv_set, kv_get, sanitize_name
+from _trace import TracedHandler
+from _shared import update_game, load_game, sanitize_name, valid_code
 
 
-class handler(BaseHTTPRequestHandler):
+class handler(TracedHandler):
     def do_POST(self):
         length = int(self.headers.get("Content-Length", 0))
         if length > 4096:
@@ -25,11 +29,11 @@ class handler(BaseHTTPRequestHandler):
         code = str(data.get("code", "")).strip().upper()
         player_name = sanitize_name(str(data.get("player_name", "")))
 
-        if not code or len(code) != 6:
+        if not valid_code(code):
             self._respond(400, {"error": "Invalid game code"})
             return
 
-        game = kv_get(f"game:{code}")
+        game = load_game(code)
         if game is None:
             self._respond(404, {"error": "Game not found. Check the code and try again."})
             return
@@ -38,11 +42,11 @@ class handler(BaseHTTPRequestHandler):
             self._respond(409, {"error": "Game is already full."})
             return
 
-        game["p2_name"] = player_name
-        game["status"] = "active"
-        game["last_updated"] = time.time()
-
-        kv_set(f"game:{code}", game, ex=3600)
+        changes = {"p2_name": player_name, "status": "active", "last_updated": time.time()}
+        game = update_game(game, changes, lambda g: g.get("p2_name") is None)
+        if game is None:
+            self._respond(409, {"error": "Game is already full."})
+            return
 
         self._respond(200, {"player_num": 2, "game": game})
 
@@ -0,0 +1,54 @@
+"""Vercel serverless function — invent a new game's looks.
+
+The player whose join (or quick match) made the game active fires this
+as soon as they have the answer, so the fighters' looks are invented in a
+request of their own while player 1 types the first move (see add_looks).
+Only the first call for a game does any work.
+"""
+
+import json
+import sys, os
+sys.path.insert(0, os.path.dirname(__file__))
+
+from _trace import TracedHandler
+from _shared import load_game, valid_code, add_looks, record_llm_usage
+
+
+class handler(TracedHandler):
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if length > 4096:
+            self._respond(413, {"error": "Request too large"})
+            return
+
+        try:
+            data = json.loads(self.rfile.read(length))
+        except Exception:
+            self._respond(400, {"error": "Invalid JSON"})
+            return
+
+        code = str(data.get("code", "")).strip().upper()
+        if not valid_code(code):
+            self._respond(400, {"error": "Invalid game code"})
+            return
+
+        game = load_game(code)
+        if game is None:
+            self._respond(404, {"error": "Game not found"})
+            return
+
+        usage = []
+        try:
+            game = add_looks(game, usage)
+        finally:
+            record_llm_usage("looks", usage)
+        self._respond(200, {"looks": bool(game.get("p1_look"))})
+
+    def _respond(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(body)
@@ -0,0 +1,103 @@
+"""Vercel serverless function — quick match against whoever is waiting.
+
+POST {"player_name"} pairs the player with the longest-waiting one and
+returns the new game (as player 2), or queues them and returns a ticket.
+GET ?ticket=&wait=25 long-polls a queued ticket until it is paired, and
+must be repeated to stay in the queue. POST {"ticket", "cancel": true}
+leaves the queue. The player who made the pairing then asks /api/looks
+for the fighters' looks.
+"""
+
+from urllib.parse import urlparse, parse_qs
+import json
+import re
+import sys, os
+sys.path.insert(0, os.path.dirname(__file__))
+
+from _trace import TracedHandler
+from _shared import (
+    quick_match, wait_for_match, cancel_match, load_game, sanitize_name, LONG_POLL_MAX,
+)
+
+TICKET_RE = re.compile(r"^[0-9a-f]{16}$")
+
+
+class handler(TracedHandler):
+    def do_GET(self):
+        params = parse_qs(urlparse(self.path).query)
+        ticket = params.get("ticket", [""])[0].strip()
+        if not TICKET_RE.match(ticket):
+            self._respond(400, {"error": "Invalid ticket"})
+            return
+        try:
+            wait = max(0.0, min(float(params.get("wait", ["0"])[0]), LONG_POLL_MAX))
+        except ValueError:
+            wait = 0
+
+        try:
+            state = wait_for_match(ticket, wait)
+        except Exception as e:
+            self._respond(502, {"error": str(e)})
+            return
+        if state is None:
+            self._respond(404, {"error": "Not in the queue any more. Try again."})
+            return
+        if "code" in state:
+            self._matched(state["code"])
+            return
+        self._respond(200, dict(state, matched=False, ticket=ticket))
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if length > 4096:
+            self._respond(413, {"error": "Request too large"})
+            return
+
+        try:
+            data = json.loads(self.rfile.read(length))
+        except Exception:
+            self._respond(400, {"error": "Invalid JSON"})
+            return
+
+        if data.get("cancel"):
+            ticket = str(data.get("ticket", ""))
+            if not TICKET_RE.match(ticket):
+                self._respond(400, {"error": "Invalid ticket"})
+                return
+            try:
+                code = cancel_match(ticket)
+            except Exception as e:
+                self._respond(502, {"error": str(e)})
+                return
+            if code:
+                self._matched(code)
+            elif code == "":
+                # Too late to leave: the game is being set up
+                self._respond(200, {"matched": False, "cancelled": False, "ticket": ticket})
+            else:
+                self._respond(200, {"matched": False, "cancelled": True})
+            return
+
+        player_name = sanitize_name(str(data.get("player_name", "")))
+        try:
+            result = quick_match(player_name)
+        except Exception as e:
+            self._respond(500, {"error": str(e)})
+            return
+        self._respond(200, result)
+
+    def _matched(self, code):
+        game = load_game(code)
+        if game is None:
+            self._respond(404, {"error": "Game not found or expired"})
+            return
+        self._respond(200, {"matched": True, "code": code, "player_num": 1, "game": game})
+
+    def _respond(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(body)
@@ -1,39 +1,75 @@
 """Vercel serverless function — poll game state."""
 
-from http.server import BaseHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs
 import json
+import math
 import sys, os
 sys.path.insert(0, os.path.dirname(__file__))
 
-from _shared import kv_get
+from _trace import TracedHandler
+from _shared import (
+    load_game_header, load_game_patch, cached_game, wait_for_change, valid_code, public_game,
+    LONG_POLL_MAX, PUBLIC_FIELDS,
+)
 
 
-class handler(BaseHTTPRequestHandler):
+class handler(TracedHandler):
     def do_GET(self):
         params = parse_qs(urlparse(self.path).query)
         code = (params.get("code", [""])[0]).strip().upper()
         since = params.get("since", [None])[0]
+        delta = params.get("delta", [""])[0] == "1"
 
-        if not code:
-            self._respond(400, {"error": "Missing code"})
+        if not valid_code(code):
+            self._respond(400, {"error": "Invalid game code"})
             return
 
-        game = kv_get(f"game:{code}")
-        if game is None:
+        try:
+            seen = int(params.get("v", [""])[0])
+        except ValueError:
+            seen = None
+        try:
+            wait = float(params.get("wait", ["0"])[0])
+        except ValueError:
+            wait = 0
+        wait = 0 if math.isnan(wait) else max(0.0, min(wait, LONG_POLL_MAX))
+
+        # Only the small header is read until something changed.
+        # Long-poll: hold the request until the version moves past ?v=
+        if seen is not None and wait > 0:
+            header = wait_for_change(code, seen, wait)
+        else:
+            header = load_game_header(code)
+        if header is None:
             self._respond(404, {"error": "Game not found or expired"})
             return
 
+        if seen is not None and header.get("version") == seen:
+            self._respond(200, {"changed": False, "version": seen})
+            return
+
         if since:
             try:
                 since_ts = float(since)
-                if game.get("last_updated", 0) < since_ts + 0.001:
+                if header.get("last_updated", 0) < since_ts + 0.001:
                     self._respond(200, {"changed": False})
                     return
             except (ValueError, TypeError):
                 pass
 
-        self._respond(200, {"changed": True, "game": game})
+        # Clients that know version ?v= get just the fields that moved since
+        version = header.get("version")
+        if delta and seen is not None and version is not None:
+            patch = load_game_patch(code, seen, version)
+            if patch is not None:
+                changed, removed = patch
+                self._respond(200, {"changed": True, "version": version,
+                                    "patch": public_game(changed),
+                                    "unset": [k for k in removed if k in PUBLIC_FIELDS]})
+                return
+
+        game = cached_game(code, header)
+        self._respond(200, {"changed": True, "game": public_game(game)})
 
     def _respond(self, status, data):
         body = json.dumps(data).encode("utf-8")
@@ -0,0 +1,60 @@
+"""Vercel serverless function — poll many games at once.
+
+POST {"games": {"<code>": <last version seen, or null>, ...}, "full": true}
+returns {"games": {"<code>": game}, "missing": [...]} with only the games
+whose version moved, read with one MGET rather than a poll per game.
+"full": false sends just the headers (names, HP, turn, status), which
+skips reading the bodies altogether.
+"""
+
+import json
+import sys, os
+sys.path.insert(0, os.path.dirname(__file__))
+
+from _trace import TracedHandler
+from _shared import load_games, valid_code, public_game, POLL_BATCH_MAX
+
+
+class handler(TracedHandler):
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if length > 16384:
+            self._respond(413, {"error": "Request too large"})
+            return
+
+        try:
+            data = json.loads(self.rfile.read(length))
+            games = data["games"]
+            if not isinstance(games, dict):
+                raise TypeError
+        except Exception:
+            self._respond(400, {"error": "Expected {\"games\": {code: version}}"})
+            return
+        if len(games) > POLL_BATCH_MAX:
+            self._respond(400, {"error": f"At most {POLL_BATCH_MAX} games per request"})
+            return
+
+        seen = {}
+        for code, version in games.items():
+            code = str(code).strip().upper()
+            if not valid_code(code):
+                self._respond(400, {"error": f"Invalid game code: {code}"})
+                return
+            seen[code] = version if type(version) is int else None
+
+        try:
+            changed, missing = load_games(seen, full=data.get("full", True) is not False)
+        except Exception as e:
+            self._respond(502, {"error": str(e)})
+            return
+        games = {code: public_game(game) for code, game in changed.items()}
+        self._respond(200, {"games": games, "missing": missing})
+
+    def _respond(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(body)
@@ -1,18 +1,20 @@
 """Vercel serverless function — referee endpoint."""
 
-from http.server import BaseHTTPRequestHandler
 import json
 import sys, os
 sys.path.insert(0, os.path.dirname(__file__))
 
+from _trace import StreamingHandler
 from _shared import (
-    call_deepseek, parse_response, sanitize_name, sanitize_action,
-    clamp_hp, build_turn_prompt, REFEREE_PROMPT,
+    sanitize_name, sanitize_action, referee_turn, RefereeFumbled, DeadlineExceeded,
+    record_llm_usage, request_deadline,
+    client_ip, admit_llm, release, LLM_POOL,
 )
 
 
-class handler(BaseHTTPRequestHandler):
+class handler(StreamingHandler):
     def do_POST(self):
+        deadline = request_deadline()
         length = int(self.headers.get("Content-Length", 0))
         if length > 10240:
             self._respond(413, {"error": "Request too large"})
@@ -34,43 +36,35 @@ class handler(BaseHTTPRequestHandler):
             self._respond(400, {"error": "Missing or invalid fields"})
             return
 
-        p1_hp = state.get("p1_hp", 100)
-        p2_hp = state.get("p2_hp", 100)
+        lease, retry_after = admit_llm("referee", client_ip(self.headers, self.client_address))
+        if lease is None:
+            self._respond(429, {"error": "The arena is packed. Trying again shortly...",
+                                "retry_after": retry_after}, retry_after)
+            return
+
+        if data.get("stream"):
+            self._start_stream()
 
-        turn_prompt = build_turn_prompt(state, player_name, player_num, action)
+        usage = []
+        try:
+            self._referee(state, player_name, player_num, action, usage, deadline)
+        finally:
+            release(LLM_POOL, lease)
+            record_llm_usage("referee", usage)
 
+    def _referee(self, state, player_name, player_num, action, usage, deadline):
         try:
-            response = call_deepseek(REFEREE_PROMPT, turn_prompt)
+            result = referee_turn(state, player_name, player_num, action,
+                                  on_event=self._send_event if self._streaming else None,
+                                  usage=usage, deadline=deadline)
+        except RefereeFumbled as e:
+            self._respond(500, {"error": str(e)})
+            return
+        except DeadlineExceeded as e:
+            self._respond(504, {"error": str(e)})
+            return
         except Exception as e:
             self._respond(502, {"error": str(e)})
             return
 
-        narrative, scene, state_update = parse_response(response)
-        if state_update is None:
-            self._respond(500, {"error": "Referee fumbled — could not parse response"})
-            return
-
-        new_p1, new_p2 = clamp_hp(p1_hp, p2_hp, state_update)
-
-        self._respond(200, {
-            "narrative": narrative,
-            "scene": scene,
-            "state": {
-                "p1_hp": new_p1,
-                "p2_hp": new_p2,
-                "situation": state_update.get("situation", ""),
-                "last_action": state_update.get("last_action", ""),
-                "image_safe": state_update.get("image_safe", False),
-                "image_prompt": state_update.get("image_prompt", ""),
-                "p1_look": state_update.get("p1_look", ""),
-                "p2_look": state_update.get("p2_look", ""),
-            },
-        })
-
-    def _respond(self, status, data):
-        body = json.dumps(data).encode("utf-8")
-        self.send_response(status)
-        self.send_header("Content-Type", "application/json")
-        self.send_header("Content-Length", str(len(body)))
-        self.end_headers()
-        self.wfile.write(body)
+        self._respond(200, result)
@@ -0,0 +1,105 @@
+"""Vercel serverless function — usage stats (admin only).
+
+GET /api/stats?days=7 with "Authorization: Bearer $ADMIN_TOKEN". "codes"
+has game code allocations and collisions over the same days, and "match"
+quick-match traffic, wait times and the queue's current depth. "latency"
+has per-phase percentiles of the requests sampled by TRACE_SAMPLE, and
+"admission" the requests and images turned away under load plus the
+leases held now. "backends"
+is the health of each LLM backend and "game_cache" the warm game cache's
+counters, both as seen by the instance that answered.
+"""
+
+from urllib.parse import urlparse, parse_qs
+import hmac
+import json
+import time
+import sys, os
+sys.path.insert(0, os.path.dirname(__file__))
+
+from _trace import TracedHandler, latency_stats_key, summarize_latency
+from _shared import (
+    kv_pipeline, llm_stats_key, summarize_llm_stats, code_stats_key, summarize_code_stats,
+    match_stats_key, summarize_match_stats, admit_stats_key, summarize_admit_stats, game_cache,
+    LLM_STATS_TTL, MATCH_QUEUE, LLM_POOL, IMAGE_POOL,
+)
+import _llm
+
+MAX_DAYS = LLM_STATS_TTL // 86400
+
+
+def _sum_hashes(hashes):
+    """Add up flat HGETALL replies field by field."""
+    totals = {}
+    for flat in hashes:
+        flat = flat or []
+        for name, value in zip(flat[::2], flat[1::2]):
+            totals[name] = totals.get(name, 0) + int(value)
+    return totals
+
+
+class handler(TracedHandler):
+    def do_GET(self):
+        admin_token = os.environ.get("ADMIN_TOKEN", "")
+        auth = self.headers.get("Authorization", "")
+        if not admin_token or not hmac.compare_digest(auth, f"Bearer {admin_token}"):
+            self._respond(401, {"error": "Unauthorized"})
+            return
+
+        params = parse_qs(urlparse(self.path).query)
+        try:
+            days = max(1, min(int(params.get("days", ["7"])[0]), MAX_DAYS))
+        except ValueError:
+            days = 7
+
+        now = time.time()
+        dates = [time.strftime("%Y%m%d", time.gmtime(now - i * 86400)) for i in range(days)]
+        try:
+            hashes = kv_pipeline([["HGETALL", llm_stats_key(d)] for d in dates]
+                                 + [["HGETALL", code_stats_key(d)] for d in dates]
+                                 + [["HGETALL", match_stats_key(d)] for d in dates]
+                                 + [["HGETALL", latency_stats_key(d)] for d in dates]
+                                 + [["HGETALL", admit_stats_key(d)] for d in dates]
+                                 + [["ZCARD", MATCH_QUEUE], ["ZCARD", LLM_POOL], ["ZCARD", IMAGE_POOL]])
+        except Exception as e:
+            self._respond(502, {"error": str(e)})
+            return
+
+        image_leases = hashes.pop() or 0
+        llm_leases = hashes.pop() or 0
+        depth = hashes.pop() or 0
+        code_totals = _sum_hashes(hashes[len(dates):2 * len(dates)])
+        match_totals = _sum_hashes(hashes[2 * len(dates):3 * len(dates)])
+        latency_totals = _sum_hashes(hashes[3 * len(dates):4 * len(dates)])
+        admit_totals = _sum_hashes(hashes[4 * len(dates):])
+
+        by_day = {}
+        totals = {}
+        for day, flat in zip(dates, hashes[:len(dates)]):
+            # Upstash returns HGETALL as a flat [field, value, ...] list
+            fields = dict(zip(flat[::2], flat[1::2])) if flat else {}
+            if not fields:
+                continue
+            by_day[day] = summarize_llm_stats(fields)
+            for name, value in fields.items():
+                totals[name] = totals.get(name, 0) + int(value)
+
+        self._respond(200, {
+            "days": by_day,
+            "total": summarize_llm_stats(totals),
+            "codes": summarize_code_stats(code_totals),
+            "match": summarize_match_stats(match_totals, depth),
+            "latency": summarize_latency(latency_totals),
+            "admission": summarize_admit_stats(admit_totals, llm_leases, image_leases),
+            "backends": _llm.status(),
+            "game_cache": game_cache.status(),
+        })
+
+    def _respond(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(body)
@@ -1,19 +1,34 @@
 """Vercel serverless function — submit turn in online game."""
 
-from http.server import BaseHTTPRequestHandler
 import json
 import time
 import sys, os
 sys.path.insert(0, os.path.dirname(__file__))
 
+from _trace import StreamingHandler
 from _shared import (
-    kv_set, kv_get, sanitize_action, call_deepseek, parse_response,
-    clamp_hp, build_turn_prompt, REFEREE_PROMPT, generate_image,
+    update_game, begin_turn, sanitize_action, sanitize_request_id, referee_turn,
+    RefereeFumbled, DeadlineExceeded, kv_release_lock, start_image_job,
+    image_webhook_url, record_llm_usage, request_deadline, client_ip,
+    admit_image, release, image_lease, image_key, cached_images, image_token, public_game,
+    LLM_POOL, IMAGE_POOL, IMAGE_PREVIEW,
 )
 
+# Longer than the function's maxDuration, so a crashed turn can't wedge a game
+TURN_LEASE = 150
 
-class handler(BaseHTTPRequestHandler):
+# begin_turn()'s answers for a move that can't be played
+NOT_PLAYABLE = {
+    "missing": (404, "Game not found"),
+    "finished": (400, "Game is already over"),
+    "waiting": (400, "Game hasn't started yet"),
+    "turn": (400, "Not your turn"),
+}
+
+
+class handler(StreamingHandler):
     def do_POST(self):
+        deadline = request_deadline()
         length = int(self.headers.get("Content-Length", 0))
         if length > 10240:
             self._respond(413, {"error": "Request too large"})
@@ -33,80 +48,165 @@ class handler(BaseHTTPRequestHandler):
             self._respond(400, {"error": "Missing or invalid fields"})
             return
 
-        game = kv_get(f"game:{code}")
-        if game is None:
-            self._respond(404, {"error": "Game not found"})
+        # A retried submission gets the result of the one that already ran.
+        # Otherwise the lock is taken, the move checked, and only then is it
+        # charged to the caller and the game, all in one round trip.
+        request_id = sanitize_request_id(str(data.get("request_id", "")))
+        result_key = f"turnreq:{code}:{request_id}" if request_id else None
+        lock_key = f"turnlock:{code}"
+        outcome, game, lock = begin_turn(code, player_num, result_key, lock_key, TURN_LEASE,
+                                         client_ip(self.headers, self.client_address))
+        if outcome == "done":
+            self._respond(200, {"game": public_game(game)})
             return
-
-        if game.get("status") == "finished":
-            self._respond(400, {"error": "Game is already over"})
+        if outcome == "busy":
+            self._respond(409, {"error": "Turn already in progress", "in_progress": True})
             return
-
-        if game.get("status") != "active":
-            self._respond(400, {"error": "Game hasn't started yet"})
+        if outcome == "refused":
+            self._respond(429, {"error": "The arena is packed. Trying again shortly...",
+                                "retry_after": game}, game)
+            return
+        if outcome in NOT_PLAYABLE:
+            status, error = NOT_PLAYABLE[outcome]
+            self._respond(status, {"error": error})
             return
 
-        if game.get("current_player") != player_num:
-            self._respond(400, {"error": "Not your turn"})
+        usage = []
+        try:
+            game = self._referee_turn(game, data, player_num, action, result_key, usage, deadline)
+        finally:
+            kv_release_lock(lock_key, lock, LLM_POOL)
+            record_llm_usage("turn", usage)
+        if game is None:
             return
 
-        player_name = game.get(f"p{player_num}_name", f"Player {player_num}")
-        p1_hp = game.get("p1_hp", 100)
-        p2_hp = game.get("p2_hp", 100)
+        # The turn is in and its lock and LLM slot are free before any image work
+        if game.get("image_token"):
+            game = self._start_images(game, code)
+        self._respond(200, {"game": public_game(game)})
 
-        turn_prompt = build_turn_prompt(game, player_name, player_num, action)
+    def _referee_turn(self, game, data, player_num, action, result_key, usage, deadline):
+        player_name = game.get(f"p{player_num}_name", f"Player {player_num}")
+        if data.get("stream"):
+            self._start_stream()
 
         try:
-            response = call_deepseek(REFEREE_PROMPT, turn_prompt)
+            result = referee_turn(game, player_name, player_num, action,
+                                  on_event=self._send_event if self._streaming else None,
+                                  usage=usage, deadline=deadline)
+        except RefereeFumbled as e:
+            self._respond(500, {"error": str(e)})
+            return
+        except DeadlineExceeded as e:
+            self._respond(504, {"error": str(e)})
+            return
         except Exception as e:
             self._respond(502, {"error": str(e)})
             return
 
-        narrative, scene, state_update = parse_response(response)
-        if state_update is None:
-            self._respond(500, {"error": "Referee fumbled — could not parse response"})
-            return
-
-        new_p1, new_p2 = clamp_hp(p1_hp, p2_hp, state_update)
-
-        game["p1_hp"] = new_p1
-        game["p2_hp"] = new_p2
-        game["situation"] = state_update.get("situation", "")
-        game["last_action"] = state_update.get("last_action", "")
-        game["narrative"] = narrative
-        game["scene"] = scene
-        game["image_safe"] = state_update.get("image_safe", False)
-        game["image_prompt"] = state_update.get("image_prompt", "")
+        state_update = result["state"]
+        new_p1 = state_update["p1_hp"]
+        new_p2 = state_update["p2_hp"]
+        played_turn = game.get("turn", 1)
+
+        changes = {
+            "p1_hp": new_p1,
+            "p2_hp": new_p2,
+            "situation": state_update.get("situation", ""),
+            "last_action": state_update.get("last_action", ""),
+            "narrative": result["narrative"],
+            "scene": result["scene"],
+            "image_safe": state_update.get("image_safe", False),
+            "image_prompt": state_update.get("image_prompt", ""),
+            "turn": played_turn + 1,
+        }
 
         # Persist character appearances for visual consistency across turns
         if state_update.get("p1_look"):
-            game["p1_look"] = state_update["p1_look"]
+            changes["p1_look"] = state_update["p1_look"]
         if state_update.get("p2_look"):
-            game["p2_look"] = state_update["p2_look"]
-
-        # Generate image server-side so both players share the same one
-        image_url = None
-        if game["image_safe"] and game["image_prompt"]:
-            image_url = generate_image(game["image_prompt"])
-        game["image_url"] = image_url
-
-        game["turn"] = game.get("turn", 1) + 1
-        game["current_player"] = 2 if player_num == 1 else 1
-        game["last_updated"] = time.time()
-        game["last_actor"] = player_num
-        game["last_actor_action"] = action
+            changes["p2_look"] = state_update["p2_look"]
+
+        # Image is rendered server-side so both players share the same one.
+        # Its jobs start once the turn is committed and it arrives later
+        # through /api/image_webhook, which the turn's image_token lets in
+        # when no webhook secret is set; poll picks it up.
+        # One drawn before for the same prompt and looks is used straight
+        # away, as is a cached preview while the full image is drawn. Under
+        # load it is skipped, and the turn goes ahead without one.
+        changes["image_url"] = None
+        changes["image_status"] = None
+        changes["image_job"] = None
+        changes["image_preview_job"] = None
+        changes["image_key"] = None
+        changes["image_token"] = None
+        if changes["image_safe"] and changes["image_prompt"]:
+            looks = [changes.get(k) or game.get(k, "") for k in ("p1_look", "p2_look")]
+            changes["image_key"] = image_key(changes["image_prompt"], looks)
+            full, preview = cached_images(changes["image_key"],
+                                          image_key(changes["image_prompt"], looks, preview=True))
+            if full:
+                changes["image_url"] = full
+                changes["image_status"] = "ready"
+            else:
+                changes["image_status"] = "pending"
+                changes["image_token"] = image_token()
+                if IMAGE_PREVIEW and preview:
+                    changes["image_url"] = preview
+                    changes["image_status"] = "preview"
+
+        changes["current_player"] = 2 if player_num == 1 else 1
+        changes["last_updated"] = time.time()
+        changes["last_actor"] = player_num
+        changes["last_actor_action"] = action
 
         if new_p1 <= 0 or new_p2 <= 0:
-            game["status"] = "finished"
+            changes["status"] = "finished"
 
-        kv_set(f"game:{code}", game, ex=3600)
-
-        self._respond(200, {"game": game})
+        # The previous turn's image may land while the referee is thinking;
+        # that write is fine to build on, another turn is not.
+        game = update_game(game, changes, lambda g: g.get("turn") == played_turn,
+                           copy_to=result_key)
+        if game is None:
+            self._respond(409, {"error": "This turn was already played"})
+        return game
+
+    def _start_images(self, game, code):
+        """Start the committed turn's image jobs and record them on the game.
+
+        Only a turn that made it in starts any, so one that lost the race
+        leaves no render or image slot behind. Returns the game as saved.
+        """
+        turn = game["turn"]
+        changes = {"image_status": "skipped", "last_updated": time.time()}
+        lease = image_lease(code, turn)
+        if admit_image(token=lease)[0] is not None:
+            self._start_jobs(changes, game, lease)
+        return update_game(dict(game), changes, lambda g: g.get("turn") == turn) or game
+
+    def _start_jobs(self, changes, game, lease):
+        """Start the image job, and a preview to show until it lands.
+
+        A cached preview was put up with the turn ("preview" status); else
+        one gets a job of its own if IMAGE_PREVIEW is on and an image slot
+        is free after the full render took one.
+        """
+        code, turn, token = game["code"], game["turn"], game["image_token"]
+        prompt = game["image_prompt"]
+        webhook = image_webhook_url(self.headers.get("Host"), code, turn, token)
+        changes["image_job"] = start_image_job(prompt, webhook)
+        if not changes["image_job"]:
+            release(IMAGE_POOL, lease)
+            changes["image_status"] = "failed"
+            return
+        changes["image_status"] = game["image_status"]
+        if not IMAGE_PREVIEW or game["image_status"] == "preview":
+            return
 
-    def _respond(self, status, data):
-        body = json.dumps(data).encode("utf-8")
-        self.send_response(status)
-        self.send_header("Content-Type", "application/json")
-        self.send_header("Content-Length", str(len(body)))
-        self.end_headers()
-        self.wfile.write(body)
+        lease = image_lease(code, turn, preview=True)
+        if admit_image(token=lease)[0] is None:
+            return
+        webhook = image_webhook_url(self.headers.get("Host"), code, turn, token, preview=True)
+        changes["image_preview_job"] = start_image_job(prompt, webhook, preview=True)
+        if not changes["image_preview_job"]:
+            release(IMAGE_POOL, lease)
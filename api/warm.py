@@ -0,0 +1,46 @@
+"""Vercel serverless function — warm-up ping.
+
+GET /api/warm loads the code a turn needs and opens the KV connection, so
+the request that follows doesn't pay for either. It only helps other
+endpoints with the single-function layout (vercel.single.json), where
+they all share this instance.
+"""
+
+import importlib
+import json
+import time
+import sys, os
+sys.path.insert(0, os.path.dirname(__file__))
+
+from _trace import TracedHandler
+from _shared import kv_command
+
+# What a player hits next from the lobby or the turn prompt
+HOT_ENDPOINTS = ("poll", "turn", "ai_turn")
+
+_loaded_at = None
+
+
+class handler(TracedHandler):
+    def do_GET(self):
+        global _loaded_at
+        warm = _loaded_at is not None
+        if not warm:
+            for name in HOT_ENDPOINTS:
+                importlib.import_module(name)
+            _loaded_at = time.time()
+        try:
+            kv_command("PING")
+        except Exception:
+            pass  # the pool just won't have a connection ready
+
+        self._respond(200, {"warm": warm, "age_s": int(time.time() - _loaded_at)})
+
+    def _respond(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(body)
@@ -0,0 +1,91 @@
+"""Vercel serverless function — read-only game view for spectators.
+
+GET ?code= answers with the game's current version and id (plus who is
+playing, whose turn it is and the status), cached at the edge for a
+second. GET ?code=&g=<id>&v=<version> answers with the public view of
+that version; a version never changes once written, and the id keeps a
+later game under the same code from matching, so the edge keeps it for
+good. However
+many viewers a game has, the function sees about one request a second per
+edge region plus one full read per move. Both carry an ETag and answer
+If-None-Match with 304.
+"""
+
+from urllib.parse import urlparse, parse_qs
+import json
+import sys, os
+sys.path.insert(0, os.path.dirname(__file__))
+
+from _trace import TracedHandler
+from _shared import load_game_header, cached_game, valid_code, public_game
+
+SUMMARY_FIELDS = ("code", "gid", "version", "p1_name", "p2_name", "turn", "current_player", "status")
+
+LATEST_CACHE = "public, max-age=0, s-maxage=1, stale-while-revalidate=5"
+VERSION_CACHE = "public, max-age=31536000, s-maxage=31536000, immutable"
+MISSING_CACHE = "public, max-age=0, s-maxage=5"
+
+
+class handler(TracedHandler):
+    def do_GET(self):
+        params = parse_qs(urlparse(self.path).query)
+        code = (params.get("code", [""])[0]).strip().upper()
+        if not valid_code(code):
+            self._respond(400, {"error": "Invalid game code"}, "no-store")
+            return
+        try:
+            version = int(params["v"][0]) if "v" in params else None
+        except ValueError:
+            self._respond(400, {"error": "Invalid version"}, "no-store")
+            return
+        gid = params.get("g", [""])[0]
+
+        header = load_game_header(code)
+        if header is None:
+            self._respond(404, {"error": "Game not found or expired"}, MISSING_CACHE)
+            return
+        current = header.get("version", 0)
+        etag = f'"{code}.{header.get("gid", "")}.{current}"'
+
+        if version is None:
+            if self._fresh(etag):
+                self._not_modified(etag, LATEST_CACHE)
+                return
+            summary = {k: header.get(k) for k in SUMMARY_FIELDS}
+            self._respond(200, summary, LATEST_CACHE, etag)
+            return
+
+        if version != current or gid != header.get("gid", ""):
+            # Older versions aren't kept, newer ones don't exist yet, and
+            # another game's are not this one's
+            self._respond(404, {"error": "Version not current", "version": current}, "no-store")
+            return
+        if self._fresh(etag):
+            self._not_modified(etag, VERSION_CACHE)
+            return
+        game = cached_game(code, header)
+        self._respond(200, public_game(game), VERSION_CACHE, etag)
+
+    def _fresh(self, etag):
+        """Whether the client's If-None-Match already names ``etag``."""
+        tags = self.headers.get("If-None-Match", "")
+        if tags.strip() == "*":
+            return True
+        return etag in (t.strip().removeprefix("W/") for t in tags.split(","))
+
+    def _not_modified(self, etag, cache):
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", cache)
+        self.end_headers()
+
+    def _respond(self, status, data, cache, etag=None):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", cache)
+        if etag:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
@@ -0,0 +1,192 @@
+"""Cold starts with one function per endpoint vs the single-function router.
+
+    python bench/coldstart.py
+    python bench/coldstart.py --games 10 --boot-ms 250
+
+Each function instance is a fresh Python process (bench/function.py),
+started by the first request it has to serve, as a cold Vercel instance
+would be. A local edge sends /api/<name> to the instance running
+api/<name>.py ("split", the default deploy) or to the one running
+api/app.py ("single", vercel.single.json). "single+warm" is the single
+layout with the client calling /api/warm from the lobby.
+
+Every game is played on a fresh deployment: one player creates a game,
+polls in the lobby, the other joins, then a few turns are played. The
+figures are the median over games of each step's latency.
+"""
+
+import argparse
+import http.client
+import os
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import FakeDeepSeek, FakeReplicate, FakeUpstash  # noqa: E402
+from harness import WEBHOOK_SECRET, Client, Recorder, percentile  # noqa: E402
+
+FUNCTION = os.path.join(os.path.dirname(os.path.abspath(__file__)), "function.py")
+LAYOUTS = ("split", "single", "single+warm")
+HOP_HEADERS = {"connection", "content-length", "keep-alive", "transfer-encoding"}
+
+
+class Deployment:
+    """Function instances for one layout, each started on first use."""
+
+    def __init__(self, layout, boot_ms, env):
+        self.layout = layout
+        self.boot_ms = boot_ms
+        self.env = env
+        self.cold_starts = 0
+        self._instances = {}
+        self._locks = defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+
+    def port(self, name):
+        fn = name if self.layout == "split" else "app"
+        with self._lock:
+            lock = self._locks[fn]
+        with lock:
+            if fn not in self._instances:
+                proc = subprocess.Popen([sys.executable, FUNCTION, fn, str(self.boot_ms)],
+                                        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                        env=self.env, text=True)
+                self._instances[fn] = (proc, int(proc.stdout.readline()))
+                self.cold_starts += 1
+            return self._instances[fn][1]
+
+    def close(self):
+        for proc, _ in self._instances.values():
+            proc.kill()
+            proc.wait()
+
+
+class _Edge(BaseHTTPRequestHandler):
+    """Forward /api/<name> to the current deployment, like Vercel's router."""
+
+    protocol_version = "HTTP/1.1"
+    deployment = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._forward("GET")
+
+    def do_POST(self):
+        self._forward("POST")
+
+    def _forward(self, method):
+        name = self.path.split("?", 1)[0].rstrip("/").rsplit("/", 1)[-1]
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        conn = http.client.HTTPConnection("127.0.0.1", self.deployment.port(name), timeout=60)
+        try:
+            headers = {k: v for k, v in self.headers.items() if k.lower() not in HOP_HEADERS}
+            conn.request(method, self.path, body=body or None, headers=headers)
+            resp = conn.getresponse()
+            data = resp.read()
+        finally:
+            conn.close()
+        self.send_response(resp.status)
+        for k, v in resp.getheaders():
+            if k.lower() not in HOP_HEADERS:
+                self.send_header(k, v)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def play(client, args, warm):
+    """One game from the lobby to a few turns in, as two browsers would play it."""
+    status, data = client.call("create", "POST", "/api/create", {"player_name": "ZED"})
+    if status != 200:
+        return
+    code = data["code"]
+    if warm:
+        client.call("warm", "GET", "/api/warm")
+    lobby_end = time.time() + args.lobby_s
+    label = "poll (first)"
+    while time.time() < lobby_end:
+        time.sleep(min(args.poll_interval, max(0, lobby_end - time.time())))
+        client.call(label, "GET", f"/api/poll?code={code}")
+        label = "poll"
+    client.call("join", "POST", "/api/join", {"code": code, "player_name": "BRAWLBOT"})
+    threading.Thread(target=client.call, daemon=True,
+                     args=("looks", "POST", "/api/looks", {"code": code})).start()
+
+    for turn in range(args.turns):
+        num = 1 + turn % 2
+        label = "turn (first)" if turn == 0 else "turn"
+        client.call(label, "POST", "/api/turn",
+                    {"code": code, "player_num": num, "action": "I throw a chair",
+                     "request_id": f"{code}-{turn}"})
+        client.call("poll", "GET", f"/api/poll?code={code}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--games", type=int, default=5, help="fresh deployments per layout")
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--lobby-s", type=float, default=1.0, help="time before the opponent joins")
+    parser.add_argument("--poll-interval", type=float, default=0.5)
+    parser.add_argument("--boot-ms", type=float, default=0,
+                        help="extra start-up per instance for the runtime a local process lacks")
+    parser.add_argument("--deepseek-ttft", default="50")
+    parser.add_argument("--token-ms", type=float, default=1)
+    parser.add_argument("--kv", default="2")
+    args = parser.parse_args(argv)
+
+    deepseek = FakeDeepSeek(args.deepseek_ttft, args.token_ms)
+    replicate = FakeReplicate("100", secret=WEBHOOK_SECRET)
+    kv = FakeUpstash(args.kv)
+    edge = ThreadingHTTPServer(("127.0.0.1", 0), _Edge)
+    edge.daemon_threads = True
+    threading.Thread(target=edge.serve_forever, daemon=True).start()
+    env = dict(os.environ, **{
+        "DEEPSEEK_API_KEY": "bench",
+        "DEEPSEEK_API_URL": deepseek.url,
+        "REPLICATE_API_TOKEN": "bench",
+        "REPLICATE_API_URL": replicate.url,
+        "REPLICATE_WEBHOOK_SECRET": WEBHOOK_SECRET,
+        "KV_REST_API_URL": kv.url,
+        "KV_REST_API_TOKEN": "bench",
+        "PUBLIC_BASE_URL": f"http://127.0.0.1:{edge.server_port}",
+    })
+
+    results = {}
+    cold_starts = Counter()
+    for layout in LAYOUTS:
+        recorder = Recorder()
+        client = Client(edge.server_port, recorder)
+        for _ in range(args.games):
+            deployment = Deployment(layout.split("+")[0], args.boot_ms, env)
+            _Edge.deployment = deployment
+            try:
+                play(client, args, warm=layout.endswith("+warm"))
+                replicate.wait_idle()
+            finally:
+                deployment.close()
+            cold_starts[layout] += deployment.cold_starts
+        results[layout] = recorder
+
+    labels = ["create", "poll (first)", "join", "turn (first)", "turn", "poll"]
+    width = max(len(label) for label in labels + ["cold starts / game"])
+    print(f"{'p50 ms':{width}}  " + "  ".join(f"{layout:>12}" for layout in LAYOUTS))
+    for label in labels:
+        cells = []
+        for layout in LAYOUTS:
+            xs = sorted(results[layout].samples.get(label, []))
+            cells.append("-" if not xs else f"{percentile(xs, 50) * 1000:.1f}")
+        print(f"{label:{width}}  " + "  ".join(f"{c:>12}" for c in cells))
+    print(f"{'cold starts / game':{width}}  "
+          + "  ".join(f"{cold_starts[layout] / args.games:>12.1f}" for layout in LAYOUTS))
+    edge.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,707 @@
+"""Local stand-ins for DeepSeek, Replicate and Upstash used by the benchmarks.
+
+Each fake is a threaded HTTP/1.1 server with keep-alive, so the pooled
+client in api/_http.py behaves the way it does against the real services.
+The Upstash fake also speaks RESP, standing in for a Redis server.
+Upstream latency comes from a ``Latency`` distribution per fake.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import random
+import re
+import select
+import socket
+import socketserver
+import sys
+import threading
+import time
+import urllib.request
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+CASSETTE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cassettes")
+
+
+class Latency:
+    """A latency distribution in milliseconds, parsed from a spec string.
+
+    "120" or "fixed:120", "uniform:50,200", "lognormal:800,0.4" (median, sigma).
+    ``sample()`` returns seconds.
+    """
+
+    def __init__(self, spec):
+        self.spec = str(spec)
+        kind, _, args = self.spec.partition(":")
+        if not args:
+            kind, args = "fixed", kind
+        nums = [float(x) for x in args.split(",")]
+        if kind not in ("fixed", "uniform", "lognormal"):
+            raise ValueError(f"unknown latency distribution: {kind}")
+        self.kind, self.nums = kind, nums
+        self._rng = random.Random(hash(self.spec))
+        self._lock = threading.Lock()
+
+    def sample(self):
+        with self._lock:
+            if self.kind == "fixed":
+                ms = self.nums[0]
+            elif self.kind == "uniform":
+                ms = self._rng.uniform(self.nums[0], self.nums[1])
+            else:
+                ms = self._rng.lognormvariate(0, self.nums[1]) * self.nums[0]
+        return max(0.0, ms) / 1000.0
+
+    def __repr__(self):
+        return self.spec
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients hang up on purpose (cancelled hedges, abandoned streams)
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def _make_server(handler_cls, **attrs):
+    server = _Server(("127.0.0.1", 0), type(handler_cls.__name__, (handler_cls,), attrs))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def nodelay(conn):
+    # Headers and body go out in separate writes; without this, Nagle plus
+    # delayed ACKs add ~40ms to every keep-alive response.
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        nodelay(self.connection)
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def _json(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+
+# --- DeepSeek ---
+
+def load_cassette(name):
+    with open(os.path.join(CASSETTE_DIR, name)) as f:
+        return json.load(f)
+
+
+class _DeepSeekHandler(_Handler):
+    fake = None
+
+    def do_POST(self):
+        self.fake.serve(self, json.loads(self._body()))
+
+
+class FakeDeepSeek:
+    """Chat completions served from recorded replies.
+
+    Referee replies are replayed with their damage applied to the HP in the
+    prompt, so games run to a finish. ``ttft`` is the wait before the first
+    token and ``token_ms`` the generation time per completion token. A
+    ``stall`` share of requests hangs for ``stall_s`` seconds before
+    answering, and an ``errors`` share fails with a 500. With
+    ``fresh_images`` no two image prompts are the same, as with real
+    replies, so the image cache never hits.
+    """
+
+    CHUNK_CHARS = 16  # about four tokens per streamed delta
+
+    def __init__(self, ttft="lognormal:700,0.35", token_ms=12, cassette="deepseek.json",
+                 stall=0.0, stall_s=30.0, errors=0.0, fresh_images=False):
+        self.ttft = Latency(ttft)
+        self.token_ms = float(token_ms)
+        self.stall = stall
+        self.stall_s = stall_s
+        self.errors = errors
+        self.fresh_images = fresh_images
+        self.cassette = load_cassette(cassette)
+        self.calls = Counter()
+        self._seen_prefixes = set()
+        self._rng = random.Random(7)
+        self._faults = random.Random(11)
+        self._lock = threading.Lock()
+        self.server = _make_server(_DeepSeekHandler, fake=self)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/chat/completions"
+
+    def _reply(self, system, user, json_mode=False):
+        with self._lock:
+            if system.startswith("You are BRAWLBOT"):
+                self.calls["opponent"] += 1
+                return self._rng.choice(self.cassette["opponent"])
+            if system.startswith("You are the costume designer"):
+                self.calls["looks"] += 1
+                entry = self._rng.choice(self.cassette["referee"])["state"]
+                return json.dumps({"p1_look": entry["p1_look"], "p2_look": entry["p2_look"]})
+            self.calls["referee"] += 1
+            entry = self._rng.choice(self.cassette["referee"])
+            if self.fresh_images:
+                prompt = f"{entry['state']['image_prompt']}, take {self.calls['referee']}"
+                entry = dict(entry, state=dict(entry["state"], image_prompt=prompt))
+        return render_referee(entry, user, json_mode)
+
+    def _usage(self, system, user, completion):
+        # DeepSeek caches whole 64-token units of a prefix it has seen before
+        prompt_tokens = (len(system) + len(user)) // 4
+        cacheable = (len(system) // 4) // 64 * 64
+        with self._lock:
+            hit = cacheable if system in self._seen_prefixes else 0
+            self._seen_prefixes.add(system)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "prompt_cache_hit_tokens": hit,
+            "prompt_cache_miss_tokens": prompt_tokens - hit,
+            "completion_tokens": max(1, len(completion) // 4),
+        }
+
+    def serve(self, handler, body):
+        messages = body.get("messages", [])
+        system = messages[0]["content"] if messages else ""
+        user = messages[-1]["content"] if messages else ""
+        json_mode = (body.get("response_format") or {}).get("type") == "json_object"
+        text = self._reply(system, user, json_mode)
+        usage = self._usage(system, user, text)
+        with self._lock:
+            roll = self._faults.random()
+            fail, stall = roll < self.errors, self.errors <= roll < self.errors + self.stall
+            if fail:
+                self.calls["error"] += 1
+            elif stall:
+                self.calls["stalled"] += 1
+        if fail:
+            time.sleep(self.ttft.sample())
+            handler._json(500, {"error": {"message": "Service is too busy"}})
+            return
+        if stall:
+            time.sleep(self.stall_s)
+        time.sleep(self.ttft.sample())
+
+        if not body.get("stream"):
+            time.sleep(usage["completion_tokens"] * self.token_ms / 1000.0)
+            handler._json(200, {
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                             "finish_reason": "stop"}],
+                "usage": usage,
+            })
+            return
+
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Transfer-Encoding", "chunked")
+        handler.end_headers()
+        step = self.CHUNK_CHARS
+        for i in range(0, len(text), step):
+            if i:
+                time.sleep(step / 4 * self.token_ms / 1000.0)
+            delta = {"choices": [{"index": 0, "delta": {"content": text[i:i + step]}}]}
+            handler._chunk(f"data: {json.dumps(delta)}\n\n".encode("utf-8"))
+        if (body.get("stream_options") or {}).get("include_usage"):
+            handler._chunk(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode("utf-8"))
+        handler._chunk(b"data: [DONE]\n\n")
+        handler.wfile.write(b"0\r\n\r\n")
+
+
+_HP_LINE = re.compile(r"\(Player ([12])\): (-?\d+) HP")
+_ACTOR_LINE = re.compile(r"NOW ACTING: .* \(Player ([12])\)")
+
+
+def render_referee(entry, user_prompt, json_mode=False):
+    """Turn a cassette entry into a referee reply for the game in ``user_prompt``."""
+    hp = {int(n): int(v) for n, v in _HP_LINE.findall(user_prompt)}
+    actor = _ACTOR_LINE.search(user_prompt)
+    actor = int(actor.group(1)) if actor else 1
+    target = 2 if actor == 1 else 1
+    state = dict(entry["state"])
+    state[f"p{actor}_hp"] = hp.get(actor, 100) - entry.get("self_damage", 0)
+    state[f"p{target}_hp"] = hp.get(target, 100) - entry.get("damage", 0)
+    if json_mode:
+        return json.dumps({"narrative": entry["narrative"], "state": state, "scene": entry["scene"]})
+    return (f"===NARRATIVE===\n{entry['narrative']}\n\n"
+            f"===SCENE===\n{entry['scene']}\n\n"
+            f"===STATE===\n{json.dumps(state)}")
+
+
+# --- Replicate ---
+
+class _ReplicateHandler(_Handler):
+    fake = None
+
+    def do_POST(self):
+        self.fake.create(self, json.loads(self._body()))
+
+    def do_GET(self):
+        self.fake.get(self)
+
+
+class FakeReplicate:
+    """Predictions that finish after ``latency``, then call their webhook.
+
+    Webhooks are signed the way Replicate signs them when ``secret`` (a
+    "whsec_..." string) is given. Output files are served from /files/ as
+    a webp header plus random bytes.
+    """
+
+    IMAGE = b"RIFF\x00\x00\x00\x00WEBPVP8 "
+    IMAGE_BYTES = 60 * 1024  # about what FLUX-schnell's 16:9 webp weighs
+    PREVIEW_SPEEDUP = 0.3  # a 0.25 megapixel, 2-step preview takes this share of the time
+
+    def __init__(self, latency="lognormal:1800,0.3", secret=""):
+        self.latency = Latency(latency)
+        self.secret = secret
+        self.calls = Counter()
+        self.predictions = {}
+        self._pending = 0
+        self._idle = threading.Condition()
+        self._lock = threading.Lock()
+        self.server = _make_server(_ReplicateHandler, fake=self)
+        self.base = f"http://127.0.0.1:{self.server.server_port}"
+        self.url = f"{self.base}/v1"
+
+    def _prediction(self, pid):
+        return {
+            "id": pid,
+            "status": "starting",
+            "output": None,
+            "urls": {"get": f"{self.url}/predictions/{pid}"},
+        }
+
+    def create(self, handler, body):
+        pid = os.urandom(8).hex()
+        prediction = self._prediction(pid)
+        with self._lock:
+            self.predictions[pid] = prediction
+        delay = self.latency.sample()
+        if body.get("input", {}).get("megapixels") == "0.25":
+            self.calls["preview"] += 1
+            delay *= self.PREVIEW_SPEEDUP
+
+        if handler.headers.get("Prefer") == "wait":
+            self.calls["sync"] += 1
+            time.sleep(delay)
+            self._finish(pid)
+            handler._json(201, prediction)
+            return
+
+        self.calls["async"] += 1
+        handler._json(201, dict(prediction))
+        webhook = body.get("webhook")
+        with self._idle:
+            self._pending += 1
+        timer = threading.Timer(delay, self._complete, (pid, webhook))
+        timer.daemon = True
+        timer.start()
+
+    def _finish(self, pid):
+        with self._lock:
+            prediction = self.predictions[pid]
+            prediction["status"] = "succeeded"
+            prediction["output"] = [f"{self.base}/files/{pid}.webp"]
+        return prediction
+
+    def wait_idle(self, timeout=60):
+        """Block until every async prediction has finished and called back."""
+        with self._idle:
+            self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def _complete(self, pid, webhook):
+        try:
+            self._deliver(pid, webhook)
+        finally:
+            with self._idle:
+                self._pending -= 1
+                self._idle.notify_all()
+
+    def _deliver(self, pid, webhook):
+        prediction = self._finish(pid)
+        if not webhook:
+            return
+        body = json.dumps(prediction).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        if self.secret:
+            msg_id, ts = f"msg_{pid}", str(int(time.time()))
+            key = base64.b64decode(self.secret.split("_", 1)[-1])
+            sig = hmac.new(key, f"{msg_id}.{ts}.".encode("utf-8") + body, hashlib.sha256).digest()
+            headers.update({"webhook-id": msg_id, "webhook-timestamp": ts,
+                            "webhook-signature": "v1," + base64.b64encode(sig).decode()})
+        self.calls["webhook"] += 1
+        try:
+            urllib.request.urlopen(urllib.request.Request(webhook, body, headers), timeout=30).read()
+        except Exception:
+            self.calls["webhook_failed"] += 1
+
+    def get(self, handler):
+        if handler.path.startswith("/files/"):
+            self.calls["download"] += 1
+            body = self.IMAGE + os.urandom(self.IMAGE_BYTES)
+            handler.send_response(200)
+            handler.send_header("Content-Type", "image/webp")
+            handler.send_header("Content-Length", str(len(body)))
+            handler.end_headers()
+            handler.wfile.write(body)
+            return
+        pid = handler.path.rstrip("/").rsplit("/", 1)[-1]
+        with self._lock:
+            prediction = self.predictions.get(pid)
+            prediction = dict(prediction) if prediction else None
+        if prediction is None:
+            handler._json(404, {"detail": "Not found"})
+        else:
+            handler._json(200, prediction)
+
+
+# --- Upstash ---
+
+class KVError(Exception):
+    pass
+
+
+class _UpstashHandler(_Handler):
+    fake = None
+
+    def do_GET(self):
+        args = [unquote(p) for p in self.path.strip("/").split("/")]
+        self.fake.http(self, [args])
+
+    def do_POST(self):
+        body = self._body()
+        path = self.path.strip("/")
+        if path.startswith("subscribe/"):
+            self.fake.subscribe(self, unquote(path.split("/", 1)[1]))
+        elif path == "pipeline":
+            self.fake.http(self, json.loads(body), pipeline=True)
+        else:
+            self.fake.http(self, [json.loads(body)])
+
+
+class _RespServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 256
+
+
+class _RespHandler(socketserver.BaseRequestHandler):
+    """Redis' wire protocol in front of a FakeUpstash.
+
+    Commands that arrive together (a pipeline) count as one round trip.
+    """
+
+    fake = None
+
+    def handle(self):
+        nodelay(self.request)
+        buf = b""
+        while True:
+            try:
+                data = self.request.recv(65536)
+            except OSError:
+                return
+            if not data:
+                return
+            buf += data
+            commands, buf = _parse_resp(buf)
+            if not commands:
+                continue
+            if [c[0].upper() for c in commands] == ["SUBSCRIBE"]:
+                self.fake.subscribe_resp(self.request, commands[0][1])
+                return
+            try:
+                self.request.sendall(self.fake.resp(commands))
+            except OSError:
+                return
+
+
+def _parse_resp(buf):
+    """Split complete RESP commands off the front of ``buf``: (commands, rest)."""
+    commands = []
+    while buf.startswith(b"*"):
+        end = buf.find(b"\r\n")
+        if end < 0:
+            break
+        n, pos, args = int(buf[1:end]), end + 2, []
+        for _ in range(n):
+            end = buf.find(b"\r\n", pos)
+            if end < 0:
+                return commands, buf
+            size = int(buf[pos + 1:end])
+            if len(buf) < end + 2 + size + 2:
+                return commands, buf
+            args.append(buf[end + 2:end + 2 + size].decode("utf-8"))
+            pos = end + 2 + size + 2
+        commands.append(args)
+        buf = buf[pos:]
+    return commands, buf
+
+
+def _resp(value):
+    if isinstance(value, KVError):
+        return b"-%s\r\n" % str(value).encode("utf-8")
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, list):
+        return b"*%d\r\n" % len(value) + b"".join(_resp(v) for v in value)
+    data = str(value).encode("utf-8")
+    return b"$%d\r\n%s\r\n" % (len(data), data)
+
+
+class FakeUpstash:
+    """The subset of the Upstash REST API the game uses, kept in memory.
+
+    The same data is served over RESP at ``redis_url``. Lua scripts from
+    api/_shared.py are run by the Python versions registered with
+    _kv.emulate, looked up by SHA like Redis' script cache. ``ops`` counts commands (pipelined ones
+    individually, script bodies as one EVAL), ``round_trips`` counts
+    HTTP requests and RESP batches, and ``bytes_out`` the replies' size.
+    """
+
+    def __init__(self, latency="lognormal:4,0.5"):
+        self.latency = Latency(latency)
+        self.ops = Counter()
+        self.round_trips = 0
+        self.bytes_out = 0
+        self._data = {}
+        self._expiry = {}
+        self._scripts = {}
+        self._cond = threading.Condition()
+        self._messages = []
+        self.server = _make_server(_UpstashHandler, fake=self)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        self.resp_server = _RespServer(("127.0.0.1", 0), type("_RespHandler", (_RespHandler,), {"fake": self}))
+        threading.Thread(target=self.resp_server.serve_forever, daemon=True).start()
+        self.redis_url = f"redis://127.0.0.1:{self.resp_server.server_address[1]}"
+
+    @staticmethod
+    def _emulation(sha):
+        # Imported late: _shared reads its upstream URLs from the environment
+        # at import time, and those point at these fakes. Importing it
+        # registers the Python versions of its scripts with _kv.
+        import _kv
+        import _shared  # noqa: F401
+        return _kv.emulation(sha)
+
+    def snapshot(self):
+        with self._cond:
+            return Counter(self.ops), self.round_trips, self.bytes_out
+
+    # HTTP side
+
+    def http(self, handler, commands, pipeline=False):
+        time.sleep(self.latency.sample())
+        results = []
+        with self._cond:
+            self.round_trips += 1
+            for cmd in commands:
+                try:
+                    results.append({"result": self.run([str(c) for c in cmd])})
+                except KVError as e:
+                    results.append({"error": str(e)})
+            self.bytes_out += len(json.dumps(results if pipeline else results[0]))
+        if pipeline:
+            handler._json(200, results)
+        elif "error" in results[0]:
+            handler._json(400, results[0])
+        else:
+            handler._json(200, results[0])
+
+    def subscribe(self, handler, channel):
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Connection", "close")
+        handler.end_headers()
+        handler.close_connection = True
+        with self._cond:
+            self.round_trips += 1
+            self.ops["SUBSCRIBE"] += 1
+            seen = len(self._messages)
+        try:
+            handler.wfile.write(f"data: subscribe,{channel},1\n\n".encode("utf-8"))
+            handler.wfile.flush()
+            while True:
+                with self._cond:
+                    self._cond.wait_for(lambda: len(self._messages) > seen, timeout=5)
+                    new, seen = self._messages[seen:], len(self._messages)
+                out = [f"data: message,{channel},{m}\n\n" for c, m in new if c == channel]
+                # A keep-alive comment notices clients that went away
+                handler.wfile.write(("".join(out) or ": ping\n\n").encode("utf-8"))
+                handler.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError, OSError):
+            return
+
+    # RESP side
+
+    def resp(self, commands):
+        time.sleep(self.latency.sample())
+        out = []
+        with self._cond:
+            self.round_trips += 1
+            for cmd in commands:
+                try:
+                    out.append(_resp(self.run(cmd)))
+                except KVError as e:
+                    out.append(_resp(e))
+            self.bytes_out += sum(map(len, out))
+        return b"".join(out)
+
+    def subscribe_resp(self, sock, channel):
+        with self._cond:
+            self.round_trips += 1
+            self.ops["SUBSCRIBE"] += 1
+            seen = len(self._messages)
+        try:
+            sock.sendall(_resp(["subscribe", channel, 1]))
+            while True:
+                with self._cond:
+                    self._cond.wait_for(lambda: len(self._messages) > seen, timeout=5)
+                    new, seen = self._messages[seen:], len(self._messages)
+                out = [_resp(["message", channel, m]) for c, m in new if c == channel]
+                if out:
+                    sock.sendall(b"".join(out))
+                elif select.select([sock], [], [], 0)[0] and not sock.recv(1):
+                    return  # the client hung up
+        except OSError:
+            return
+
+    # Commands (called with the condition held)
+
+    def _get(self, key):
+        exp = self._expiry.get(key)
+        if exp is not None and exp <= time.time():
+            self._data.pop(key, None)
+            self._expiry.pop(key, None)
+        return self._data.get(key)
+
+    def _set(self, key, value, ex=None):
+        self._data[key] = value
+        if ex:
+            self._expiry[key] = time.time() + int(ex)
+        else:
+            self._expiry.pop(key, None)
+
+    def run(self, cmd, counted=True):
+        op, args = cmd[0].upper(), cmd[1:]
+        if counted:
+            self.ops[op] += 1
+        if op == "PING":
+            return "PONG"
+        if op == "GET":
+            value = self._get(args[0])
+            return value if isinstance(value, str) else None
+        if op == "SET":
+            flags = [a.upper() for a in args[2:]]
+            if "NX" in flags and self._get(args[0]) is not None:
+                return None
+            ex = args[2 + flags.index("EX") + 1] if "EX" in flags else None
+            self._set(args[0], args[1], ex)
+            return "OK"
+        if op == "DEL":
+            return sum(1 for k in args if self._data.pop(k, None) is not None)
+        if op == "MGET":
+            return [v if isinstance(v, str) else None for v in map(self._get, args)]
+        if op == "INCR":
+            value = int(self._get(args[0]) or 0) + 1
+            self._data[args[0]] = str(value)
+            return value
+        if op == "EXPIRE":
+            if self._get(args[0]) is None:
+                return 0
+            self._expiry[args[0]] = time.time() + int(args[1])
+            return 1
+        if op == "LPUSH":
+            lst = self._get(args[0]) or []
+            lst[:0] = reversed(args[1:])
+            self._data[args[0]] = lst
+            return len(lst)
+        if op == "LTRIM":
+            lst = self._get(args[0]) or []
+            stop = int(args[2])
+            self._data[args[0]] = lst[int(args[1]):None if stop == -1 else stop + 1]
+            return "OK"
+        if op == "LRANGE":
+            lst = self._get(args[0]) or []
+            stop = int(args[2])
+            return lst[int(args[1]):None if stop == -1 else stop + 1]
+        if op == "HINCRBY":
+            h = self._get(args[0]) or {}
+            h[args[1]] = h.get(args[1], 0) + int(args[2])
+            self._data[args[0]] = h
+            return h[args[1]]
+        if op == "HGETALL":
+            return [x for k, v in (self._get(args[0]) or {}).items() for x in (k, str(v))]
+        if op == "HSET":
+            h = self._get(args[0]) or {}
+            added = sum(1 for k in args[1::2] if k not in h)
+            h.update(zip(args[1::2], args[2::2]))
+            self._data[args[0]] = h
+            return added
+        if op == "HGET":
+            value = (self._get(args[0]) or {}).get(args[1])
+            return None if value is None else str(value)
+        if op == "HDEL":
+            h = self._get(args[0]) or {}
+            return sum(1 for k in args[1:] if h.pop(k, None) is not None)
+        if op == "ZADD":
+            z = self._get(args[0]) or {}
+            added = sum(1 for m in args[2::2] if m not in z)
+            z.update(zip(args[2::2], map(float, args[1::2])))
+            self._data[args[0]] = z
+            return added
+        if op == "ZREM":
+            z = self._get(args[0]) or {}
+            return sum(1 for m in args[1:] if z.pop(m, None) is not None)
+        if op == "ZCARD":
+            return len(self._get(args[0]) or {})
+        if op == "ZSCORE":
+            score = (self._get(args[0]) or {}).get(args[1])
+            return None if score is None else repr(score)
+        if op in ("ZRANK", "ZRANGE"):
+            z = self._get(args[0]) or {}
+            ranked = sorted(z, key=lambda m: (z[m], m))
+            if op == "ZRANK":
+                return ranked.index(args[1]) if args[1] in ranked else None
+            stop = int(args[2])
+            return ranked[int(args[1]):None if stop == -1 else stop + 1]
+        if op == "PUBLISH":
+            self._messages.append((args[0], args[1]))
+            self._cond.notify_all()
+            return 0
+        if op in ("EVAL", "EVALSHA"):
+            sha = hashlib.sha1(args[0].encode("utf-8")).hexdigest() if op == "EVAL" else args[0]
+            if op == "EVAL":
+                self._scripts[sha] = self._emulation(sha)
+            script = self._scripts.get(sha)
+            if script is None:
+                raise KVError("NOSCRIPT No matching script. Please use EVAL.")
+            n = int(args[1])
+            # Commands inside a script count as part of its EVAL
+            call = lambda *a: self.run([str(x) for x in a], counted=False)  # noqa: E731
+            return script(call, args[2:2 + n], args[2 + n:])
+        raise KVError(f"ERR unknown command '{op}'")
@@ -0,0 +1,30 @@
+"""One function instance for bench/coldstart.py: api/<name>.py in a fresh process.
+
+    python bench/function.py turn [BOOT_MS]
+
+Prints the port it listens on once the module is imported.
+"""
+
+import importlib
+import os
+import sys
+import time
+from http.server import ThreadingHTTPServer
+
+API_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "api")
+
+
+def main():
+    name = sys.argv[1]
+    boot_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 0
+    time.sleep(boot_ms / 1000.0)  # runtime start-up a local process doesn't have
+    sys.path.insert(0, API_DIR)
+    module = importlib.import_module(name)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), module.handler)
+    server.daemon_threads = True
+    print(server.server_port, flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
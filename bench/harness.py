@@ -0,0 +1,240 @@
+"""Serve the api/ handlers in-process against the fakes and time calls to them."""
+
+import base64
+import http.client
+import importlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+API_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "api")
+sys.path.insert(0, API_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import FakeDeepSeek, FakeReplicate, FakeUpstash, nodelay  # noqa: E402
+
+WEBHOOK_SECRET = "whsec_" + base64.b64encode(b"bench-webhook-secret").decode()
+
+
+class _Router(BaseHTTPRequestHandler):
+    """Dispatch /api/<name> to api/<name>.py's handler, like Vercel does."""
+
+    handlers = {}
+
+    def setup(self):
+        super().setup()
+        nodelay(self.connection)
+
+    def log_message(self, *args):
+        pass
+
+    def _dispatch(self, method):
+        name = self.path.split("?", 1)[0].rstrip("/").rsplit("/", 1)[-1]
+        handler = self.handlers.get(name)
+        if handler is None:
+            self.send_error(404)
+            return
+        import app
+        app.handle_as(handler, self, method)
+
+    def do_GET(self):
+        self._dispatch("do_GET")
+
+    def do_POST(self):
+        self._dispatch("do_POST")
+
+
+class _AppServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256  # many games connect at once
+
+
+class Stack:
+    """Fake upstreams plus the API, wired together through the environment.
+
+    Only one Stack can exist per process: _shared reads its configuration
+    when it is first imported.
+    """
+
+    def __init__(self, deepseek_ttft, token_ms, replicate_latency, kv_latency,
+                 deepseek_stall=0.0, deepseek_errors=0.0, backup_ttft=None, kv_backend="upstash",
+                 fresh_images=False):
+        if "_shared" in sys.modules:
+            raise RuntimeError("api modules already imported; start the Stack first")
+        self.deepseek = FakeDeepSeek(deepseek_ttft, token_ms, stall=deepseek_stall, errors=deepseek_errors,
+                                     fresh_images=fresh_images)
+        # A second OpenAI-compatible provider, healthy, for the LLM router
+        self.backup = FakeDeepSeek(backup_ttft, token_ms) if backup_ttft else None
+        self.replicate = FakeReplicate(replicate_latency, secret=WEBHOOK_SECRET)
+        self.kv = FakeUpstash(kv_latency)
+        self.blob_dir = tempfile.TemporaryDirectory(prefix="bench-blobs-")
+
+        self.app = _AppServer(("127.0.0.1", 0), _Router)
+        self.base = f"http://127.0.0.1:{self.app.server_port}"
+
+        os.environ.update({
+            "DEEPSEEK_API_KEY": "bench",
+            "DEEPSEEK_API_URL": self.deepseek.url,
+            "REPLICATE_API_TOKEN": "bench",
+            "REPLICATE_API_URL": self.replicate.url,
+            "REPLICATE_WEBHOOK_SECRET": WEBHOOK_SECRET,
+            "KV_REST_API_URL": self.kv.url,
+            "KV_REST_API_TOKEN": "bench",
+            "PUBLIC_BASE_URL": self.base,
+            "ADMIN_TOKEN": "bench",
+            # "memory" keeps game state inside the API process; the fake sees no traffic
+            "KV_BACKEND": kv_backend,
+            "REDIS_URL": self.kv.redis_url,
+            "TRACE_LOG": "0",  # timings are read from Server-Timing instead
+            "BLOB_BACKEND": "local",
+            "BLOB_DIR": self.blob_dir.name,
+            "IMAGE_SOURCES": self.replicate.base,
+        })
+        # Every bench player comes from 127.0.0.1 and plays faster than a person
+        for name in ("ADMIT_IP_PER_MIN", "ADMIT_GAME_PER_MIN"):
+            os.environ.setdefault(name, "0")
+        if self.backup:
+            os.environ["LLM_BACKENDS"] = json.dumps([
+                {"name": "deepseek", "url": self.deepseek.url, "model": "deepseek-chat",
+                 "key_env": "DEEPSEEK_API_KEY"},
+                {"name": "backup", "url": self.backup.url, "model": "backup-chat",
+                 "key_env": "DEEPSEEK_API_KEY"},
+            ])
+        for path in sorted(os.listdir(API_DIR)):
+            name, ext = os.path.splitext(path)
+            if ext == ".py" and not name.startswith("_"):
+                module = importlib.import_module(name)
+                _Router.handlers[name] = type(name, (module.handler,), {"log_message": _Router.log_message})
+        threading.Thread(target=self.app.serve_forever, daemon=True).start()
+
+    def client(self, recorder):
+        return Client(self.app.server_port, recorder)
+
+    def close(self):
+        for server in (self.app, self.deepseek.server, self.replicate.server, self.kv.server,
+                       self.kv.resp_server):
+            server.shutdown()
+        if self.backup:
+            self.backup.server.shutdown()
+        self.blob_dir.cleanup()
+
+
+class Recorder:
+    """Latency samples and outcomes per label, safe to share between threads."""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self.spans = {}
+        self.phases = defaultdict(lambda: defaultdict(list))
+        self._lock = threading.Lock()
+
+    def add(self, label, seconds, status=200):
+        end = time.perf_counter()
+        with self._lock:
+            self.samples[label].append(seconds)
+            self.statuses[label][status] += 1
+            first, last = self.spans.get(label, (end - seconds, end))
+            self.spans[label] = (min(first, end - seconds), max(last, end))
+
+    def add_phases(self, label, server_timing):
+        """Record the per-phase milliseconds of a Server-Timing header."""
+        with self._lock:
+            for name, ms in parse_server_timing(server_timing).items():
+                self.phases[label][name].append(ms)
+
+    def report(self):
+        """Per label: count, errors, throughput over the label's own span, percentiles,
+        and the median of each phase the server reported."""
+        rows = {}
+        for label in sorted(self.samples):
+            xs = sorted(self.samples[label])
+            statuses = self.statuses[label]
+            first, last = self.spans[label]
+            rows[label] = {
+                "count": len(xs),
+                "errors": sum(n for s, n in statuses.items() if s == "exc" or s >= 500),
+                "statuses": {str(s): n for s, n in sorted(statuses.items(), key=str)},
+                "rps": round(len(xs) / (last - first), 2) if last > first else None,
+                "p50_ms": _ms(percentile(xs, 50)),
+                "p95_ms": _ms(percentile(xs, 95)),
+                "p99_ms": _ms(percentile(xs, 99)),
+                "max_ms": _ms(xs[-1] if xs else None),
+                "phases": {name: percentile(sorted(ms), 50) for name, ms in sorted(self.phases[label].items())},
+            }
+        return rows
+
+
+def parse_server_timing(header):
+    """{name: ms} from a Server-Timing header."""
+    timings = {}
+    for metric in (header or "").split(","):
+        name, _, params = metric.strip().partition(";")
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "dur":
+                timings[name] = float(value)
+    return timings
+
+
+def percentile(sorted_xs, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_xs:
+        return None
+    rank = max(1, -(-len(sorted_xs) * p // 100))
+    return sorted_xs[int(rank) - 1]
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+class Client:
+    """Times requests against the local API like a browser would make them."""
+
+    def __init__(self, port, recorder):
+        self.port = port
+        self.recorder = recorder
+
+    def call(self, label, method, path, body=None, timeout=60):
+        """Return (status, data); data is the JSON reply, or the final SSE event's."""
+        started = time.perf_counter()
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=timeout)
+        try:
+            payload = json.dumps(body).encode("utf-8") if body is not None else None
+            headers = {"Content-Type": "application/json"} if payload else {}
+            conn.request(method, path, body=payload, headers=headers)
+            resp = conn.getresponse()
+            if resp.getheader("Content-Type", "").startswith("text/event-stream"):
+                status, data = self._read_events(label, resp, started)
+            else:
+                status, data = resp.status, json.loads(resp.read() or b"null")
+                # Streams send their headers before most of the work is done
+                self.recorder.add_phases(label, resp.getheader("Server-Timing"))
+        except Exception as e:
+            self.recorder.add(label, time.perf_counter() - started, "exc")
+            return None, {"error": str(e)}
+        finally:
+            conn.close()
+        self.recorder.add(label, time.perf_counter() - started, status)
+        return status, data
+
+    def _read_events(self, label, resp, started):
+        event, first = None, True
+        status, data = 502, {"error": "stream ended without a result"}
+        for raw in resp:
+            line = raw.decode("utf-8").rstrip("\n")
+            if line.startswith("event:"):
+                event = line[6:].strip()
+                if first:
+                    self.recorder.add(f"{label} (first event)", time.perf_counter() - started)
+                    first = False
+            elif line.startswith("data:") and event in ("result", "error"):
+                data = json.loads(line[5:])
+                status = 200 if event == "result" else data.get("status", 500)
+        return status, data
@@ -0,0 +1,74 @@
+"""Per-command latency of each KV backend in api/_kv.py.
+
+    python bench/kv_bench.py
+    python bench/kv_bench.py --kv 2 --ops 5000
+    python bench/kv_bench.py --redis-url redis://localhost:6379/15
+
+Upstash and Redis talk to the local fake (REST and RESP respectively) with
+``--kv`` milliseconds of server-side latency, so the difference between them
+is the cost of the client and protocol. ``--redis-url`` adds a real server.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "api"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+os.environ.setdefault("KV_BACKEND", "memory")
+
+import _kv  # noqa: E402
+import _shared  # noqa: E402,F401  (registers the script emulations)
+from fakes import FakeUpstash  # noqa: E402
+from harness import percentile  # noqa: E402
+
+GAME = json.dumps({"code": "000000", "turn": 3, "situation": "x" * 600})
+
+
+def ops(backend):
+    return {
+        "GET": lambda: backend.command("GET", "bench:game"),
+        "SET EX": lambda: backend.command("SET", "bench:game", GAME, "EX", 60),
+        "MGET x2": lambda: backend.command("MGET", "bench:game", "bench:missing"),
+        "pipeline x10": lambda: backend.pipeline([["HINCRBY", "bench:h", f"f{i}", 1] for i in range(10)]),
+        "EVALSHA": lambda: _shared.kv_release_lock("bench:lock", "nobody"),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--kv", default="0", help="fake server latency spec (ms)")
+    parser.add_argument("--ops", type=int, default=2000, help="timed calls per command")
+    parser.add_argument("--redis-url", help="also time a real Redis server")
+    args = parser.parse_args(argv)
+
+    fake = FakeUpstash(args.kv)
+    backends = [_kv.Memory(), _kv.Redis(fake.redis_url), _kv.Upstash(fake.url, "bench")]
+    if args.redis_url:
+        real = _kv.Redis(args.redis_url)
+        real.name = "redis (real)"
+        backends.append(real)
+
+    print(f"{'':14}" + "".join(f"{b.name:>16}" for b in backends))
+    results = {}
+    for backend in backends:
+        _kv.BACKEND = backend
+        for name, op in ops(backend).items():
+            op()  # connect, load scripts
+            times = []
+            for _ in range(args.ops):
+                started = time.perf_counter()
+                op()
+                times.append(time.perf_counter() - started)
+            times.sort()
+            results.setdefault(name, []).append(percentile(times, 50) * 1e6)
+    for name, row in results.items():
+        print(f"{name:14}" + "".join(f"{us:>14.1f}us" for us in row))
+    print("(p50 per call)")
+
+
+if __name__ == "__main__":
+    main()
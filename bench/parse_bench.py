@@ -0,0 +1,73 @@
+"""Referee reply parsing: success rate and parse time over recorded replies.
+
+    python bench/parse_bench.py
+    python bench/parse_bench.py --repeat 5000
+
+Replies in bench/cassettes/referee_replies.json are in either the legacy
+===SECTION=== format or the JSON format, clean and in the malformed shapes
+DeepSeek has been seen to produce. Each is parsed by the legacy
+parse_response and by parse_referee_reply, which reads JSON first.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "api"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _shared import parse_response, parse_referee_reply  # noqa: E402
+from fakes import CASSETTE_DIR  # noqa: E402
+from harness import percentile  # noqa: E402
+
+PARSERS = {"parse_response": parse_response, "parse_referee_reply": parse_referee_reply}
+
+
+def usable(parsed):
+    """Whether the game could go on with this parse, as referee_turn decides."""
+    narrative, _, state = parsed
+    return (state is not None and bool(narrative)
+            and isinstance(state.get("p1_hp", 0), (int, float))
+            and isinstance(state.get("p2_hp", 0), (int, float)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", default=os.path.join(CASSETTE_DIR, "referee_replies.json"))
+    parser.add_argument("--repeat", type=int, default=2000, help="timed parses per reply")
+    args = parser.parse_args(argv)
+
+    with open(args.corpus) as f:
+        corpus = json.load(f)
+
+    for name, parse in PARSERS.items():
+        ok = defaultdict(int)
+        total = defaultdict(int)
+        times = defaultdict(list)
+        failed = []
+        for entry in corpus:
+            fmt = entry["format"]
+            total[fmt] += 1
+            if usable(parse(entry["reply"])):
+                ok[fmt] += 1
+            else:
+                failed.append(f"{fmt}/{entry['kind']}")
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                parse(entry["reply"])
+                times[fmt].append(time.perf_counter() - started)
+
+        print(name)
+        for fmt in sorted(total):
+            xs = sorted(times[fmt])
+            print(f"  {fmt:9} {ok[fmt]:>3}/{total[fmt]:<3} usable  "
+                  f"p50 {percentile(xs, 50) * 1e6:7.1f}us  p99 {percentile(xs, 99) * 1e6:7.1f}us")
+        if failed:
+            print("  fumbled:", ", ".join(failed))
+
+
+if __name__ == "__main__":
+    main()
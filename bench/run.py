@@ -0,0 +1,450 @@
+"""Offline load test for the API handlers.
+
+Every handler in api/ is served in-process while DeepSeek, Replicate and
+Upstash are replaced by local fakes with configurable latency (see
+bench/fakes.py). Nothing touches the network.
+
+    python bench/run.py                          # 20 concurrent games
+    python bench/run.py --scenario endpoints     # each handler on its own
+    python bench/run.py --games 100 --poll long --json out.json
+    python bench/run.py --scenario lobby --arrivals 600
+    python bench/run.py --games 60 --llm-inflight 20   # admission control sheds images, then turns
+
+Latency specs are milliseconds: "120", "uniform:50,200" or
+"lognormal:MEDIAN,SIGMA".
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import Recorder, Stack  # noqa: E402
+
+ACTIONS = [
+    "I smack them with a frying pan",
+    "I summon a swarm of bees shaped like a fist",
+    "I erupt a tiny volcano under their feet",
+    "I fire forty rubber ducks at mach speed",
+    "I tell the worst dad joke ever told",
+    "I drop a grand piano from the rafters",
+]
+
+STATE = {
+    "p1_name": "ZED", "p2_name": "BRAWLBOT", "p1_hp": 100, "p2_hp": 100,
+    "situation": "An open arena, untouched and waiting for chaos.",
+    "last_action": "None yet. This is the first move!",
+}
+
+
+# --- Game sessions ---
+
+class _Game:
+    def __init__(self):
+        self.code = None
+        self.ready = threading.Event()
+
+
+class Sessions:
+    """Concurrent two-player games played start to finish.
+
+    The waiting player polls the way the web client does: every
+    ``poll_interval`` seconds, or by long-polling with ``--poll long``.
+    """
+
+    def __init__(self, stack, recorder, args):
+        self.stack = stack
+        self.recorder = recorder
+        self.args = args
+        self.turns = 0
+        self.finished = 0
+        self.images = Counter()  # image_status of each played turn
+        self._lock = threading.Lock()
+
+    def run(self):
+        games = [_Game() for _ in range(self.args.games)]
+        threads = []
+        for game in games:
+            # Stagger arrivals over one poll interval so polls don't beat in lockstep
+            delay = random.uniform(0, self.args.poll_interval)
+            for num in (1, 2):
+                t = threading.Thread(target=self._player, args=(game, num, delay), daemon=True)
+                t.start()
+                threads.append(t)
+        for t in threads:
+            t.join()
+
+    def _player(self, shared, num, delay):
+        client = self.stack.client(self.recorder)
+        time.sleep(delay)
+        if num == 1:
+            status, data = client.call("create", "POST", "/api/create", {"player_name": "ZED"})
+            if status == 200:
+                shared.code = data["code"]
+            shared.ready.set()
+        else:
+            shared.ready.wait()
+            if shared.code is None:
+                return
+            status, data = client.call("join", "POST", "/api/join",
+                                       {"code": shared.code, "player_name": "BRAWLBOT"})
+            if status == 200:
+                # Like the browser: the looks are asked for and not waited on
+                threading.Thread(target=client.call, daemon=True,
+                                 args=("looks", "POST", "/api/looks", {"code": shared.code})).start()
+        if status != 200:
+            return
+
+        game = data["game"]
+        request = None
+        while game.get("status") != "finished" and game.get("turn", 1) <= self.args.max_turns:
+            if game.get("status") == "active" and game.get("current_player") == num:
+                request = request or {
+                    "code": shared.code, "player_num": num, "action": random.choice(ACTIONS),
+                    "request_id": uuid.uuid4().hex, "stream": self.args.stream,
+                }
+                status, data = client.call("turn", "POST", "/api/turn", request)
+                if status == 200:
+                    game, request = data["game"], None
+                    with self._lock:
+                        self.turns += 1
+                        self.images[game.get("image_status") or "none"] += 1
+                elif status == 409 and data.get("in_progress"):
+                    time.sleep(1)
+                elif status == 429:
+                    time.sleep(data.get("retry_after", 1))
+                elif status is None or status >= 500:
+                    time.sleep(1)  # same request_id, so a retry can't double-play
+                else:
+                    return
+            else:
+                game = self._poll(client, shared.code, game)
+                if game is None:
+                    return
+        if num == 1 and game.get("status") == "finished":
+            with self._lock:
+                self.finished += 1
+
+    def _poll(self, client, code, game):
+        version = game.get("version")
+        path = f"/api/poll?code={code}&v={version}&delta=1"
+        if self.args.poll == "long":
+            path += "&wait=25"
+        else:
+            time.sleep(self.args.poll_interval)
+
+        started = time.time()
+        status, data = client.call(f"poll ({self.args.poll})", "GET", path)
+        if status == 404:
+            return None
+        if status != 200:
+            time.sleep(self.args.poll_interval)
+            return game
+        if not data.get("changed"):
+            if self.args.poll == "long" and time.time() - started < 1:
+                time.sleep(self.args.poll_interval)  # the client backs off after quick replies
+            return game
+
+        seen_turn = game.get("turn", 1)
+        had_image = game.get("image_url")
+        committed = game.get("last_updated", time.time())
+        if "patch" in data:
+            game = dict(game, **data["patch"])
+            for key in data.get("unset", []):
+                game.pop(key, None)
+            game["version"] = data["version"]
+        else:
+            game = data["game"]
+        if game.get("turn", 1) > seen_turn:
+            # Time from the server committing the opponent's move to this player seeing it
+            lag = time.time() - game.get("last_updated", time.time())
+            self.recorder.add("opponent sees turn", max(0.0, lag))
+        elif game.get("image_url") and not had_image:
+            # Time from the turn being committed to its first picture, preview or not
+            self.recorder.add("first picture", max(0.0, time.time() - committed))
+        return game
+
+
+# --- Quick-match lobby ---
+
+class Lobby:
+    """Players arrive at random, ``arrivals`` a minute for ``duration`` seconds, and quick-match.
+
+    Queued players long-poll their ticket like the web client. Every game
+    must end up with exactly the two players it was made for.
+    """
+
+    def __init__(self, stack, recorder, args):
+        self.stack = stack
+        self.recorder = recorder
+        self.args = args
+        self.codes = Counter()
+        self.unmatched = 0
+        self._lock = threading.Lock()
+
+    def run(self):
+        threads = []
+        rate = self.args.arrivals / 60.0
+        ends = time.time() + self.args.duration
+        while time.time() < ends:
+            t = threading.Thread(target=self._player, daemon=True)
+            t.start()
+            threads.append(t)
+            time.sleep(random.expovariate(rate))
+        for t in threads:
+            t.join()
+
+    def _player(self):
+        client = self.stack.client(self.recorder)
+        started = time.perf_counter()
+        status, data = client.call("match", "POST", "/api/match", {"player_name": "ZED"})
+        # The last arrivals give up once nobody else is coming
+        give_up = time.time() + self.args.duration
+        while status == 200 and not data.get("matched") and time.time() < give_up:
+            status, data = client.call("match (wait)", "GET",
+                                       f"/api/match?ticket={data['ticket']}&wait=25")
+        if status == 200 and data.get("matched"):
+            self.recorder.add("time to match", time.perf_counter() - started)
+            with self._lock:
+                self.codes[data["code"]] += 1
+        else:
+            if status == 200:
+                client.call("match (cancel)", "POST", "/api/match", {"ticket": data["ticket"], "cancel": True})
+            with self._lock:
+                self.unmatched += 1
+
+    def summary(self):
+        sizes = Counter(self.codes.values())
+        return {
+            "players": sum(self.codes.values()) + self.unmatched,
+            "games": len(self.codes),
+            "unmatched": self.unmatched,
+            "games_not_two_players": sum(n for size, n in sizes.items() if size != 2),
+        }
+
+
+# --- Single endpoints ---
+
+class Endpoints:
+    """Each handler on its own, ``requests`` calls at ``concurrency``."""
+
+    def __init__(self, stack, recorder, args):
+        self.stack = stack
+        self.recorder = recorder
+        self.args = args
+        self.setup = stack.client(Recorder())  # untimed helper calls
+        self.client = stack.client(recorder)
+        self.kv_per_turn = None
+
+    def _new_game(self):
+        _, data = self.setup.call("create", "POST", "/api/create", {"player_name": "ZED"})
+        _, data = self.setup.call("join", "POST", "/api/join", {"code": data["code"], "player_name": "BRAWLBOT"})
+        self.setup.call("looks", "POST", "/api/looks", {"code": data["game"]["code"]})
+        return data["game"]
+
+    def _many(self, fn):
+        with ThreadPoolExecutor(self.args.concurrency) as pool:
+            list(pool.map(lambda _: fn(), range(self.args.requests)))
+
+    def run(self):
+        c = self.client
+        self._many(lambda: c.call("create", "POST", "/api/create", {"player_name": "ZED"}))
+
+        codes = [self.setup.call("create", "POST", "/api/create", {"player_name": "ZED"})[1]["code"]
+                 for _ in range(self.args.requests)]
+        with ThreadPoolExecutor(self.args.concurrency) as pool:
+            list(pool.map(lambda code: c.call("join", "POST", "/api/join",
+                                              {"code": code, "player_name": "BRAWLBOT"}), codes))
+
+        game = self._new_game()
+        self._many(lambda: c.call("poll (full)", "GET", f"/api/poll?code={game['code']}"))
+        self._many(lambda: c.call("poll (unchanged)", "GET",
+                                  f"/api/poll?code={game['code']}&v={game['version']}"))
+
+        self._turns()
+
+        body = {"state": STATE, "player_name": "ZED", "player_num": 1, "action": ACTIONS[0]}
+        self._many(lambda: c.call("referee", "POST", "/api/referee", body))
+        self._many(lambda: c.call("referee (stream)", "POST", "/api/referee", dict(body, stream=True)))
+        self._many(lambda: c.call("ai_turn", "POST", "/api/ai_turn", dict(body, ai_name="BRAWLBOT")))
+        self._many(lambda: c.call("opponent", "POST", "/api/opponent",
+                                  {"state": STATE, "ai_name": "BRAWLBOT", "player_num": 2}))
+        self._many(lambda: c.call("image", "POST", "/api/image", {"prompt": "a taco explosion"}))
+
+    def _turns(self):
+        local = threading.local()
+        played = Counter()
+        lock = threading.Lock()
+
+        def one():
+            game = getattr(local, "game", None)
+            if game is None or game.get("status") == "finished":
+                game = self._new_game()
+            num = game["current_player"]
+            status, data = self.client.call("turn", "POST", "/api/turn", {
+                "code": game["code"], "player_num": num, "action": random.choice(ACTIONS),
+                "request_id": uuid.uuid4().hex,
+            })
+            if status == 200:
+                game = data["game"]
+                with lock:
+                    played["turns"] += 1
+            local.game = game
+
+        # Count the KV traffic a turn causes, including the image webhook it
+        # triggers later. Games that finish are replaced inside the window,
+        # so a small share of create/join traffic is in the figure too.
+        self.stack.replicate.wait_idle()
+        ops_before, trips_before, sent_before = self.stack.kv.snapshot()
+        self._many(one)
+        self.stack.replicate.wait_idle()
+        ops_after, trips_after, sent_after = self.stack.kv.snapshot()
+        if played["turns"] and trips_after > trips_before:
+            self.kv_per_turn = kv_breakdown(ops_after - ops_before, trips_after - trips_before,
+                                            sent_after - sent_before, played["turns"])
+
+
+# --- Reporting ---
+
+def print_table(rows):
+    cols = ("count", "errors", "rps", "p50_ms", "p95_ms", "p99_ms", "max_ms")
+    width = max([len(label) for label in rows] + [8])
+    print(f"{'':{width}}  " + "  ".join(f"{c:>8}" for c in cols))
+    for label, row in rows.items():
+        cells = ["-" if row[c] is None else row[c] for c in cols]
+        print(f"{label:{width}}  " + "  ".join(f"{v:>8}" for v in cells))
+
+
+def print_phases(rows):
+    lines = [f"  {label}: " + ", ".join(f"{k} {v}" for k, v in row["phases"].items())
+             for label, row in rows.items() if row["phases"]]
+    if lines:
+        print("\nserver phases (p50 ms, from Server-Timing):")
+        print("\n".join(lines))
+
+
+def kv_breakdown(ops, trips, sent, turns):
+    return {
+        "turns": turns,
+        "round_trips": round(trips / turns, 2),
+        "kb_out": round(sent / turns / 1024, 2),
+        "commands": {k: round(v / turns, 2) for k, v in sorted(ops.items())},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=("sessions", "endpoints", "lobby"), default="sessions")
+    parser.add_argument("--games", type=int, default=20, help="concurrent games (sessions)")
+    parser.add_argument("--max-turns", type=int, default=12, help="stop a game after this many turns")
+    parser.add_argument("--poll", choices=("short", "long"), default="short")
+    parser.add_argument("--poll-interval", type=float, default=2.0)
+    parser.add_argument("--stream", action="store_true", help="submit turns with SSE streaming")
+    parser.add_argument("--requests", type=int, default=40, help="calls per handler (endpoints)")
+    parser.add_argument("--arrivals", type=float, default=300, help="players a minute (lobby)")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of arrivals (lobby)")
+    parser.add_argument("--concurrency", type=int, default=8, help="parallel callers (endpoints)")
+    parser.add_argument("--deepseek-ttft", default="lognormal:700,0.35")
+    parser.add_argument("--token-ms", type=float, default=12)
+    parser.add_argument("--deepseek-stall", type=float, default=0.0, metavar="SHARE",
+                        help="share of DeepSeek requests that hang for 30s")
+    parser.add_argument("--deepseek-errors", type=float, default=0.0, metavar="SHARE",
+                        help="share of DeepSeek requests that fail with a 500")
+    parser.add_argument("--backup-ttft", metavar="SPEC",
+                        help="add a second, healthy LLM backend with this time to first token")
+    parser.add_argument("--replicate", default="lognormal:1800,0.3")
+    parser.add_argument("--kv", default="lognormal:4,0.5")
+    parser.add_argument("--kv-backend", choices=("upstash", "redis", "memory"), default="upstash",
+                        help="reach the KV fake over REST or RESP, or keep state in the API process")
+    parser.add_argument("--llm-inflight", type=int, metavar="N",
+                        help="admit at most N LLM requests at once (LLM_MAX_INFLIGHT)")
+    parser.add_argument("--image-inflight", type=int, metavar="N",
+                        help="admit at most N image jobs at once (IMAGE_MAX_INFLIGHT)")
+    parser.add_argument("--fresh-images", action="store_true",
+                        help="make every image prompt new, so the image cache never hits")
+    parser.add_argument("--no-preview", action="store_true",
+                        help="full images only, no quick previews first (IMAGE_PREVIEW=0)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", metavar="PATH", help="also write results as JSON")
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    if args.llm_inflight is not None:
+        os.environ["LLM_MAX_INFLIGHT"] = str(args.llm_inflight)
+    if args.image_inflight is not None:
+        os.environ["IMAGE_MAX_INFLIGHT"] = str(args.image_inflight)
+    if args.no_preview:
+        os.environ["IMAGE_PREVIEW"] = "0"
+    stack = Stack(args.deepseek_ttft, args.token_ms, args.replicate, args.kv,
+                  args.deepseek_stall, args.deepseek_errors, args.backup_ttft, args.kv_backend,
+                  args.fresh_images)
+    recorder = Recorder()
+    ops_before, trips_before, sent_before = stack.kv.snapshot()
+    started = time.perf_counter()
+
+    if args.scenario == "sessions":
+        runner = Sessions(stack, recorder, args)
+        runner.run()
+    elif args.scenario == "lobby":
+        runner = Lobby(stack, recorder, args)
+        runner.run()
+    else:
+        runner = Endpoints(stack, recorder, args)
+        runner.run()
+    wall = time.perf_counter() - started
+    stack.replicate.wait_idle()  # images still on their way belong to the run
+    ops_after, trips_after, sent_after = stack.kv.snapshot()
+
+    rows = recorder.report()
+    print_table(rows)
+    print_phases(rows)
+    result = {
+        "config": vars(args),
+        "wall_s": round(wall, 2),
+        "endpoints": rows,
+        "upstream_calls": {
+            "deepseek": dict(stack.deepseek.calls),
+            "replicate": dict(stack.replicate.calls),
+        },
+    }
+    if stack.backup:
+        result["upstream_calls"]["backup"] = dict(stack.backup.calls)
+    print(f"\nwall {wall:.1f}s")
+    if args.scenario == "sessions":
+        result["turns"] = runner.turns
+        result["games_finished"] = runner.finished
+        result["turn_images"] = dict(runner.images)
+        print(f"turns {runner.turns} ({runner.turns / wall:.2f}/s), games finished {runner.finished}/{args.games}")
+        print("turn images:", json.dumps(result["turn_images"]))
+        if runner.turns and trips_after > trips_before:
+            result["kv_per_turn"] = kv_breakdown(ops_after - ops_before, trips_after - trips_before,
+                                                 sent_after - sent_before, runner.turns)
+    elif args.scenario == "lobby":
+        result["lobby"] = runner.summary()
+        print("lobby:", json.dumps(result["lobby"]))
+    else:
+        result["kv_per_turn"] = runner.kv_per_turn
+
+    kv = result.get("kv_per_turn")
+    if kv:
+        label = "turn handler only" if args.scenario == "endpoints" else "whole session, incl. polls"
+        print(f"KV per turn ({label}): {kv['round_trips']} round trips, {kv['kb_out']} KB read, "
+              + ", ".join(f"{k} {v}" for k, v in kv["commands"].items()))
+    print("upstream calls:", json.dumps(result["upstream_calls"]))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+    stack.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Run the site locally: public/ plus every api/ endpoint on one port.
+
+    python dev.py                      # http://localhost:3000, games kept in memory
+    KV_BACKEND=redis python dev.py     # against a local redis-server
+    python dev.py --port 8080
+
+Games live in this process unless KV_BACKEND says otherwise, so nothing
+needs setting up besides DEEPSEEK_API_KEY (and REPLICATE_API_TOKEN for
+images). Replicate can't reach the image webhook on localhost, so turn
+images only show up if PUBLIC_BASE_URL points at a tunnel to this server.
+"""
+
+import argparse
+import os
+import sys
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+class _DevHandler(SimpleHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith("/api/"):
+            self._api("do_GET")
+        else:
+            super().do_GET()
+
+    def do_POST(self):
+        if self.path.startswith("/api/"):
+            self._api("do_POST")
+        else:
+            self.send_error(405)
+
+    def _api(self, method):
+        import app
+        app.handle_as(app.handler, self, method)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3000)
+    args = parser.parse_args(argv)
+
+    # Before api/ is imported: the backends read their settings at import time
+    os.environ.setdefault("KV_BACKEND", "memory")
+    os.environ.setdefault("BLOB_BACKEND", "local")
+    os.environ.setdefault("PUBLIC_BASE_URL", f"http://{args.host}:{args.port}")
+    sys.path.insert(0, os.path.join(ROOT, "api"))
+
+    server = ThreadingHTTPServer((args.host, args.port),
+                                 partial(_DevHandler, directory=os.path.join(ROOT, "public")))
+    server.daemon_threads = True
+    print(f"http://{args.host}:{args.port} (KV_BACKEND={os.environ['KV_BACKEND']})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()